@@ -0,0 +1,551 @@
+#!/usr/bin/python
+
+"""A stand-in for the parts of eventsforce that the editor talks to,
+serving a synthetic set of people, so that fetching, uploading and
+photo downloads can be run (and timed) without the real site:
+
+    python bench/efserver.py --people 5000 --latency 200 --failure-rate 0.02
+
+then point the editor, efsync or membercheck at it:
+
+    EF_BASE_URL=http://localhost:8080 python efsync.py --event 101 --once
+
+It covers logging in (LoginTask), the report parameters page and
+running and exporting reports (ReportFormTask, ReportTask,
+MemberReportTask), person and registration pages (PhotosTask,
+CategoryTask), the registration pages that UploadTask walks through,
+and photos (PhotoDownload, with ETag/Last-Modified revalidation).
+Uploaded photos replace the person's current one.
+
+The pages only have as much markup as the scraping code looks for; the
+same seed always gives the same people.
+"""
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from Cookie import SimpleCookie
+from StringIO import StringIO
+from email.utils import formatdate
+from cgi import escape, FieldStorage
+import argparse
+import datetime
+import hashlib
+import random
+import threading
+import time
+import urlparse
+import os
+import sys
+
+from PIL import Image, ImageDraw
+
+backend = '/libdems/backend/home/'
+frontend = '/libdems/frontend/reg/'
+# Where photos are served from. Reports only give their filenames;
+# PhotosTask works out what those are relative to from a person page,
+# so nothing in the editor depends on this path.
+media = '/LIBDEMS/media/delegate_files/'
+
+# Reports which show their parameters page first; others run
+# straight away, over everybody
+criteria_profiles = [69]
+date_criterion = 12
+event_criterion = 13
+
+columns = ['Person ID', 'Salutation', 'Firstname', 'common first name', 'Lastname', 'Full Name',
+           'username', 'Profile Picture', 'Membership No', 'Voting Rights', 'EF_Application Status',
+           'Local Party', 'Local Party (Other)', 'Event ID', 'Event Name',
+           'Booking Ref', 'Bookers Firstname', 'Bookers lastname', 'Type of Attendee', 'Amendment Date']
+
+firstnames = ['Alice', 'Bob', 'Carol', 'Dave', 'Eve', 'Frank', 'Grace', 'Heidi', u'Zo\xeb', u'Ren\xe9e']
+lastnames = ['Smith', 'Jones', 'Brown', "O'Neill", 'Taylor', 'Williams', 'Davies', 'Evans']
+categories = ['Member', 'Exhibitor', 'Press', 'Observer', 'Staff']
+statuses = ['Approved', 'Pending', 'Rejected', '']
+local_parties = ['Camden', 'Islington', 'Hackney', 'Cambridge', '']
+
+def ef_date(date):
+    return date.strftime('%d-%b-%Y')
+
+def parse_ef_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%d-%b-%Y').date()
+    except ValueError:
+        return None
+
+class Dataset(object):
+    """People, their registrations and their photos"""
+    def __init__(self, people, events, photo_rate, seed, photo_size):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.photo_size = photo_size
+        self.started = time.time()
+        self.events = [(101 + i, 'Conference %d' % (101 + i)) for i in xrange(events)]
+        today = datetime.date.today()
+        self.people = {}
+        for i in xrange(people):
+            id = 100001 + i
+            first = rng.choice(firstnames)
+            last = rng.choice(lastnames)
+            registrations = {}
+            for event_id, event_name in rng.sample(self.events, rng.randint(1, min(3, len(self.events)))):
+                registrations[event_id] = {'Type of Attendee': rng.choice(categories),
+                                           'Booking Ref': 'REF%07d%d' % (id, event_id),
+                                           'Bookers Firstname': first,
+                                           'Bookers lastname': last,
+                                           }
+            self.people[id] = {'Person ID': id,
+                               'Salutation': rng.choice(['Mr', 'Ms', 'Dr', '']),
+                               'Firstname': first,
+                               'common first name': '',
+                               'Lastname': last,
+                               'Full Name': '%s %s' % (first, last),
+                               'username': 'user%d' % id,
+                               'Membership No': 'M%07d' % id,
+                               'Voting Rights': rng.choice(['Yes', 'No']),
+                               'EF_Application Status': rng.choice(statuses),
+                               'Local Party': rng.choice(local_parties),
+                               'Local Party (Other)': '',
+                               'photo': 1 if rng.random() < photo_rate else None,
+                               'photo_versions': 1,
+                               'amended': today - datetime.timedelta(days=rng.randint(0, 400)),
+                               'events': registrations,
+                               }
+        # Photos that have been uploaded, by filename
+        self.uploads = {}
+        self.photo_cache = {}
+
+    def photo_name(self, person):
+        if person['photo'] is None:
+            return None
+        return '%d_%d.jpg' % (person['Person ID'], person['photo'])
+
+    def photo(self, name):
+        """(data, etag) of a photo, or None"""
+        with self.lock:
+            if name in self.uploads:
+                data = self.uploads[name]
+            elif name in self.photo_cache:
+                data = self.photo_cache[name]
+            else:
+                data = self.make_photo(name)
+                if data is None:
+                    return None
+                self.photo_cache[name] = data
+        return data, '"%s"' % hashlib.md5(data).hexdigest()
+
+    def make_photo(self, name):
+        try:
+            id, version = [int(part) for part in name.split('.')[0].split('_')]
+        except ValueError:
+            return None
+        person = self.people.get(id)
+        if person is None or version != 1 or person['photo'] is None:
+            return None
+        rng = random.Random(id * 1000 + version)
+        image = Image.new('RGB', self.photo_size, tuple(rng.randint(0, 255) for i in xrange(3)))
+        draw = ImageDraw.Draw(image)
+        width, height = self.photo_size
+        draw.ellipse([width // 4, height // 6, 3 * width // 4, 2 * height // 3], fill=tuple(rng.randint(0, 255) for i in xrange(3)))
+        draw.text((10, height - 20), name, fill=(255, 255, 255))
+        data = StringIO()
+        image.save(data, 'jpeg', quality=85)
+        return data.getvalue()
+
+    def upload(self, person, data):
+        with self.lock:
+            person['photo_versions'] = person['photo_versions'] + 1
+            person['photo'] = person['photo_versions']
+            person['amended'] = datetime.date.today()
+            self.uploads[self.photo_name(person)] = data
+
+    def remove_photo(self, person):
+        with self.lock:
+            person['photo'] = None
+            person['amended'] = datetime.date.today()
+
+    def report(self, event_id=None, since=None, until=None):
+        """The "Export to Excel" report: one row per registration"""
+        parts = [u'<html><body><table border="1">\n<tr>']
+        parts.extend([u'<td><b>%s</b></td>' % c for c in columns])
+        parts.append(u'</tr>\n')
+        events = dict(self.events)
+        for id in sorted(self.people):
+            person = self.people[id]
+            if since is not None and person['amended'] < since:
+                continue
+            if until is not None and person['amended'] > until:
+                continue
+            for reg_event_id in sorted(person['events']):
+                if event_id and reg_event_id != event_id:
+                    continue
+                registration = person['events'][reg_event_id]
+                row = dict(person)
+                row.update(registration)
+                row['Profile Picture'] = self.photo_name(person) or ''
+                row['Event ID'] = reg_event_id
+                row['Event Name'] = events[reg_event_id]
+                row['Amendment Date'] = ef_date(person['amended'])
+                parts.append(u'<tr>')
+                parts.extend([u'<td>%s</td>' % escape(unicode(row[c])) for c in columns])
+                parts.append(u'</tr>\n')
+        parts.append(u'</table></body></html>\n')
+        return u''.join(parts).encode('utf-8')
+
+def page(title, body):
+    return ('<html><head><title>%s</title></head><body>%s</body></html>' % (title, body)).encode('utf-8')
+
+def hidden(fields):
+    return ''.join('<input type="hidden" name="%s" value="%s">' % (name, escape(unicode(value), True))
+                   for name, value in fields)
+
+logout_button = '<a id="ef_menu_button_logout" href="logout.csp">Logout</a>'
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'efserver/1.0'
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        options = self.server.options
+        self.method = method
+        url = urlparse.urlparse(self.path)
+        self.query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        self.form = {}
+        self.files = {}
+        if method == 'POST':
+            self.read_form()
+
+        if options.latency:
+            time.sleep(max(0, random.gauss(options.latency, options.latency * options.jitter)) / 1000.0)
+        if random.random() < options.failure_rate:
+            self.send_page(page('Service Unavailable', 'Try again later'), status=503)
+            return
+
+        path = url.path
+        if path.startswith(media):
+            self.photo(path[len(media):])
+            return
+        name = path.rsplit('/', 1)[-1]
+        if path.startswith(backend) and name == 'login.csp':
+            self.login()
+            return
+        handler = None
+        if path.startswith(backend):
+            handler = getattr(self, 'backend_' + name.replace('.csp', ''), None)
+        elif path.startswith(frontend):
+            handler = getattr(self, 'frontend_' + name.replace('.csp', ''), None)
+        if handler is None:
+            self.send_page(page('Not Found', 'No such page'), status=404)
+            return
+        if not self.has_session():
+            # As eventsforce does, show the login page rather than an error
+            self.login_page()
+            return
+        handler()
+
+    def read_form(self):
+        content_type = self.headers.get('Content-Type', '')
+        length = int(self.headers.get('Content-Length', 0))
+        if content_type.startswith('multipart/form-data'):
+            storage = FieldStorage(fp=self.rfile, headers=self.headers,
+                                   environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': content_type})
+            for key in storage.keys():
+                field = storage[key]
+                if field.filename:
+                    self.files[key] = field.value
+                else:
+                    self.form[key] = field.value.decode('utf-8')
+        else:
+            body = self.rfile.read(length)
+            self.form = dict((k, v.decode('utf-8')) for k, v in urlparse.parse_qsl(body, keep_blank_values=True))
+
+    def param(self, name, default=None):
+        return self.form.get(name, self.query.get(name, default))
+
+    def int_param(self, name):
+        try:
+            return int(self.param(name))
+        except (TypeError, ValueError):
+            return None
+
+    def send_page(self, body, status=200, headers={}, content_type='text/html; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.method == 'HEAD':
+            return
+        throughput = self.server.options.throughput
+        if not throughput:
+            self.wfile.write(body)
+            return
+        # Trickle it out, as a slow link would
+        chunk = 16384
+        for i in xrange(0, len(body), chunk):
+            self.wfile.write(body[i:i+chunk])
+            self.wfile.flush()
+            time.sleep(chunk / (throughput * 1024.0))
+
+    # Sessions
+
+    def has_session(self):
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        morsel = cookie.get('CSPSESSIONID')
+        return morsel is not None and morsel.value in self.server.sessions
+
+    def login_page(self, message=''):
+        self.send_page(page('Eventsforce Login',
+                            '%s<form method="post" action="login.csp">'
+                            '<input type="text" name="txtUsername" value="">'
+                            '<input type="password" name="txtPassword" value="">'
+                            '%s<input type="submit" name="btnLogin" value="Login"></form>' %
+                            (message, hidden([('CSPToken', 'x')]))))
+
+    def login(self):
+        if self.method != 'POST':
+            self.login_page()
+            return
+        options = self.server.options
+        username = self.form.get('txtUsername', '')
+        password = self.form.get('txtPassword', '')
+        if not username or (options.username is not None and username != options.username) or \
+                (options.password is not None and password != options.password):
+            self.login_page('<p>Invalid logon</p>')
+            return
+        session = os.urandom(12).encode('hex')
+        with self.server.lock:
+            self.server.sessions.add(session)
+        # The real thing goes through a javascript redirect too
+        self.send_page(page('Eventsforce', '<script>var redirectURL="home.csp"; window.location=redirectURL;</script>'),
+                       headers={'Set-Cookie': 'CSPSESSIONID=%s; path=/' % session})
+
+    def backend_home(self):
+        self.send_page(page('Eventsforce', '%s<p>Welcome</p>' % logout_button))
+
+    # Reports
+
+    def backend_dynaRepStart(self):
+        rows = ''.join('<tr><td>Report %d #export</td><td><a href="dynaRepRun.csp?profileID=%d">Run</a></td></tr>' % (profile, profile)
+                       for profile in criteria_profiles + [65])
+        self.send_page(page('Eventsforce', '%s<table>%s</table>' % (logout_button, rows)))
+
+    def backend_dynaRepRun(self):
+        profile = self.int_param('profileID')
+        if profile in criteria_profiles and self.method != 'POST':
+            self.report_form(profile)
+            return
+        run = {}
+        if profile in criteria_profiles:
+            run = {'event': self.int_param('value1_%d' % event_criterion),
+                   'since': parse_ef_date(self.param('value1_%d' % date_criterion, '')),
+                   'until': parse_ef_date(self.param('value2_%d' % date_criterion, '')),
+                   }
+        with self.server.lock:
+            run_id = len(self.server.runs) + 1
+            self.server.runs[run_id] = run
+        self.send_page(page('Eventsforce', '%s<p>Report results</p>'
+                            '<a href="dynaRepExport.csp?runID=%d"><img title="Export to Excel" src="/libdems/backend/excel.gif"></a>' %
+                            (logout_button, run_id)))
+
+    def report_form(self, profile):
+        events = ''.join('<option value="%d">%s</option>' % (id, escape(name)) for id, name in self.server.dataset.events)
+        self.send_page(page('Eventsforce', '%s<form method="post" action="dynaRepRun.csp?profileID=%d">'
+                            '%s<select name="value1_%d"><option value="0" selected>All events</option>%s</select>'
+                            '<input type="text" name="value1_%d" value=""><input type="text" name="value2_%d" value="">'
+                            '<input type="submit" name="btnRun" value="Run"></form>' %
+                            (logout_button, profile,
+                             hidden([('criteriaDescription_%d' % event_criterion, 'In Event'),
+                                     ('criteriaDescription_%d' % date_criterion, 'Amendment Date')]),
+                             event_criterion, events, date_criterion, date_criterion)))
+
+    def backend_dynaRepExport(self):
+        run = self.server.runs.get(self.int_param('runID'))
+        if run is None:
+            self.send_page(page('Not Found', 'No such report'), status=404)
+            return
+        self.send_page(self.server.dataset.report(run.get('event'), run.get('since'), run.get('until')),
+                       content_type='application/vnd.ms-excel; charset=utf-8')
+
+    # Person pages
+
+    def person(self):
+        person = self.server.dataset.people.get(self.int_param('personID'))
+        if person is None:
+            self.send_page(page('Eventsforce', '%s<p>No such person</p>' % logout_button))
+        return person
+
+    def backend_codEditMain(self):
+        person = self.person()
+        if person is None:
+            return
+        dataset = self.server.dataset
+        parts = [logout_button, '<h1>%s</h1>' % escape(person['Full Name'])]
+        photo = dataset.photo_name(person)
+        if photo is not None:
+            parts.append('<img title="Picture Profile" src="%s%s">' % (media, photo))
+        events = dict(dataset.events)
+        for event_id in sorted(person['events']):
+            parts.append('<a href="../../frontend/reg/initSession.csp?personID=%d&amp;eventID=%d">%s</a>' %
+                         (person['Person ID'], event_id, escape(events[event_id])))
+        event_id = self.int_param('eventID')
+        if event_id in person['events']:
+            ticked = person['events'][event_id]['Type of Attendee']
+            parts.append('<table>')
+            for category in categories:
+                parts.append('<tr><td>%s</td><td><img src="/libdems/backend/%s.gif"></td></tr>' %
+                             (category, 'tick' if category == ticked else 'cross'))
+            parts.append('</table>')
+        self.send_page(page('Eventsforce', ''.join(parts)))
+
+    # The registration pages that UploadTask goes through:
+    #   initSession: the booking, with an Edit button
+    #   regPage 1: a page of questions
+    #   regPage 2: photo upload, with remove and Upload buttons;
+    #     Upload leads to a page with the file field, and posting the
+    #     file to a javascript redirect to regPage 3
+    #   regPage 3: upload result, with an OK button
+    #   regPage 4: the new photo, and more questions
+    #   regPage 5: the button to save the booking (regReceipt)
+    #   regReceipt, regConfirm: CONFIRM link, then thanks
+
+    def reg_link(self, person, **params):
+        params.setdefault('personID', person['Person ID'])
+        params.setdefault('eventID', self.int_param('eventID') or 0)
+        return 'regPage.csp?' + '&amp;'.join('%s=%s' % (k, v) for k, v in sorted(params.iteritems()))
+
+    def reg_form(self, person, page_number, body, enctype=''):
+        return ('<form method="post" action="regPage.csp"%s>%s%s<input type="submit" name="btnNext" value="Next"></form>' %
+                (enctype, hidden([('personID', person['Person ID']), ('eventID', self.int_param('eventID') or 0),
+                                  ('page', page_number)]), body))
+
+    def frontend_initSession(self):
+        person = self.person()
+        if person is None:
+            return
+        self.send_page(page('Booking', '<p>Booking for %s</p>'
+                            '<input type="button" value="Edit" onclick="document.location=\'%s\';">' %
+                            (escape(person['Full Name']), self.reg_link(person, page=1))))
+
+    def frontend_regPage(self):
+        person = self.person()
+        if person is None:
+            return
+        number = self.int_param('page') or 1
+        if number == 1:
+            body = self.reg_form(person, 2, '<select name="selDiet"><option value="1" selected>None</option><option value="2">Vegetarian</option></select>')
+        elif number == 2:
+            body = self.photo_upload_page(person)
+        elif number == 3:
+            body = '<p>File uploaded</p><input type="button" value="OK" onclick="document.location=\'%s\';">' % self.reg_link(person, page=4)
+        elif number == 4:
+            photo = self.server.dataset.photo_name(person)
+            link = '<a href="%s%s">Your photo</a>' % (media, photo) if photo is not None else ''
+            body = link + self.reg_form(person, 5, '<input type="radio" name="radQuestion_111_1" value="Green Pack">'
+                                                   '<input type="radio" name="radQuestion_111_1" value="Blue Pack">')
+        else:
+            body = ('<input type="button" value="SAVE" onclick="document.location=\'regReceipt.csp?personID=%d&amp;gotoReceipt=1\';">' %
+                    person['Person ID'])
+        self.send_page(page('Registration', body))
+
+    def photo_upload_page(self, person):
+        dataset = self.server.dataset
+        temp_person_id = 900000 + person['Person ID'] % 100000
+        if self.param('deleteFile'):
+            dataset.remove_photo(person)
+        if self.files.get('FileStream') is not None:
+            data = self.files['FileStream']
+            try:
+                Image.open(StringIO(data)).verify()
+            except Exception:
+                return "<script>window.location='regPage.csp?page=2&error=File could not be saved';</script>"
+            dataset.upload(person, data)
+            return "<script>window.location='%s';</script>" % self.reg_link(person, page=3, uploadSuccess=1).replace('&amp;', '&')
+        fields = ''.join('<input type="hidden" name="%s" value="">' % name
+                         for name in ['deleteFile', 'uploadFile', 'uploadTempPersonID', 'uploadItemNameID',
+                                      'uploadGuestNumber', 'uploadDataID'])
+        if self.param('uploadFile') == '1':
+            return '<h2>Photo Upload</h2>' + self.reg_form(person, 2, '<input type="file" name="FileStream">',
+                                                           enctype=' enctype="multipart/form-data"')
+        remove = ''
+        if person['photo'] is not None:
+            remove = '<a href="javascript: removeFile(%d, 55)">remove</a>' % temp_person_id
+        return ('<h2>Photo Upload</h2>%s<input type="button" value="Upload" onclick="SaveAndUpload(%d, 77, 0)">%s' %
+                (remove, temp_person_id, self.reg_form(person, 2, fields)))
+
+    def frontend_regReceipt(self):
+        self.send_page(page('Registration', '<a href="regConfirm.csp?personID=%s">CONFIRM</a>' % escape(self.param('personID', ''))))
+
+    def frontend_regConfirm(self):
+        self.send_page(page('Registration', '<p>Thank you for your registration</p>'))
+
+    # Photos
+
+    def photo(self, name):
+        photo = self.server.dataset.photo(name)
+        if photo is None:
+            self.send_page(page('Not Found', 'No such file'), status=404)
+            return
+        data, etag = photo
+        last_modified = formatdate(self.server.dataset.started, usegmt=True)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_page(data, content_type='image/jpeg', headers={'ETag': etag, 'Last-Modified': last_modified})
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        HTTPServer.__init__(self, address, Handler)
+        self.options = options
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.runs = {}
+        self.dataset = Dataset(options.people, options.events, options.photo_rate, options.seed,
+                               tuple(int(n) for n in options.photo_size.split('x')))
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic eventsforce for testing')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--people', type=int, default=2000, help='how many people (default 2000)')
+    parser.add_argument('--events', type=int, default=3, help='how many events, numbered from 101 (default 3)')
+    parser.add_argument('--photo-rate', type=float, default=0.8, help='fraction of people with a photo (default 0.8)')
+    parser.add_argument('--photo-size', default='300x400', help='photo dimensions (default 300x400)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0, help='mean milliseconds before each response (default 0)')
+    parser.add_argument('--jitter', type=float, default=0.5, help='standard deviation of the latency, as a fraction of it (default 0.5)')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of requests answered with a 503 (default 0)')
+    parser.add_argument('--throughput', type=float, default=0, help='KB/s to send response bodies at (default unlimited)')
+    parser.add_argument('--username', help='only accept this username (default: any)')
+    parser.add_argument('--password', help='only accept this password (default: any)')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    options = parser.parse_args()
+
+    server = Server((options.bind, options.port), options)
+    print 'Serving %d people on http://%s:%d/ (EF_BASE_URL=http://%s:%d)' % (options.people, options.bind, options.port, options.bind, options.port)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
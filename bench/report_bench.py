@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+"""Compare the cost of reading an "Export to Excel" report with the old
+HTMLParser-based EFParser and with the current streaming one, and
+check that both see the same people and registrations.
+
+By default this generates a synthetic report in the same shape as the
+one the fetcher downloads:
+
+    python bench/report_bench.py [rows]
+
+or give it a report saved from eventsforce:
+
+    python bench/report_bench.py --file report.xls
+
+Times are process CPU time, the best of a few runs each, since wall
+clock time on a busy (or single core) machine varies by more than the
+difference being measured.
+"""
+
+from HTMLParser import HTMLParser
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ef.parser import EFDelegateParser, person_fields, event_fields
+
+columns = ['Person ID', 'Salutation', 'Firstname', 'common first name', 'Lastname', 'Full Name',
+           'username', 'Profile Picture', 'Membership No', 'Voting Rights', 'EF_Application Status',
+           'Local Party', 'Local Party (Other)', 'Event ID', 'Event Name',
+           'Booking Ref', 'Bookers Firstname', 'Bookers lastname', 'Type of Attendee', 'Amendment Date']
+
+def synthetic_report(rows):
+    rng = random.Random(1)
+    parts = ['<html><body><table border="1">\n<tr>']
+    parts.extend(['<td><b>%s</b></td>' % c for c in columns])
+    parts.append('</tr>\n')
+    person_id = 100000
+    for i in xrange(rows):
+        if rng.random() < 0.7:
+            person_id = person_id + 1
+        event_id = rng.choice([101, 102, 103])
+        first = rng.choice(['Alice', 'Bob', 'Carol', 'Dave', 'Eve', u'Zo\xeb'])
+        last = rng.choice(['Smith', 'Jones', 'Brown', "O'Neill", 'Taylor'])
+        values = [person_id, 'Ms', first, '', last, '%s %s' % (first, last),
+                  'user%d' % person_id, '/libdems/media/photo%d.jpg' % person_id, 'M%07d' % person_id,
+                  rng.choice(['Yes', 'No']), rng.choice(['Approved', 'Pending', '']),
+                  rng.choice(['Camden', 'Islington', '']), '', event_id, 'Conference %d' % event_id,
+                  'REF%06d' % i, first, last, rng.choice(['Member', 'Exhibitor', 'Press']), '01-Jan-2014']
+        parts.append('<tr>')
+        parts.extend(['<td>%s</td>' % v for v in values])
+        parts.append('</tr>\n')
+    parts.append('</table></body></html>\n')
+    return u''.join([unicode(p) for p in parts])
+
+class OldEFParser(HTMLParser):
+    """EFParser as it was before it was rewritten on lxml, for comparison"""
+    current_target = None
+    current_inserter = None
+    keys = None
+    pos = None
+    records = 0
+    current_string = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            if self.keys is None:
+                self.keys = []
+            else:
+                self.current_target = {}
+                self.pos = 0
+                self.records = self.records + 1
+        elif tag == 'td':
+            if self.current_target is None:
+                self.current_inserter = lambda data: self.keys.append(data)
+            else:
+                i = self.pos
+                self.pos = self.pos + 1
+                def inserter(data):
+                    if i >= len(self.keys):
+                        raise ValueError('corrupted data in record %d' % self.records)
+                    self.current_target[self.keys[i]] = data
+                self.current_inserter = inserter
+            self.current_string = ''
+
+    def handle_endtag(self, tag):
+        if tag == 'tr':
+            if self.current_target is not None:
+                self.handle_record(self.current_target)
+            self.current_target = None
+        elif tag == 'td':
+            if self.current_inserter is not None:
+                self.current_inserter(self.current_string.strip())
+                self.current_inserter = None
+
+    def handle_data(self, data):
+        if self.current_string is not None:
+            self.current_string = self.current_string + ' ' + data.strip()
+
+class OldDelegateParser(OldEFParser):
+    def __init__(self):
+        OldEFParser.__init__(self)
+        self.people = {}
+        self.events_map = {}
+        self.registrations = {}
+
+    def handle_record(self, record):
+        try:
+            if record['Person ID'] == '':
+                return
+            person_id = record['Person ID'] = int(record['Person ID'])
+        except (KeyError, ValueError):
+            return
+        person = self.people.setdefault(person_id, {'events': {}})
+        for key in person_fields:
+            if key in record:
+                value = record.pop(key)
+                if 0 == len(unicode(person.get(key, ''))):
+                    person[key] = value
+        for key in list(record.keys()):
+            if re.match(r'^Local Party', key):
+                if record[key].strip() != '':
+                    person['Local Party'] = record[key]
+                del record[key]
+        try:
+            event_id = int(record.pop('Event ID'))
+        except ValueError:
+            return
+        self.events_map.setdefault(event_id, record.pop('Event Name'))
+        event = person['events'].setdefault(event_id, {})
+        for key in event_fields:
+            if record.has_key(key) and 0 == len(unicode(event.get(key, ''))):
+                event[key] = record[key]
+        self.registrations.setdefault(person_id, []).append(event_id)
+
+class NewDelegateParser(EFDelegateParser):
+    def __init__(self):
+        EFDelegateParser.__init__(self, streaming=True)
+        self.seen_people = {}
+
+    def handle_person(self, person):
+        self.seen_people[person['Person ID']] = person
+
+def registrations(parser):
+    return dict((person_id, sorted(set(events))) for person_id, events in parser.registrations.iteritems())
+
+# Runs of each parser to take the best of
+repeat = 3
+
+def run(parser_class, data, chunk=16384):
+    parser = parser_class()
+    start = time.clock()
+    for i in xrange(0, len(data), chunk):
+        parser.feed(data[i:i+chunk])
+    parser.close()
+    return time.clock() - start, parser
+
+def best(parser_class, data):
+    # Nothing is kept from one run to the next, so that no run pays
+    # for garbage collecting another's people
+    best_time = None
+    for i in xrange(repeat):
+        elapsed, parser = run(parser_class, data)
+        records = parser.records
+        del parser
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return best_time, records
+
+def main(args):
+    if len(args) >= 2 and args[0] == '--file':
+        data = open(args[1], 'rb').read().decode('utf-8', 'replace')
+    else:
+        rows = int(args[0]) if args else 100000
+        data = synthetic_report(rows)
+    print 'report: %d bytes' % len(data)
+
+    old_time, records = best(OldDelegateParser, data)
+    print '  HTMLParser %8.2fs  %8.0f rows/s' % (old_time, records / old_time)
+    new_time, records = best(NewDelegateParser, data)
+    print '  lxml       %8.2fs  %8.0f rows/s  %5.1fx' % (new_time, records / new_time, old_time / new_time)
+
+    # The old parser split cell text wherever a network chunk boundary
+    # fell, so compare against it reading the whole report in one go
+    old_time, old = run(OldDelegateParser, data, chunk=len(data))
+    new_time, new = run(NewDelegateParser, data)
+    new_registrations = dict((person_id, sorted(person['events'].keys())) for person_id, person in new.seen_people.iteritems())
+    same = (old.people == new.seen_people and old.events_map == new.events_map and registrations(old) == new_registrations)
+    print '  %d people, %d events: %s' % (len(new.seen_people), len(new.events_map), 'same' if same else 'DIFFERENT')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+"""Compare the cost of scraping saved eventsforce pages with
+BeautifulSoup (the way the fetch/login code used to) and with
+ef.scrape, and check that both give the same answers.
+
+Save some pages from a browser (a person page from codEditMain.csp,
+a person's event page, a report results page, the login page, a
+registration form page) and run:
+
+    python bench/scrape_bench.py page1.html page2.html ...
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bs4 import BeautifulSoup, SoupStrainer
+from ef import scrape
+from ef.nettask import soup_form_fields
+
+def soup_profile_picture(data):
+    soup = BeautifulSoup(data, 'lxml', parse_only=SoupStrainer(['img']))
+    img = soup.find('img', title='Picture Profile')
+    return img['src'] if img is not None else None
+
+def soup_ticked_category(data):
+    soup = BeautifulSoup(data, 'lxml', parse_only=SoupStrainer(['tr', 'td', 'img']))
+    img = soup.find('img', src=re.compile(r'.*/backend/tick.gif$'))
+    if img is None:
+        return None
+    category_td = img.find_parent('td').find_previous_sibling('td')
+    return category_td.string
+
+def soup_export_link(data):
+    soup = BeautifulSoup(data, 'lxml')
+    img = soup.find('img', title='Export to Excel')
+    return img.parent['href'] if img is not None else None
+
+def soup_window_location(data):
+    soup = BeautifulSoup(data, 'lxml')
+    for script in soup.find_all('script'):
+        m = re.match(r'^\s*window\.location=\'(.*)\';', script.text)
+        if m:
+            return m.group(1)
+    return None
+
+def soup_form(data):
+    soup = BeautifulSoup(data, 'lxml')
+    if soup.form is None:
+        return None
+    action, fields, seen, scripts = soup_form_fields(soup.form)
+    return action, fields, seen
+
+def lxml_form(data):
+    form = scrape.first_form(scrape.parse(data))
+    if form is None:
+        return None
+    action, fields, seen, scripts = scrape.form_fields(form)
+    return action, fields, seen
+
+extractors = [
+    ('profile picture', soup_profile_picture, lambda data: scrape.profile_picture(scrape.parse(data))),
+    ('ticked category', soup_ticked_category, lambda data: scrape.ticked_category(scrape.parse(data))),
+    ('export link', soup_export_link, lambda data: scrape.export_link(scrape.parse(data))),
+    ('window.location', soup_window_location, lambda data: scrape.window_location(scrape.parse(data))),
+    ('form fields', soup_form, lxml_form),
+    ]
+
+def bench(f, data, number):
+    return min(timeit.repeat(lambda: f(data), number=number, repeat=3)) / number
+
+def main(filenames, number=20):
+    for filename in filenames:
+        data = open(filename, 'rb').read().decode('utf-8', 'replace')
+        print '%s (%d bytes)' % (filename, len(data))
+        for name, soup_f, lxml_f in extractors:
+            soup_result = soup_f(data)
+            lxml_result = lxml_f(data)
+            same = 'same' if soup_result == lxml_result else 'DIFFERENT: %r vs %r' % (soup_result, lxml_result)
+            soup_time = bench(soup_f, data, number)
+            lxml_time = bench(lxml_f, data, number)
+            print '  %-16s bs4 %8.2fms  lxml %8.2fms  %5.1fx  %s' % (name, soup_time * 1000, lxml_time * 1000, soup_time / lxml_time, same)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print >>sys.stderr, __doc__
+        sys.exit(1)
+    main(sys.argv[1:])
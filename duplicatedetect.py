@@ -9,6 +9,7 @@ from datetime import datetime
 
 from ef.ui.duplicatedetect import Ui_DuplicateDetect
 from ef.netlib import start_network_manager, stop_network_manager
+from ef.scheduler import scheduler
 
 class DuplicateDetect(QtGui.QMainWindow, Ui_DuplicateDetect):
     def __init__(self, parent=None):
@@ -48,7 +49,7 @@ class DuplicateDetect(QtGui.QMainWindow, Ui_DuplicateDetect):
         self.scanner.task_exception.connect(self.handle_exception)
         self.scanner.progress.connect(self.handle_progress)
 
-        self.scanner.start_task()
+        scheduler.submit(self.scanner, 'bulk')
 
     def task_ended(self):
         self.start.setEnabled(True)
@@ -22,7 +22,12 @@ from ef.fetch import Fetcher
 from ef.fetchreports import ReportsFetcher
 from ef.fetchwizard import FetchWizard
 from ef.upload import Uploader
-from ef.netlib import start_network_manager
+from ef.netlib import start_network_thread, ef_url
+from ef.nettask import start_parse_pool
+from ef.trace import start_tracing, stop_tracing
+from ef.netrecord import start_session_archive, stop_session_archive
+from ef.netstats import NetStatsDialog
+from ef.threads import thread_registry
 from ef.filtercontrol import FilterProxyModel
 from ef.trylogin import TryLogin
 from collections import deque
@@ -441,6 +446,11 @@ class ImageEdit(QtGui.QMainWindow, Ui_ImageEdit):
         self.action_openeventsforce.triggered.connect(self.handle_openeventsforce)
         self.openeventsforce.clicked.connect(self.handle_openeventsforce)
         self.action_reloadphoto.triggered.connect(self.handle_reloadphoto)
+        self.action_verifyphotos.triggered.connect(self.handle_verifyphotos)
+        self.action_reingest.triggered.connect(self.handle_reingest)
+        self.action_abort.triggered.connect(self.handle_abort)
+        self.action_netstats.triggered.connect(self.handle_netstats)
+        self.netstats = NetStatsDialog(self)
         self.action_editimage.triggered.connect(self.handle_editimage)
         self.editimage.clicked.connect(self.handle_editimage)
         self.action_importphoto.triggered.connect(self.handle_import_photo)
@@ -729,6 +739,10 @@ class ImageEdit(QtGui.QMainWindow, Ui_ImageEdit):
         if self.current_person is not None:
             self.load_person(self.current_person.id, refresh=True)        
 
+    def handle_verifyphotos(self):
+        count = self.photodownloader.verify_photos(Photo.all())
+        self.status.setText('Verifying %d cached photos' % count)
+
     """Select this id in person_list"""
     def select_person(self, id):
         index = self.image_list_items[id].index()
@@ -912,8 +926,10 @@ class ImageEdit(QtGui.QMainWindow, Ui_ImageEdit):
 
     def set_ef_ops_enabled(self, enabled):
         self.action_fetch.setEnabled(enabled)
+        self.action_reingest.setEnabled(enabled)
         self.action_upload.setEnabled(enabled)
         self.fetch_this_person.setEnabled(enabled)
+        self.action_abort.setEnabled(not enabled)
 
     def handle_fetch_wizard(self):
         self.fetch_wizard = FetchWizard(self.username, self.password)
@@ -924,6 +940,18 @@ class ImageEdit(QtGui.QMainWindow, Ui_ImageEdit):
         self.fetch_wizard.show()
         self.set_ef_ops_enabled(False)
 
+    def handle_reingest(self):
+        self.fetcher.start_reingest()
+        self.set_ef_ops_enabled(False)
+
+    def handle_abort(self):
+        # Whichever is running reports back through its error signal
+        self.fetcher.abort()
+        self.uploader.abort()
+
+    def handle_netstats(self):
+        self.netstats.show()
+
     def handle_fetch_person(self):
         if self.loading_now:
             return
@@ -1049,7 +1077,7 @@ class ImageEdit(QtGui.QMainWindow, Ui_ImageEdit):
 
     def handle_openeventsforce(self):
         if self.current_person is not None:
-            QtGui.QDesktopServices.openUrl(QtCore.QUrl('https://www.eventsforce.net/libdems/backend/home/codEditMain.csp?codReadOnly=1&personID=%d&curPage=1' % self.current_person.id))
+            QtGui.QDesktopServices.openUrl(QtCore.QUrl(ef_url('/libdems/backend/home/codEditMain.csp?codReadOnly=1&personID=%d&curPage=1' % self.current_person.id)))
 
     def handle_chooseeditor(self):
         if self.chooseeditor.exec_():
@@ -1217,7 +1245,10 @@ def setup():
         dir.mkpath(datadir)
     sys.stderr = open(os.path.join(unicode(datadir), 'ef-image-editor.log'), 'a')
     dbmanager = setup_session(unicode(datadir))
-    start_network_manager()
+    start_tracing(unicode(datadir))
+    start_session_archive()
+    start_network_thread(unicode(datadir))
+    start_parse_pool()
     return dbmanager
 
 if __name__ == "__main__":
@@ -1237,4 +1268,8 @@ if __name__ == "__main__":
         print >>sys.stderr, message
         QtGui.QMessageBox.information(self, "Unhandled exception", message)
     finally:
+        thread_registry.shutdown(0)
+        thread_registry.wait_all()
+        stop_tracing()
+        stop_session_archive()
         dbmanager.shutdown()
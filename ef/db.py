@@ -7,10 +7,12 @@ import sys
 import multiprocessing
 import Queue
 import errno
+import threading
 from PyQt4 import QtCore
 from ef.task import Finishable
 from ef.lib import LRUCache, SignalGroup
-from ef.dbworker import start_dbworker
+from ef.dbworker import start_dbworker, op_weight
+from ef.spool import setup_spool, spool_path
 from multiprocessing.queues import Queue as MPQueue
 
 photodir = None
@@ -48,6 +50,15 @@ class DBDataManager(object):
         obj._do_update(values, origin, suppress_updates)
         return obj
 
+    def bulk_update(self, table, ids, values, origin):
+        # Applied quietly: nothing wants thousands of updated signals
+        # for a bookkeeping field
+        key_field = self.classes[table]['key'][0]
+        for id in ids:
+            obj = self.objects.get(self.object_key(table, {key_field: id}))
+            if obj is not None:
+                obj._do_update(values, origin, True)
+
     def register_class(self, dbclass, name):
         rec = {'name': name,
                'table': dbclass.__tablename__,
@@ -145,6 +156,42 @@ class DBBase(QtCore.QObject):
         values.update(kwargs)
         dbdata.dbmanager.upsert(self.__tablename__, values, origin, self.batch_op(batch))
 
+    def changed_values(self, values):
+        """The subset of values which differ from what we have"""
+        changed = {}
+        for k, v in values.iteritems():
+            if k in self.__key__:
+                continue
+            if self.__values__.get(k) != v:
+                changed[k] = v
+        return changed
+
+    @classmethod
+    def upsert_changed(self, values, origin='', batch=None):
+        """Like upsert, but only writes the fields which have changed
+        (or everything, for an object we haven't seen). Returns whether
+        anything was written."""
+        key = dict([(k, values[k]) for k in self.__key__])
+        try:
+            obj = dbdata.get(self, key)
+        except KeyError:
+            self.upsert(values, origin, batch)
+            return True
+        changed = obj.changed_values(values)
+        if not changed:
+            return False
+        obj.update(changed, origin, batch)
+        return True
+
+    # Sets the same values on many objects in one statement. Only for
+    # tables with a single key field; ids are values of that field
+    @classmethod
+    def bulk_update(self, ids, values, origin='', batch=None):
+        for k in values:
+            if k not in self.__fields__ or k in self.__key__:
+                raise KeyError("Invalid key %s in values" % k)
+        dbdata.dbmanager.bulk_update(self.__tablename__, list(ids), values, origin, self.batch_op(batch))
+
     @classmethod
     def signal_existing_created(self):
         dbdata.dbmanager.signal_existing_created(self.__tablename__)
@@ -178,6 +225,15 @@ class DBManager(QtCore.QObject):
     exception = QtCore.pyqtSignal(Exception, str)
     existing_done = QtCore.pyqtSignal(str)
     process_done = QtCore.pyqtSignal(str, str)
+    # Flow control: throttled when the backlog of work sent to the
+    # worker passes backlog_high, drained when it gets back down to
+    # backlog_low. Anything that can produce writes faster than the
+    # worker can keep up with should stop when throttled.
+    throttled = QtCore.pyqtSignal()
+    drained = QtCore.pyqtSignal()
+
+    backlog_high = 5000
+    backlog_low = 1000
 
     def __init__(self, datadir):
         super(QtCore.QObject, self).__init__()
@@ -193,7 +249,13 @@ class DBManager(QtCore.QObject):
         self.timer.start()
 
         self.pending_op_count = 0
+        self.posted_count = 0
+        self.received_count = 0
+        self.is_throttled = False
+        # post() is called from other threads
+        self.post_lock = threading.Lock()
         self.batches = weakref.WeakValueDictionary()
+        self.ingests = weakref.WeakValueDictionary()
         self.is_shutdown = False
 
         self.is_importing = False
@@ -216,9 +278,33 @@ class DBManager(QtCore.QObject):
     def register_batch(self, id, batch):
         self.batches[id] = batch
 
+    def register_ingest(self, id, ingest):
+        self.ingests[id] = ingest
+
     def post(self, op, args):
         #print 'manager posting', op, args
+        with self.post_lock:
+            self.posted_count = self.posted_count + op_weight(op, args)
         self.write_queue.put((op, args))
+        self.check_backlog()
+
+    def backlog(self):
+        """Ops sent to the worker which it hasn't yet taken, plus writes
+        it has queued up but not yet done"""
+        return self.posted_count - self.received_count + self.pending_op_count
+
+    def check_backlog(self):
+        with self.post_lock:
+            backlog = self.backlog()
+            if not self.is_throttled and backlog >= self.backlog_high:
+                self.is_throttled = True
+                signal = self.throttled
+            elif self.is_throttled and backlog <= self.backlog_low:
+                self.is_throttled = False
+                signal = self.drained
+            else:
+                return
+        signal.emit()
 
     def poll(self):
         if self.is_shutdown:
@@ -241,9 +327,10 @@ class DBManager(QtCore.QObject):
                     id, count = result
                     batch = self.batches.get(id, None)
                     if batch is not None:
-                        batch.committed(count)
+                        batch.sig_committed.emit(count)
                 elif op == 'pending':
-                    self.pending_op_count = result
+                    self.received_count, self.pending_op_count = result
+                    self.check_backlog()
                 elif op == 'fetch' or op == 'insert':
                     obj = dbdata.create(result['table'], result['key'], result['values'])
                     if self.is_importing:
@@ -252,6 +339,21 @@ class DBManager(QtCore.QObject):
                         self.created.emit(obj, result.get('origin', set(['fetch'])))
                 elif op == 'fetch_all':
                     self.existing_done.emit(result)
+                elif op == 'bulk_update':
+                    dbdata.bulk_update(result['table'], result['ids'], result['values'], result['origin'])
+                elif op == 'ingest_done':
+                    id, summary = result
+                    self.apply_ingest(summary)
+                    ingest = self.ingests.get(id, None)
+                    if ingest is not None:
+                        ingest.sig_done.emit(summary)
+                elif op == 'ingest_failed':
+                    id, (e, msg) = result
+                    ingest = self.ingests.get(id, None)
+                    if ingest is not None:
+                        ingest.sig_failed.emit(e, msg)
+                    else:
+                        self.exception.emit(e, msg)
                 elif op == 'update':
                     obj = dbdata.update(result['table'], result['key'], result['values'], result['origin'], suppress_updates=self.is_importing)
                     if self.is_importing:
@@ -274,6 +376,16 @@ class DBManager(QtCore.QObject):
         except Exception, e:
             self.exception.emit(e, traceback.format_exc())
 
+    def apply_ingest(self, summary):
+        origin = set(['ingest'])
+        for op, table, key, values in summary['changes']:
+            if op == 'insert':
+                obj = dbdata.create(table, key, values)
+                self.created.emit(obj, origin)
+            else:
+                dbdata.update(table, key, values, origin)
+        dbdata.bulk_update('person', summary['checked'], {'last_checked_at': summary['checked_at']}, origin)
+
     def pending(self):
         return self.pending_op_count
 
@@ -283,6 +395,9 @@ class DBManager(QtCore.QObject):
     def upsert(self, table, values, origin, batchid):
         self.post('upsert', (table, values, origin, batchid))
 
+    def bulk_update(self, table, ids, values, origin, batchid):
+        self.post('bulk_update', (table, ids, values, origin, batchid))
+
     def signal_existing_created(self, table):
         self.post('fetch_all', table)
 
@@ -296,6 +411,9 @@ class DBManager(QtCore.QObject):
 class Batch(QtCore.QObject, Finishable):
     finished = QtCore.pyqtSignal()
     progress = QtCore.pyqtSignal(int, int)
+    # Commits are reported through this, so that they get handled in
+    # the batch's own thread rather than the one polling the dbworker
+    sig_committed = QtCore.pyqtSignal(int)
 
     def __init__(self, parent=None):
         QtCore.QObject.__init__(self)
@@ -309,6 +427,8 @@ class Batch(QtCore.QObject, Finishable):
         self.ops_committed = 0
         self.finish_called = False
 
+        self.sig_committed.connect(self.committed)
+
         self.parent = parent
         if parent is not None:
             parent.register_child(self)
@@ -344,6 +464,58 @@ class Batch(QtCore.QObject, Finishable):
         if self.finish_called and self.ops_started == self.ops_committed and len(self.children) == len(self.finished_children):
             self.finished.emit()
 
+class Ingest(QtCore.QObject, Finishable):
+    """Hands a report over to the db worker, which parses it and writes
+    it all in one transaction. Feed it the report as it downloads and
+    call finish(); once finished, result() is a summary of what was
+    in the report and what changed.
+
+    spool is where the report is being spooled (see ef.spool), and
+    previous is the last spooled run of the same report, for skipping
+    people who haven't changed. With reingest, the report is read back
+    from spool instead, and there's no need to feed or finish."""
+    finished = QtCore.pyqtSignal()
+    failed = QtCore.pyqtSignal(Exception, str)
+    # As for Batch, so that results are handled in our own thread
+    sig_done = QtCore.pyqtSignal(object)
+    sig_failed = QtCore.pyqtSignal(Exception, str)
+
+    def __init__(self, spool=None, previous=None, reingest=False, encoding=None):
+        QtCore.QObject.__init__(self)
+        Finishable.__init__(self, self.finished, self.failed)
+
+        self.summary = None
+        self.sig_done.connect(self.done)
+        self.sig_failed.connect(self.failed)
+
+        dbdata.dbmanager.register_ingest(id(self), self)
+        if reingest:
+            dbdata.dbmanager.post('ingest_file', (id(self), {'spool': spool,
+                                                             'file': spool_path(spool, 'html.gz'),
+                                                             'encoding': encoding,
+                                                             }))
+        else:
+            dbdata.dbmanager.post('ingest_start', (id(self), {'spool': spool,
+                                                              'previous': previous,
+                                                              }))
+
+    def feed(self, data):
+        dbdata.dbmanager.post('ingest_chunk', (id(self), data))
+
+    def finish(self):
+        dbdata.dbmanager.post('ingest_end', id(self))
+
+    def abort(self):
+        """Throw away whatever has been ingested so far"""
+        dbdata.dbmanager.post('ingest_abort', id(self))
+
+    def done(self, summary):
+        self.summary = summary
+        self.finished.emit()
+
+    def result(self):
+        return self.summary
+
 def conv_bool(v):
     return v.toBool()
 
@@ -390,6 +562,9 @@ class Photo(DBBase):
                   'opinion' : conv_str,
                   'block_upload' : conv_bool,
                   'load_failed' : conv_bool,
+                  'etag' : conv_str,
+                  'last_modified' : conv_str,
+                  'content_length' : conv_int,
                   }
 
     by_person_dict = {}
@@ -419,6 +594,12 @@ class Photo(DBBase):
         if filename:
             return os.path.join(photodir, filename)
 
+    def validators(self):
+        return {'etag': self.etag,
+                'last_modified': self.last_modified,
+                'content_length': self.content_length,
+                }
+
     def update_crop(self, centre_x, centre_y, scale, origin=''):
         self.update({'id': self.id,
                      'crop_centre_x': centre_x,
@@ -676,6 +857,7 @@ def setup_session(datadir):
     photodir = os.path.join(datadir, 'photos')
     if not os.path.exists(photodir):
         os.mkdir(photodir)
+    setup_spool(datadir)
 
     dbmanager = DBManager(datadir)
     dbdata.dbmanager = dbmanager
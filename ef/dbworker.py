@@ -3,6 +3,7 @@ import time
 import sys
 import os
 import shutil
+import tempfile
 import traceback
 import yaml
 from collections import deque, OrderedDict
@@ -10,6 +11,8 @@ from sqlalchemy.engine import reflection
 from sqlalchemy.sql import select, update, insert
 import Queue
 from yaml import CLoader as Loader, CDumper as Dumper
+from ef.parser import EFDelegateParser, person_record, registration_record
+from ef.spool import read_chunks, decode_chunks, group_digest, load_digests, save_digests, mark_ingested
 
 class DBImportError(Exception):
     def __init__(self, msg):
@@ -17,6 +20,111 @@ class DBImportError(Exception):
     def __str__(self):
         return self.msg
 
+bulk_chunk_size = 500
+
+# When more than this many writes are queued up, spend longer writing
+# them out each time round
+drain_threshold = 1000
+
+def op_weight(op, args):
+    """Rough cost of a message to the worker, in ops. The manager adds
+    up what it sends and we add up what we've taken, so it knows how
+    far behind we are (see DBManager.backlog)."""
+    if op == 'ingest_chunk':
+        return 1 + len(args[1]) / 4096
+    return 1
+
+class ReportIngest(EFDelegateParser):
+    """Parses a report inside the worker, writing it straight to the
+    database and keeping a note of what actually changed.
+
+    Given the digests of each person's rows from the previous run of
+    the same report, people whose rows are exactly the same as last
+    time are skipped without being looked at any further."""
+
+    def __init__(self, worker, previous=(None, None)):
+        EFDelegateParser.__init__(self, streaming=True)
+        self.worker = worker
+        self.changes = []
+        self.checked = []
+        self.photos = {}
+        self.registration_count = 0
+        self.previous_keys, self.previous = previous
+        self.digests = []
+        self.group = []
+        self.group_id = None
+        self.skipped = 0
+
+    def handle_header(self, keys):
+        EFDelegateParser.handle_header(self, keys)
+        # The digests are of whole rows
+        self.wanted = None
+        self.photo_col = list(keys).index('Profile Picture') if 'Profile Picture' in keys else None
+        if self.previous_keys is not None and list(keys) != self.previous_keys:
+            # Different columns, so nothing can match
+            self.previous = None
+
+    def handle_row(self, values):
+        # Rows are held back until all of a person's have arrived
+        group_id = values[self.person_id_col] if self.person_id_col is not None and self.person_id_col < len(values) else None
+        if group_id != self.group_id:
+            self.end_group()
+            self.group_id = group_id
+        self.group.append(values)
+
+    def end_group(self):
+        if not self.group:
+            return
+        digest = group_digest(self.group)
+        self.digests.append(digest)
+        if self.previous is not None and digest in self.previous:
+            self.skip_group()
+        else:
+            for values in self.group:
+                EFDelegateParser.handle_row(self, values)
+        self.group = []
+
+    def skip_group(self):
+        try:
+            person_id = int(self.group_id)
+        except (TypeError, ValueError):
+            return
+        self.skipped = self.skipped + 1
+        self.checked.append(person_id)
+        if self.photo_col is not None:
+            for values in self.group:
+                if self.photo_col < len(values) and values[self.photo_col]:
+                    self.photos[person_id] = values[self.photo_col]
+                    break
+
+    def handle_end(self):
+        self.end_group()
+        EFDelegateParser.handle_end(self)
+
+    def handle_person(self, person):
+        self.worker.ingest_row('person', person_record(person), self.changes)
+        self.checked.append(person['Person ID'])
+        photo = person.get('Profile Picture', '').strip()
+        if photo:
+            self.photos[person['Person ID']] = photo
+
+    def handle_event(self, event_id, event_name):
+        self.worker.ingest_row('event', {'id': event_id, 'name': event_name}, self.changes)
+
+    def handle_registration(self, person, event_id):
+        self.worker.ingest_row('registration', registration_record(person, event_id), self.changes)
+        self.registration_count = self.registration_count + 1
+
+    def summary(self):
+        return {'changes': self.changes,
+                'checked': self.checked,
+                'checked_at': time.time(),
+                'photos': self.photos,
+                'people': self.person_count + self.skipped,
+                'unchanged': self.skipped,
+                'registrations': self.registration_count,
+                }
+
 class DBWorker(object):
     # In order to improve application performance and decrease the
     # number of spurious database operations, we batch updates
@@ -33,6 +141,8 @@ class DBWorker(object):
         self.meta = sqlalchemy.MetaData()
         self.meta.reflect(bind=self.conn)
         self.tables = self.meta.tables
+        self.ingests = {}
+        self.received = 0
 
     def post(self, op, result):
         #print 'worker posting', op, result
@@ -50,12 +160,25 @@ class DBWorker(object):
         #print 'worker task', task
         try:
             op, args = task
+            self.received = self.received + op_weight(op, args)
             if op == 'fetch_all':
                 self.fetch_all(args)
             elif op == 'update':
                 self.update(*args)
             elif op == 'upsert':
                 self.upsert(*args)
+            elif op == 'bulk_update':
+                self.bulk_update(*args)
+            elif op == 'ingest_start':
+                self.ingest_start(*args)
+            elif op == 'ingest_file':
+                self.ingest_file(*args)
+            elif op == 'ingest_chunk':
+                self.ingest_chunk(*args)
+            elif op == 'ingest_end':
+                self.ingest_end(args)
+            elif op == 'ingest_abort':
+                self.ingest_abort(args)
             elif op == 'import':
                 self.import_data(args)
             elif op == 'export':
@@ -64,6 +187,9 @@ class DBWorker(object):
             self.post_exception()
 
     def shutdown(self):
+        # Reports still downloading will never finish
+        for id in self.ingests.keys():
+            self.ingest_abort(id)
         try:
             self.process_queues(-1)
         except Exception:
@@ -72,7 +198,10 @@ class DBWorker(object):
 
     def idle(self):
         try:
-            self.process_queues(0.2)
+            if len(self.write_cache) + len(self.insert_queue) > drain_threshold:
+                self.process_queues(1.0)
+            else:
+                self.process_queues(0.2)
         except Exception:
             self.post_exception()
 
@@ -118,7 +247,7 @@ class DBWorker(object):
         for k, v in batches.iteritems():
             self.post('batch_committed', (k,v))
 
-        self.post('pending', len(self.write_cache) + len(self.insert_queue))
+        self.post('pending', (self.received, len(self.write_cache) + len(self.insert_queue)))
 
     def get_queued_update(self, table, key):
         new_rec = {'table': table, 'key_fields': None, 'values': {}, 'origin': set(), 'upsert': False, 'batches': {}}
@@ -176,6 +305,160 @@ class DBWorker(object):
         queued['batches'][batchid] = 1 + queued['batches'].get(batchid, 0)
         queued['upsert'] = True
 
+    def bulk_update(self, table_name, ids, values, origin, batchid):
+        # Anything already queued for these rows (including inserting
+        # them) has to land first
+        self.process_queues(-1)
+
+        trans = self.conn.begin()
+        try:
+            self.do_bulk_update(table_name, ids, values)
+            trans.commit()
+        except:
+            exc_info = sys.exc_info()
+            try:
+                trans.rollback()
+            except:
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        self.post('bulk_update', {'table': table_name, 'ids': ids, 'values': values, 'origin': origin})
+        self.post('batch_committed', (batchid, 1))
+
+    def do_bulk_update(self, table_name, ids, values):
+        table = self.tables[table_name]
+        key_col = table.primary_key.columns.values()[0]
+        # Keep under sqlite's limit on bound parameters
+        for i in xrange(0, len(ids), bulk_chunk_size):
+            q = table.update().where(key_col.in_(ids[i:i+bulk_chunk_size]))
+            self.conn.execute(q.values(values))
+
+    # Report ingest: the GUI streams a report through in chunks (or
+    # points us at a spooled copy), we parse and write it in a single
+    # transaction, and only the changes go back (as 'ingest_done'),
+    # rather than an upsert and an echo for every row.
+    #
+    # A streamed report goes to a scratch file until it has all
+    # arrived, and is only parsed at ingest_end, all in one go. That
+    # way the transaction is never left open while the download goes
+    # on, holding up every other write (and the backlog that the
+    # download waits on).
+    #
+    # options: 'spool' is the spooled copy of this report, which gets
+    # the digests for next time; 'previous' is the last spooled run of
+    # the same report, to skip people who are unchanged since then
+
+    def ingest_start(self, id, options):
+        self.ingests[id] = {'options': options,
+                            'file': tempfile.TemporaryFile(),
+                            'encoding': None,
+                            }
+
+    def ingest_chunk(self, id, data):
+        pending = self.ingests.get(id)
+        if pending is None:
+            # Already failed
+            return
+        try:
+            if isinstance(data, unicode):
+                pending['encoding'] = 'utf-8'
+                data = data.encode('utf-8')
+            pending['file'].write(data)
+        except Exception:
+            self.ingest_failed(id)
+
+    def ingest_end(self, id):
+        pending = self.ingests.pop(id, None)
+        if pending is None:
+            return
+        f = pending['file']
+        try:
+            f.seek(0)
+            self.ingest(id, pending['options'], decode_chunks(f, pending['encoding']))
+        finally:
+            f.close()
+
+    def ingest_file(self, id, options):
+        self.ingest(id, options, read_chunks(options['file'], options.get('encoding')))
+
+    def ingest_abort(self, id):
+        # Nobody wants the result, so nothing to post back
+        pending = self.ingests.pop(id, None)
+        if pending is not None:
+            pending['file'].close()
+
+    def ingest_failed(self, id):
+        e = sys.exc_info()[1]
+        msg = traceback.format_exc()
+        pending = self.ingests.pop(id)
+        pending['file'].close()
+        self.post('ingest_failed', (id, (e, msg)))
+
+    def ingest(self, id, options, chunks):
+        # Compare against anything that's already queued, too
+        self.process_queues(-1)
+        previous = (None, None)
+        if options.get('previous') is not None:
+            previous = load_digests(options['previous'])
+        ingest = ReportIngest(self, previous)
+
+        trans = self.conn.begin()
+        try:
+            for data in chunks:
+                ingest.feed(data)
+            ingest.close()
+            summary = ingest.summary()
+            self.do_bulk_update('person', ingest.checked, {'last_checked_at': summary['checked_at']})
+            trans.commit()
+        except Exception:
+            e = sys.exc_info()[1]
+            msg = traceback.format_exc()
+            try:
+                trans.rollback()
+            except:
+                pass
+            self.post('ingest_failed', (id, (e, msg)))
+            return
+
+        spool = options.get('spool')
+        if spool is not None:
+            try:
+                save_digests(spool, ingest.keys, ingest.digests)
+                mark_ingested(spool)
+            except Exception:
+                self.post_exception()
+
+        self.post('ingest_done', (id, summary))
+
+    def ingest_row(self, table_name, values, changes):
+        table = self.tables[table_name]
+        key = self.extract_key(table_name, values)
+
+        q = select([table])
+        for col in table.primary_key.columns:
+            q = q.where(col == values[col.name])
+        row = self.conn.execute(q).fetchone()
+
+        if row is None:
+            self.conn.execute(table.insert().values(values))
+            row = self.conn.execute(q).fetchone()
+            changes.append(('insert', table_name, key, dict(row.items())))
+            return
+
+        changed = {}
+        for k, v in values.iteritems():
+            if k not in key and row[k] != v:
+                changed[k] = v
+        if not changed:
+            return
+
+        q = table.update()
+        for col in table.primary_key.columns:
+            q = q.where(col == values[col.name])
+        self.conn.execute(q.values(changed))
+        changed.update(key)
+        changes.append(('update', table_name, key, changed))
+
     def do_update(self, table_name, values, origin):
         value_fields = set(values) - set(self.key_fields(table_name))
 
@@ -442,6 +725,9 @@ def setup_session(datadir):
                        rotate FLOAT default 0,
                        block_upload boolean default 0,
                        load_failed boolean default 0,
+                       etag varchar,
+                       last_modified varchar,
+                       content_length integer,
                        opinion VARCHAR(6) default 'unsure',
                        PRIMARY KEY (id),
                        UNIQUE(url, person_id),
@@ -470,6 +756,12 @@ def setup_session(datadir):
             conn.execute('''alter table photo add column uploaded boolean default 0''')
         if not columns.has_key('date_edited'):
             conn.execute('''alter table photo add column date_edited float default 0.0''')
+        if not columns.has_key('etag'):
+            conn.execute('''alter table photo add column etag varchar''')
+        if not columns.has_key('last_modified'):
+            conn.execute('''alter table photo add column last_modified varchar''')
+        if not columns.has_key('content_length'):
+            conn.execute('''alter table photo add column content_length integer''')
 
     if 'event' not in tables:
         conn.execute('''CREATE TABLE event (
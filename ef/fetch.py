@@ -1,13 +1,16 @@
 from PyQt4 import QtCore
-from ef.db import Person, Photo, Event, Registration, Batch, FetchedPhoto
-from ef.parser import EFDelegateParser
+from ef.threads import thread_registry
+from ef.db import dbdata, Person, Photo, Event, Registration, Batch, Ingest, FetchedPhoto
+from ef.parser import EFDelegateParser, person_record, registration_record
 import traceback
 import time
-import re
 from ef.login import LoginTask, LoginError
-from ef.nettask import NetFuncs, NetworkError
-from ef.task import Task, TaskList
-from bs4 import SoupStrainer
+from ef.nettask import NetFuncs
+from ef.netlib import ef_url
+from ef.task import Task, TaskList, TaskGroup, BoundedMapOp, CancelToken, TaskCancelled
+from ef.scheduler import scheduler
+from ef import scrape, spool
+from ef.reportmeta import ReportFormTask, ReportFormError, invalidate_report_meta
 
 class FetchError(Exception):
     def __init__(self, msg):
@@ -15,39 +18,65 @@ class FetchError(Exception):
     def __str__(self):
         return self.msg
 
+def photo_value(value):
+    """A report's 'Profile Picture' column, or None if it's empty"""
+    value = value.strip()
+    if not value:
+        return None
+    return value
+
+def resolve_photo_url(value, base):
+    """Absolute URL for a 'Profile Picture' value. Nothing says what
+    relative values are relative to, so base has to be the URL of an
+    actual photo, as found on a person page (see PhotosTask)"""
+    url = QtCore.QUrl(base).resolved(QtCore.QUrl(value))
+    return str(url.toEncoded())
+
+def person_page_url(person_id):
+    return ef_url('/libdems/backend/home/codEditMain.csp?codReadOnly=1&personID=%d&curPage=1' % person_id)
+
+def page_photo_url(page):
+    """Absolute URL of the profile picture on a PageTask's person
+    page, or None"""
+    src = scrape.profile_picture(page.tree)
+    if src is None:
+        return None
+    url = QtCore.QUrl()
+    url.setEncodedUrl(src)
+    return str(page.current.resolve_url(url).toEncoded())
+
 class PersonDBParser(EFDelegateParser):
-    def __init__(self, progress, batch):
-        EFDelegateParser.__init__(self)
+    def __init__(self, progress, batch, photo_values=None):
+        EFDelegateParser.__init__(self, streaming=True)
         self.progress = progress
         self.batch = batch
+        # Person ID -> 'Profile Picture' value, for PhotosTask to pick
+        # up without having to crawl each person's page
+        self.photo_values = photo_values if photo_values is not None else {}
+        self.checked = []
 
     def handle_person(self, person):
-        firstname = person['Firstname'] or person['common first name']
-        fullname = filter(lambda x: len(x) > 0, [person['Salutation'].strip(), firstname.strip(), person['Lastname'].strip()])
-        Person.upsert({'id': person['Person ID'],
-                       'firstname': firstname.strip(),
-                       'lastname': person['Lastname'].strip(),
-                       'title': person['Salutation'].strip(),
-                       'fullname': ' '.join(fullname),
-                       'police_status': person['EF_Application Status'],
-                       'last_checked_at': time.time(),
-                       }, batch=self.batch)
-        self.progress.emit('Updated %d people' % len(self.people), 0, 0)
+        # Only changes are written; everybody seen gets last_checked_at
+        # bumped in one go at the end
+        Person.upsert_changed(person_record(person), batch=self.batch)
+        self.checked.append(person['Person ID'])
+        value = photo_value(person.get('Profile Picture', ''))
+        if value is not None:
+            self.photo_values[person['Person ID']] = value
+        self.progress.emit('Updated %d people' % self.person_count, 0, 0)
 
     def handle_event(self, event_id, event_name):
-        Event.upsert({'id': event_id,
-                      'name': event_name,
-                      }, batch=self.batch)
+        Event.upsert_changed({'id': event_id,
+                              'name': event_name,
+                              }, batch=self.batch)
 
     def handle_registration(self, person, event_id):
-        data = person['events'][event_id]
-        Registration.upsert({'person_id': person['Person ID'],
-                             'event_id': event_id,
-                             'attendee_type': data['Type of Attendee'],
-                             'booking_ref': data['Booking Ref'],
-                             'booker_firstname': data['Bookers Firstname'],
-                             'booker_lastname': data['Bookers lastname'],
-                             }, batch=self.batch)
+        Registration.upsert_changed(registration_record(person, event_id), batch=self.batch)
+
+    def close(self):
+        EFDelegateParser.close(self)
+        if self.checked:
+            Person.bulk_update(self.checked, {'last_checked_at': time.time()}, batch=self.batch)
 
 def catcherror(func):
     def wrapped(self, *args, **kwargs):
@@ -57,54 +86,118 @@ def catcherror(func):
             self.error.emit(traceback.format_exc())
     return wrapped
 
+# Most of a report to hold in memory while the db worker catches up
+report_buffer_size = 1024 * 1024
+
 class ReportTask(Task, NetFuncs):
-    def __init__(self, event, since, progress):
+    # With ingest, the report is handed to the db worker to parse and
+    # write, instead of being parsed here and written row by row
+    def __init__(self, event, since, progress, photo_values=None, ingest=True):
         Task.__init__(self)
         NetFuncs.__init__(self)
 
         self.progress = progress
         self.event = event
         self.since = since
+        self.photo_values = photo_values
+        self.ingest = ingest
         #self.f = open('output.tmp', 'w')
     
     def task(self):
-        self.batch = Batch()
-        self.parser = PersonDBParser(self.progress, self.batch)
-
         self.progress.emit('Running report', 0, 0)
-        soup = yield self.get('https://www.eventsforce.net/libdems/backend/home/dynaRepRun.csp?profileID=69', timeout=None)
-
-        date_id = None
-        event_id = None
-        for elem in soup.find_all('input', {'type': 'hidden', 'name': re.compile(r'^criteriaDescription')}):
-            m = re.match(r'^criteriaDescription_(\d+)$', elem['name'])
-            if m:
-                this_id = m.group(1)
-            else:
-                continue
-            if elem['value'] == 'Amendment Date':
-                date_id = this_id
-            elif elem['value'] == 'In Event':
-                event_id = this_id
 
-        if date_id is None or event_id is None:
-            raise FetchError("Failed to parse form from eventsforce (couldn't find in report parameters: %s, %s)" % (date_id, event_id))
-
-        soup = yield self.submit_form(soup.form, {'value1_%s' % date_id: self.since.toString('dd-MMM-yyyy'),
-                                                  'value2_%s' % date_id: QtCore.QDate.currentDate().toString('dd-MMM-yyyy'),
-                                                  'value1_%s' % event_id: str(self.event),
-                                                  })
-
-        img = soup.find('img', title='Export to Excel')
-        if img is None:
+        # The form is usually cached; if it turns out not to work any
+        # more (it's missing the criteria, or running it doesn't give
+        # an export link), fetch it afresh and try once more
+        link = None
+        for force in [False, True]:
+            form_task = self.subtask(ReportFormTask(69, force=force))
+            form_task.start_task()
+            yield self.wait(form_task)
+            meta = form_task.meta
+
+            date_id = meta['criteria'].get('Amendment Date')
+            event_id = meta['criteria'].get('In Event')
+            if date_id is None or event_id is None:
+                invalidate_report_meta(69)
+                if form_task.cached:
+                    continue
+                raise FetchError("Failed to parse form from eventsforce (couldn't find in report parameters: %s, %s)" % (date_id, event_id))
+
+            fields = dict(meta['fields'])
+            fields.update({'value1_%s' % date_id: str(self.since.toString('dd-MMM-yyyy')),
+                           'value2_%s' % date_id: str(QtCore.QDate.currentDate().toString('dd-MMM-yyyy')),
+                           'value1_%s' % event_id: str(self.event),
+                           })
+            tree = yield self.post(meta['action'], fields, None, tree=True)
+
+            link = scrape.export_link(tree)
+            if link is not None:
+                break
+            invalidate_report_meta(69)
+            if not form_task.cached:
+                break
+
+        if link is None:
             raise FetchError("Failed to parse response from eventsforce (didn't have Export link)")
-        link = img.parent
 
         self.progress.emit('Downloading results', 0, 0)
 
-        self.report_op = self.get_raw(link['href'], timeout=120)
-        self.report_op.reply.readyRead.connect(self.report_get_data)
-        yield self.report_op
+        # Only set up once there's something to download, so that
+        # nothing is left open if we fail (or are cancelled) before
+        params = {'profile': 69, 'event': self.event, 'since': str(self.since.toString(QtCore.Qt.ISODate))}
+        self.report_spool = None
+        previous = None
+        if spool.spooldir is not None:
+            self.report_spool = spool.ReportSpool(params)
+            previous = spool.latest_spool(params, ingested=True)
+
+        if self.ingest:
+            self.parser = Ingest(spool=self.report_spool and self.report_spool.base,
+                                 previous=previous and spool.spool_base(previous['name']))
+        else:
+            self.batch = Batch()
+            self.parser = PersonDBParser(self.progress, self.batch, self.photo_values)
+
+        # Read as it arrives, so it can't be retried
+        self.report_op = self.get_raw(link, timeout=120, retries=0)
+        # Once the db worker falls too far behind, we stop reading, and
+        # with a limited read buffer, Qt stops reading from the socket
+        self.report_op.when_started(self.setup_report_reply)
+        self.paused = dbdata.dbmanager.is_throttled
+        dbdata.dbmanager.throttled.connect(self.handle_throttled)
+        dbdata.dbmanager.drained.connect(self.handle_drained)
+        try:
+            # Finishing reads whatever was still in the buffer, which
+            # may be a lot if we were paused at the time
+            data = yield self.report_op
+            if data:
+                if self.paused:
+                    yield self.wait(dbdata.dbmanager.drained)
+                self.report_feed(data)
+            while self.report_op.reply.bytesAvailable() > 0:
+                if self.paused:
+                    yield self.wait(dbdata.dbmanager.drained)
+                self.report_get_data()
+        except:
+            if self.report_spool is not None:
+                self.report_spool.discard()
+            if self.ingest:
+                self.parser.abort()
+            raise
+        finally:
+            dbdata.dbmanager.throttled.disconnect(self.handle_throttled)
+            dbdata.dbmanager.drained.disconnect(self.handle_drained)
+
+        if self.report_spool is not None:
+            self.report_spool.close()
+
+        if self.ingest:
+            self.progress.emit('Saving people', 0, 0)
+            self.parser.finish()
+            yield self.wait(self.parser)
+            self.handle_ingested(self.parser.result())
+            return
 
         self.parser.close()
 
@@ -113,22 +206,83 @@ class ReportTask(Task, NetFuncs):
 
         yield self.wait(self.batch)
 
+    def setup_report_reply(self, reply):
+        reply.setReadBufferSize(report_buffer_size)
+        reply.readyRead.connect(self.report_get_data)
+
+    def handle_throttled(self):
+        self.paused = True
+        self.report_op.pause_timeout()
+
+    def handle_drained(self):
+        self.paused = False
+        self.report_op.resume_timeout()
+        self.report_get_data()
+
     def report_get_data(self):
-        data = self.report_op.result()
-        #self.f.write(unicode(data).encode('utf-8'))
+        if self.paused:
+            return
+        self.report_feed(self.report_op.result())
+
+    def report_feed(self, data):
+        if self.report_spool is not None:
+            self.report_spool.write(data)
         self.parser.feed(data)
 
     def handle_commit_progress(self, cur, max):
         self.progress.emit('Saving people', cur, max)
 
+    def handle_ingested(self, summary):
+        if self.photo_values is not None:
+            for person_id, value in summary['photos'].iteritems():
+                value = photo_value(value)
+                if value is not None:
+                    self.photo_values[person_id] = value
+        self.progress.emit('Updated %d people (%d changes)' % (summary['people'], len(summary['changes'])), 0, 0)
+
+class ReingestTask(ReportTask):
+    """Ingest the most recently spooled report again, without going to
+    eventsforce"""
+    def __init__(self, progress, photo_values=None):
+        ReportTask.__init__(self, None, None, progress, photo_values)
+
+    def task(self):
+        meta = spool.latest_spool()
+        if meta is None:
+            raise FetchError("There is no saved report to import")
+        self.progress.emit('Saving people', 0, 0)
+        self.parser = Ingest(spool=spool.spool_base(meta['name']), reingest=True, encoding=meta['encoding'])
+        yield self.wait(self.parser)
+        self.handle_ingested(self.parser.result())
+
+# How many person pages to fetch at once
+fetch_concurrency = 4
+
+# How many people with a photo named in the report to look at, to find
+# out what the report's names are relative to, before giving up and
+# crawling everybody
+photo_probes = 3
+
+class PageTask(Task, NetFuncs):
+    def __init__(self, url):
+        Task.__init__(self)
+        NetFuncs.__init__(self)
+
+        self.url = url
+        self.tree = None
+
+    def task(self):
+        self.tree = yield self.get_tree(self.url)
+
 class PhotosTask(Task, NetFuncs):
-    def __init__(self, progress, fetch_photos, batch):
+    def __init__(self, progress, fetch_photos, batch, photo_values=None):
         Task.__init__(self)
         NetFuncs.__init__(self)
 
         self.progress = progress
         self.fetch_photos = fetch_photos
         self.batch = batch
+        self.photo_values = photo_values or {}
 
     def task(self):
         self.db_tasks = []
@@ -138,25 +292,47 @@ class PhotosTask(Task, NetFuncs):
         else:
             self.people = Person.all_with_photos(self.fetch_photos)
 
-        image_strainer = SoupStrainer(['img'])
-
-        for i, person in enumerate(self.people):
-            self.progress.emit('Finding photos', i, len(self.people))
-            for retry in reversed(xrange(3)):
-                try:
-                    soup = yield self.get('https://www.eventsforce.net/libdems/backend/home/codEditMain.csp?codReadOnly=1&personID=%d&curPage=1' % person.id, parse_only=image_strainer)
-                    break
-                except NetworkError, e:
-                    if retry == 0:
-                        raise
-                    continue
-
-            img = soup.find('img', title='Picture Profile')
-            if img is not None:
-                url = QtCore.QUrl()
-                url.setEncodedUrl(img['src'])
-                fetched = FetchedPhoto(person, str(self.current.resolve_url(url).toEncoded()), self.batch)
-                self.db_tasks.append(fetched)
+        # People whose photo is named in the report don't need their
+        # page crawled, once one of them has shown us what the names
+        # are relative to: their value, resolved against the photo URL
+        # on their page, has to come out as that same URL. If it
+        # doesn't, everybody gets crawled.
+        listed = [person for person in self.people if person.id in self.photo_values]
+        base = None
+        for person in listed[:photo_probes]:
+            page = self.subtask(PageTask(person_page_url(person.id)))
+            page.start_task()
+            yield self.wait(page)
+            src = page_photo_url(page)
+            if src is None:
+                continue
+            if resolve_photo_url(self.photo_values[person.id], src) == src:
+                base = src
+            break
+
+        if base is not None:
+            crawl = []
+            for person in self.people:
+                value = self.photo_values.get(person.id)
+                if value is None:
+                    crawl.append(person)
+                else:
+                    self.db_tasks.append(FetchedPhoto(person, resolve_photo_url(value, base), self.batch))
+            self.people = crawl
+
+        def make_task(person):
+            return self.subtask(PageTask(person_page_url(person.id)))
+
+        self.progress.emit('Finding photos', 0, len(self.people))
+        yield BoundedMapOp(make_task, self.people, fetch_concurrency, self.handle_page)
+
+    def handle_page(self, i, page):
+        self.progress.emit('Finding photos', i + 1, len(self.people))
+        person = self.people[i]
+        url = page_photo_url(page)
+        if url is not None:
+            fetched = FetchedPhoto(person, url, self.batch)
+            self.db_tasks.append(fetched)
 
 class CategoryTask(Task, NetFuncs):
     def __init__(self, progress, regs, batch):
@@ -168,26 +344,18 @@ class CategoryTask(Task, NetFuncs):
         self.batch = batch
 
     def task(self):
-        category_strainer = SoupStrainer(['tr', 'td', 'img'])
-
-        for i, reg in enumerate(self.regs):
-            self.progress.emit('Finding missing registration categories', i, len(self.regs))
-            for retry in reversed(xrange(3)):
-                try:
-                    soup = yield self.get('https://www.eventsforce.net/libdems/backend/home/codEditMain.csp?codReadOnly=1&personID=%d&eventID=%d&curPage=1' % (reg.person_id, reg.event_id), parse_only=category_strainer)
-                    break
-                except NetworkError, e:
-                    if retry == 0:
-                        raise
-                    continue
+        def make_task(reg):
+            return self.subtask(PageTask(ef_url('/libdems/backend/home/codEditMain.csp?codReadOnly=1&personID=%d&eventID=%d&curPage=1' % (reg.person_id, reg.event_id))))
+
+        self.progress.emit('Finding missing registration categories', 0, len(self.regs))
+        yield BoundedMapOp(make_task, self.regs, fetch_concurrency, self.handle_page)
 
-            img = soup.find('img', src=re.compile(r'.*/backend/tick.gif$'))
-            if img is not None:
-                img_td = img.find_parent('td')
-                category_td = img_td.find_previous_sibling('td')
-                category = category_td.string
-                if category is not None:
-                    reg.update_category(category.strip(), batch=self.batch)
+    def handle_page(self, i, page):
+        self.progress.emit('Finding missing registration categories', i + 1, len(self.regs))
+        reg = self.regs[i]
+        category = scrape.ticked_category(page.tree)
+        if category is not None:
+            reg.update_category(category.strip(), batch=self.batch)
 
 class BatchFinishTask(Task):
     def __init__(self, progress, batch):
@@ -206,14 +374,19 @@ class BatchFinishTask(Task):
 
 class FetchTask(TaskList):
     def __init__(self, fetch_event, fetch_since, fetch_photos, username, password, progress, batch):
+        photo_values = {}
         tasks = [LoginTask(username, password)]
         if fetch_event:
-            tasks.append(ReportTask(fetch_event, fetch_since, progress))
+            tasks.append(ReportTask(fetch_event, fetch_since, progress, photo_values))
+        # Photos and categories are independent, so crawl for both at once
+        crawls = []
         if fetch_photos != 'none':
-            tasks.append(PhotosTask(progress, fetch_photos, batch))
+            crawls.append(PhotosTask(progress, fetch_photos, batch, photo_values))
         broken_registrations = Registration.by_category('')
         if broken_registrations:
-            tasks.append(CategoryTask(progress, list(broken_registrations), batch))
+            crawls.append(CategoryTask(progress, list(broken_registrations), batch))
+        if crawls:
+            tasks.append(TaskGroup(crawls))
         tasks.append(BatchFinishTask(progress, batch))
         TaskList.__init__(self, tasks)
 
@@ -228,9 +401,18 @@ class FetchWorker(QtCore.QObject):
     completed = QtCore.pyqtSignal(int)
     error = QtCore.pyqtSignal(str)
     progress = QtCore.pyqtSignal(str, int, int)
+
+    # Longest a fetch may take before it's given up on, in seconds
+    time_limit = 4 * 60 * 60
     
     def __init__(self):
         QtCore.QObject.__init__(self)
+        self.token = None
+
+    def start(self, priority):
+        self.token = CancelToken(deadline=self.time_limit)
+        self.task.set_token(self.token)
+        scheduler.submit(self.task, priority)
 
     @QtCore.pyqtSlot(int, QtCore.QDate, str, str, str)
     @catcherror
@@ -242,7 +424,7 @@ class FetchWorker(QtCore.QObject):
         self.batch.finished.connect(lambda: self.completed.emit(fetch_event))
         self.progress.emit('Logging in', 0, 0)
 
-        self.task.start_task()
+        self.start('bulk')
 
     @QtCore.pyqtSlot(int, QtCore.QDate, str, str, str)
     @catcherror
@@ -254,10 +436,33 @@ class FetchWorker(QtCore.QObject):
         self.batch.finished.connect(lambda: self.completed.emit(0))
         self.progress.emit('Logging in', 0, 0)
 
-        self.task.start_task()
+        # Somebody's waiting to look at this person
+        self.start('interactive')
+
+    @QtCore.pyqtSlot()
+    @catcherror
+    def start_reingest(self):
+        self.batch = Batch()
+        self.task = ReingestTask(self.progress)
+        self.task.task_finished.connect(self.batch.finish)
+        self.task.task_exception.connect(self.handle_exception)
+        self.batch.finished.connect(lambda: self.completed.emit(0))
+
+        self.start('bulk')
+
+    @QtCore.pyqtSlot()
+    def abort(self):
+        if self.token is not None:
+            self.token.cancel()
 
     def handle_exception(self, e, msg):
-        if isinstance(e, LoginError):
+        if isinstance(e, TaskCancelled):
+            # Whatever it had queued for the db can go
+            self.batch = None
+            self.error.emit(str(e))
+        elif isinstance(e, (FetchError, ReportFormError)):
+            self.error.emit(str(e))
+        elif isinstance(e, LoginError):
             self.error.emit(str(e))
         else:
             self.error.emit(msg)
@@ -265,15 +470,19 @@ class FetchWorker(QtCore.QObject):
 class Fetcher(QtCore.QObject):
     sig_start_fetch = QtCore.pyqtSignal(int, QtCore.QDate, str, str, str)
     sig_start_fetch_person = QtCore.pyqtSignal(int, str, str)
+    sig_start_reingest = QtCore.pyqtSignal()
+    sig_abort = QtCore.pyqtSignal()
     
     def __init__(self):
         super(QtCore.QObject, self).__init__()
         
         self.fetcher = FetchWorker()
-        #self.fetcher.moveToThread(thread_registry.get('network'))
+        self.fetcher.moveToThread(thread_registry.get('network'))
 
         self.sig_start_fetch.connect(self.fetcher.start_fetch)
         self.sig_start_fetch_person.connect(self.fetcher.start_fetch_person)
+        self.sig_start_reingest.connect(self.fetcher.start_reingest)
+        self.sig_abort.connect(self.fetcher.abort)
 
         # This is an interesting idiom: copy the bound signals into
         # this object, so clients can just connect to them and hear
@@ -287,3 +496,9 @@ class Fetcher(QtCore.QObject):
 
     def start_fetch_person(self, person, username, password):
         self.sig_start_fetch_person.emit(person, username, password)
+
+    def start_reingest(self):
+        self.sig_start_reingest.emit()
+
+    def abort(self):
+        self.sig_abort.emit()
@@ -1,9 +1,13 @@
 from PyQt4 import QtCore
+from ef.threads import thread_registry
 import time
 import re
 from ef.login import LoginTask, LoginError
 from ef.nettask import NetFuncs
+from ef.netlib import ef_url
 from ef.task import Task, TaskList
+from ef.scheduler import scheduler
+from ef.reportmeta import ReportFormTask, ReportFormError, load_report_meta
 
 # This isn't used right now, fetches the list of reports
 class ReportListTask(Task, NetFuncs):
@@ -14,7 +18,7 @@ class ReportListTask(Task, NetFuncs):
         self.reports = []
 
     def task(self):
-        soup = yield self.get('https://www.eventsforce.net/libdems/backend/home/dynaRepStart.csp')
+        soup = yield self.get(ef_url('/libdems/backend/home/dynaRepStart.csp'))
         for report_tag in soup.find_all('td', text=re.compile(r'#export')):
             report_name = unicode(report_tag.string).replace('#export', '').strip()
             report_link = None
@@ -31,20 +35,18 @@ class ReportListTask(Task, NetFuncs):
                     pass
 
 # Currently using this one, fetches parameters from report 69
-class ReportParamsTask(Task, NetFuncs):
-    def __init__(self):
+class ReportParamsTask(Task):
+    def __init__(self, force=False):
         Task.__init__(self)
-        NetFuncs.__init__(self)
 
+        self.force = force
         self.reports = []
 
     def task(self):
-        soup = yield self.get('https://www.eventsforce.net/libdems/backend/home/dynaRepRun.csp?profileID=69')
-        select = soup.find('select', {'name': re.compile(r'^value1_')})
-        for option in select.find_all('option'):
-            if not option.has_key('value'):
-                continue
-            self.reports.append((option.text, int(option['value'])))
+        form_task = self.subtask(ReportFormTask(69, force=self.force, for_post=False))
+        form_task.start_task()
+        yield self.wait(form_task)
+        self.reports = [tuple(choice) for choice in form_task.meta['choices']]
 
 class ReportsFetchWorker(QtCore.QObject):
     completed = QtCore.pyqtSignal(list)
@@ -55,18 +57,24 @@ class ReportsFetchWorker(QtCore.QObject):
 
     @QtCore.pyqtSlot(str, str)
     def start_fetch(self, username, password):
+        # No need to log in if we still know the list
+        meta = load_report_meta(69)
+        if meta is not None:
+            self.completed.emit([tuple(choice) for choice in meta['choices']])
+            return
+
         self.reportslist_task = ReportParamsTask()
         self.task = TaskList(LoginTask(username, password), self.reportslist_task)
         self.task.task_finished.connect(self.handle_finished)
         self.task.task_exception.connect(self.handle_exception)
 
-        self.task.start_task()
+        scheduler.submit(self.task, 'interactive')
 
     def handle_finished(self):
         self.completed.emit(self.reportslist_task.reports)
 
     def handle_exception(self, e, msg):
-        if isinstance(e, LoginError):
+        if isinstance(e, (LoginError, ReportFormError)):
             self.error.emit(str(e))
         else:
             self.error.emit(msg)
@@ -78,7 +86,7 @@ class ReportsFetcher(QtCore.QObject):
         super(QtCore.QObject, self).__init__()
         
         self.fetcher = ReportsFetchWorker()
-        #self.fetcher.moveToThread(thread_registry.get('network'))
+        self.fetcher.moveToThread(thread_registry.get('network'))
 
         self.sig_start_fetch.connect(self.fetcher.start_fetch)
 
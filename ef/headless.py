@@ -0,0 +1,146 @@
+"""Runs fetches, uploads and other tasks without a GUI, e.g. from cron
+or a server, or to time them.
+
+Tasks only need a Qt event loop and QtNetwork, not a display, so this
+runs the same task coroutines and workers as the editor does, under a
+QCoreApplication. Everything (the network manager included) lives in
+the calling thread, and each call runs the event loop until the work
+is done."""
+
+from PyQt4 import QtCore
+import sys
+from ef.db import setup_session, Person, Photo, Registration, Event
+from ef.netlib import start_network_manager, stop_network_manager
+from ef.task import CancelToken
+from ef.scheduler import scheduler
+from ef.trace import start_tracing, stop_tracing
+from ef.netrecord import start_session_archive, stop_session_archive
+from ef.fetch import FetchWorker
+from ef.upload import UploadWorker
+
+class HeadlessError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return self.msg
+
+def core_application():
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        app = QtCore.QCoreApplication(sys.argv[:1])
+    # So that QSettings (saved logins, cached report forms) are the
+    # editor's
+    if not QtCore.QCoreApplication.applicationName():
+        QtCore.QCoreApplication.setOrganizationName('asuffield.me.uk')
+        QtCore.QCoreApplication.setOrganizationDomain('asuffield.me.uk')
+        QtCore.QCoreApplication.setApplicationName('ef-image-editor')
+    return app
+
+class Headless(object):
+    """A db session and network manager on datadir, as the editor
+    would set up. With load_db, everything in the database is loaded
+    first, which the fetcher and uploader expect."""
+
+    def __init__(self, datadir, load_db=True):
+        self.app = core_application()
+
+        self.datadir = datadir
+        start_tracing(datadir)
+        start_session_archive()
+        self.dbmanager = setup_session(datadir)
+        self.dbmanager.exception.connect(self.handle_db_exception)
+        self.db_errors = []
+        start_network_manager(datadir)
+        if load_db:
+            self.load_db()
+
+    def handle_db_exception(self, e, msg):
+        print >>sys.stderr, msg
+        self.db_errors.append(msg)
+
+    def run_until(self, start, signals):
+        """Call start(), then run the event loop until one of signals
+        is emitted. Returns (index of the signal, its arguments)."""
+        loop = QtCore.QEventLoop()
+        outcome = []
+        def make_handler(i):
+            def handler(*args):
+                if not outcome:
+                    outcome.append((i, args))
+                loop.quit()
+            return handler
+        handlers = [make_handler(i) for i in xrange(len(signals))]
+        for signal, handler in zip(signals, handlers):
+            signal.connect(handler)
+        try:
+            start()
+            if not outcome:
+                loop.exec_()
+        finally:
+            for signal, handler in zip(signals, handlers):
+                signal.disconnect(handler)
+        return outcome[0]
+
+    def load_db(self):
+        for cls in [Photo, Registration, Event, Person]:
+            cls.signal_existing_created()
+        # Tables are loaded in order, so person is the last
+        while True:
+            i, (table,) = self.run_until(lambda: None, [self.dbmanager.existing_done])
+            if table == 'person':
+                break
+
+    def run(self, task, priority='bulk', time_limit=None):
+        """Run a task to completion, raising whatever it raised.
+        Returns the task."""
+        if time_limit is not None:
+            task.set_token(CancelToken(deadline=time_limit))
+        i, args = self.run_until(lambda: scheduler.submit(task, priority),
+                                 [task.task_finished, task.task_exception])
+        if i == 1:
+            e, msg, blob = args
+            raise e, None, blob.get('traceback')
+        return task
+
+    def wait(self, finishable):
+        """Run until a Batch (or any Finishable) has finished"""
+        if finishable.is_finished:
+            return
+        signals = [finishable.finish_signal]
+        if finishable.error_signal is not None:
+            signals.append(finishable.error_signal)
+        i, args = self.run_until(lambda: None, signals)
+        if i == 1:
+            raise HeadlessError(str(args[-1]))
+
+    def run_worker(self, worker, start, progress=None):
+        """Drive one of the editor's workers (FetchWorker, UploadWorker)
+        in this thread: call start(), then run until the worker emits
+        completed or error. Errors are raised as HeadlessError."""
+        if progress is not None:
+            worker.progress.connect(progress)
+        try:
+            i, args = self.run_until(start, [worker.completed, worker.error])
+        finally:
+            if progress is not None:
+                worker.progress.disconnect(progress)
+        if i == 1:
+            raise HeadlessError(str(args[0]))
+        return args
+
+    def fetch(self, event, since, photos, username, password, progress=None):
+        """As the fetch wizard does: event id (0 for none), since (a
+        QDate), which photos to look for ('none', 'missing', ...)"""
+        self.fetcher = FetchWorker()
+        return self.run_worker(self.fetcher, lambda: self.fetcher.start_fetch(event, since, photos, username, password), progress)
+
+    def upload(self, people_filter, username, password, progress=None):
+        """As the upload wizard does, e.g. people_filter={'mode': 'good'}"""
+        self.uploader = UploadWorker()
+        return self.run_worker(self.uploader, lambda: self.uploader.start_upload(people_filter, username, password), progress)
+
+    def close(self):
+        stop_network_manager()
+        stop_tracing()
+        stop_session_archive()
+        self.dbmanager.shutdown()
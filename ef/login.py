@@ -1,8 +1,8 @@
-from ef.nettask import NetFuncs
+from ef.nettask import NetFuncs, NetworkError
+from ef.netlib import session_jar, ef_url
 from ef.task import Task
 from PyQt4 import QtCore
-from bs4 import SoupStrainer
-import re
+from ef import scrape
 
 class LoginError(Exception):
     def __init__(self, value):
@@ -14,34 +14,52 @@ class LoginTask(Task, NetFuncs):
     completed = QtCore.pyqtSignal(bool)
     error = QtCore.pyqtSignal(str)
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, net_manager=None, force=False):
         Task.__init__(self)
-        NetFuncs.__init__(self)
+        NetFuncs.__init__(self, net_manager)
 
         self.username = username
         self.password = password
+        self.force = force
 
     def task(self):
-        soup = yield self.get('https://www.eventsforce.net/libdems/backend/home/login.csp', parse_only=SoupStrainer(['form']))
+        jar = session_jar(self.net_manager)
 
-        login_strainer = SoupStrainer(['script', 'title', 'span', 'a'])
+        if not self.force and jar.has_session(self.username, self.password):
+            if jar.is_fresh():
+                return
+            # Cheap check that the saved session is still alive
+            # before going through the whole login sequence
+            try:
+                tree = yield self.get_tree(jar.probe_url)
+                if scrape.has_logout_button(tree):
+                    jar.validated(self.username, self.password, jar.probe_url)
+                    return
+            except NetworkError:
+                pass
 
-        soup = yield self.submit_form(soup.form, {'txtUsername': self.username, 'txtPassword': self.password}, parse_only=login_strainer)
+        jar.invalidate()
+
+        tree = yield self.get_tree(ef_url('/libdems/backend/home/login.csp'))
+
+        tree = yield self.submit_form(scrape.first_form(tree), {'txtUsername': self.username, 'txtPassword': self.password}, tree=True)
 
         # Follow hideous javascript redirect that they snuck into the login sequence
-        m = None
-        for script in soup.find_all('script'):
-            m = re.search(r'var redirectURL="(.*)"', script.text)
-            if m:
-                link = m.group(1)
-                soup = yield self.get(link, parse_only=login_strainer)
-                break
-
-        if soup.find(text=re.compile('Invalid logon')) is not None:
+        link = scrape.redirect_url(tree)
+        if link is not None:
+            tree = yield self.get_tree(link)
+
+        if scrape.has_invalid_logon(tree):
             raise LoginError('Invalid logon')
-        if soup.title is None:
+        title = scrape.title(tree)
+        if title is None:
             raise LoginError('Got incomprehensible page from eventsforce after login')
-        if soup.title.text != 'Eventsforce':
-            raise LoginError('Got unexpected page title "%s" from eventsforce after login' % soup.title.text)
-        if soup.find('a', id='ef_menu_button_logout') is None:
+        if title != 'Eventsforce':
+            raise LoginError('Got unexpected page title "%s" from eventsforce after login' % title)
+        if not scrape.has_logout_button(tree):
             raise LoginError('Did not see logout button on page after logging in')
+
+        # The page we ended up on is a good cheap check for whether
+        # the session is still alive next time
+        probe_url = str(self.current.resolve_url(QtCore.QUrl('')).toEncoded())
+        jar.validated(self.username, self.password, probe_url)
@@ -3,6 +3,8 @@ from ef.nettask import NetFuncs
 from ef.task import Task, TaskList
 from ef.login import LoginTask, LoginError
 from ef.parser import EFDelegateParser
+from ef import scrape, spool
+from ef.reportmeta import report_url
 import traceback
 import sys
 
@@ -16,7 +18,7 @@ voting_bool_map = {
 
 class MemberParser(EFDelegateParser):
     def __init__(self, members, unreg, wrong, have_nv):
-        EFDelegateParser.__init__(self)
+        EFDelegateParser.__init__(self, streaming=True)
 
         self.members = members
         self.unreg = unreg
@@ -24,7 +26,7 @@ class MemberParser(EFDelegateParser):
         self.have_nv = have_nv
 
     def handle_person(self, person):
-        self.progress.emit('Scanned %d people' % len(self.people))
+        self.progress.emit('Scanned %d people' % self.person_count)
         if person.get('Membership No', '').strip() == '':
             return
         member = person['Membership No']
@@ -63,27 +65,48 @@ class MemberReportTask(Task, NetFuncs):
     def task(self):
         self.parser.progress = self.progress
         self.progress.emit('Running report')
-        soup = yield self.get('https://www.eventsforce.net/libdems/backend/home/dynaRepRun.csp?profileID=65', timeout=None)
+        tree = yield self.get_tree(report_url(65), timeout=None)
 
-        img = soup.find('img', title='Export to Excel')
-        if img is None:
+        link = scrape.export_link(tree)
+        if link is None:
             raise ScanError("Failed to parse response from eventsforce (didn't have Export link)")
-        link = img.parent
 
         self.progress.emit('Downloading results')
 
         self.report_exception = None
 
-        self.report_op = self.get_raw(link['href'], timeout=120)
-        self.report_op.reply.readyRead.connect(self.report_get_data)
-        yield self.report_op
+        self.report_spool = None
+        if spool.spooldir is not None:
+            self.report_spool = spool.ReportSpool({'profile': 65})
+
+        self.report_op = self.get_raw(link, timeout=120, retries=0)
+        self.report_op.when_started(lambda reply: reply.readyRead.connect(self.report_get_data))
+        try:
+            # Anything that came in with the end of the reply
+            data = yield self.report_op
+            if data:
+                self.report_feed(data)
+        except:
+            if self.report_spool is not None:
+                self.report_spool.discard()
+            raise
+
+        if self.report_spool is not None:
+            self.report_spool.close()
 
         if self.report_exception is not None:
             raise self.report_exception, None, self.report_tb
 
+        self.parser.close()
+
     def report_get_data(self):
+        self.report_feed(self.report_op.result())
+
+    def report_feed(self, data):
         try:
-            self.parser.feed(self.report_op.result())
+            if self.report_spool is not None:
+                self.report_spool.write(data)
+            self.parser.feed(data)
         except Exception, e:
             self.report_exception = e
             self.report_tb = sys.exc_info()[2]
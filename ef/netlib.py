@@ -1,11 +1,28 @@
 from urllib import urlencode
 from PyQt4 import QtCore, QtNetwork
+from ef.threads import WorkerThread
 import os
 import re
+import sys
+import json
+import time
+import base64
+import hashlib
+import hmac
+import traceback
 from types import StringType, UnicodeType
 
 STRING_TYPES = StringType, UnicodeType
 
+# Where eventsforce is. Setting EF_BASE_URL points everything at a
+# stand-in instead, such as bench/efserver.py
+ef_base_url = os.environ.get('EF_BASE_URL', 'https://www.eventsforce.net').rstrip('/')
+
+def ef_url(path):
+    """Absolute URL of a path on eventsforce, e.g.
+    ef_url('/libdems/backend/home/login.csp')"""
+    return ef_base_url + path
+
 """
 Lifted this next couple of functions from mechanize - parses content-type headers
 
@@ -117,27 +134,237 @@ def split_header_words(header_values):
 def encode_form_fields(fields):
     return urlencode(dict([(k,unicode(v).encode('utf-8')) for k,v in fields.items()]))
 
+try:
+    import win32crypt
+except ImportError:
+    win32crypt = None
+
+def protect_data(data):
+    if win32crypt is not None:
+        return win32crypt.CryptProtectData(data, u'ef-image-editor session', None, None, None, 0)
+    return data
+
+def unprotect_data(data):
+    if win32crypt is not None:
+        return win32crypt.CryptUnprotectData(data, None, None, None, 0)[1]
+    return data
+
+def password_hash(password, salt):
+    return hashlib.pbkdf2_hmac('sha256', unicode(password).encode('utf-8'), salt, 10000).encode('hex')
+
+def session_owner(username):
+    """Who a saved session belongs to (the username, and which site
+    it's for), as a digest keyed with a secret kept in QSettings rather
+    than alongside the session"""
+    settings = QtCore.QSettings()
+    key = settings.value('session-key')
+    if key.isValid():
+        key = str(key.toString())
+    else:
+        key = os.urandom(32).encode('hex')
+        settings.setValue('session-key', key)
+    return hmac.new(key, (u'%s\n%s' % (username, ef_base_url)).encode('utf-8'), hashlib.sha256).hexdigest()
+
+class SessionCookieJar(QtNetwork.QNetworkCookieJar):
+    """Cookie jar which remembers who it's logged in as, so that
+    LoginTask can skip logging in again while the session is still
+    good. If it has a filename, the session is saved there (encrypted
+    with the user's credentials on Windows, and readable only by the
+    user elsewhere) and survives a restart.
+
+    Nothing derived from the password is saved: a saved session is
+    only matched to the username (see session_owner). Once a session
+    has been validated in this run, the password has to match too."""
+
+    # Don't bother probing a session that was known good this recently
+    fresh_time = 60
+
+    def __init__(self, filename=None):
+        QtNetwork.QNetworkCookieJar.__init__(self)
+        self.filename = filename
+        self.forget()
+        self.load()
+
+    def forget(self):
+        self.setAllCookies([])
+        self.owner = None
+        self.salt = None
+        self.password_hash = None
+        self.probe_url = None
+        self.validated_at = 0
+
+    def has_session(self, username, password):
+        if self.owner is None or self.owner != session_owner(unicode(username)):
+            return False
+        if self.password_hash is None:
+            # Loaded from disk; the probe will tell
+            return True
+        return self.password_hash == password_hash(password, self.salt)
+
+    def is_fresh(self):
+        return time.time() - self.validated_at < self.fresh_time
+
+    def validated(self, username, password, probe_url):
+        if self.salt is None:
+            self.salt = os.urandom(16).encode('hex')
+        self.owner = session_owner(unicode(username))
+        self.password_hash = password_hash(password, self.salt)
+        self.probe_url = probe_url
+        self.validated_at = time.time()
+        self.save()
+
+    def invalidate(self):
+        self.forget()
+        self.save()
+
+    def load(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                state = json.loads(unprotect_data(f.read()))
+            finally:
+                f.close()
+            cookies = []
+            for raw in state['cookies']:
+                cookies.extend(QtNetwork.QNetworkCookie.parseCookies(base64.b64decode(raw)))
+            self.setAllCookies(cookies)
+            self.owner = state['owner']
+            self.probe_url = state['probe_url']
+        except Exception:
+            print >>sys.stderr, "Discarding unreadable saved session:", traceback.format_exc()
+            self.forget()
+
+    def save(self):
+        if self.filename is None:
+            return
+        now = QtCore.QDateTime.currentDateTime()
+        cookies = []
+        for cookie in self.allCookies():
+            if cookie.isSessionCookie() or cookie.expirationDate() > now:
+                cookies.append(base64.b64encode(str(cookie.toRawForm())))
+        state = {'owner': self.owner,
+                 'probe_url': self.probe_url,
+                 'cookies': cookies,
+                 }
+        f = os.fdopen(os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb')
+        try:
+            # O_CREAT's mode only applies to a new file
+            os.chmod(self.filename, 0600)
+            f.write(protect_data(json.dumps(state)))
+        finally:
+            f.close()
+
 manager = None
 
 def ignoreSslErrors(reply, errors):
     reply.ignoreSslErrors()
 
-def start_network_manager():
+def start_network_manager(datadir=None):
     global manager
     manager = QtNetwork.QNetworkAccessManager()
+    session_file = None
+    if datadir is not None:
+        session_file = os.path.join(datadir, 'session.dat')
+    manager.setCookieJar(SessionCookieJar(session_file))
     #manager.setProxy(QtNetwork.QNetworkProxy(QtNetwork.QNetworkProxy.HttpProxy, '127.0.0.1', 8080))
     #manager.sslErrors.connect(ignoreSslErrors)
 
 def stop_network_manager():
     global manager
+    if manager is not None:
+        manager.cookieJar().save()
     manager = None
 
-def qt_form_post(url, fields, file=None):
+class NetworkThreadControl(QtCore.QObject):
+    """Lives in the network thread, so that the network manager is
+    created (and torn down) in the thread that uses it"""
+
+    def __init__(self, datadir):
+        QtCore.QObject.__init__(self)
+        self.datadir = datadir
+
+    @QtCore.pyqtSlot()
+    def start(self):
+        start_network_manager(self.datadir)
+
+    @QtCore.pyqtSlot(int)
+    def stop(self, rc):
+        stop_network_manager()
+        QtCore.QThread.currentThread().exit(rc)
+
+def start_network_thread(datadir=None):
+    """Start the 'network' worker thread, with the global network
+    manager living in it. Everything that uses NetFuncs should be
+    moved to this thread, and talk to the rest of the application
+    through queued signals."""
+    thread = WorkerThread(name='network')
+    control = thread.control = NetworkThreadControl(datadir)
+    control.moveToThread(thread)
+    # started is emitted in the new thread before its event loop
+    # runs, so the manager exists before any queued work arrives
+    thread.started.connect(control.start, QtCore.Qt.DirectConnection)
+    thread.please_exit.connect(control.stop)
+    thread.start()
+    return thread
+
+def create_network_manager():
+    """Create an extra network manager, with its own cookie jar, for
+    running a separate eventsforce session alongside the main one."""
+    net_manager = QtNetwork.QNetworkAccessManager()
+    net_manager.setCookieJar(SessionCookieJar())
+    return net_manager
+
+def session_jar(net_manager=None):
+    if net_manager is None:
+        net_manager = manager
+    return net_manager.cookieJar()
+
+def session_id(url, net_manager=None):
+    """Digest of the cookies net_manager would send to url, which tells
+    one eventsforce session from another, or None if there are none"""
+    cookies = session_jar(net_manager).cookiesForUrl(QtCore.QUrl(url))
+    if not cookies:
+        return None
+    return hashlib.sha1('\n'.join(sorted([str(cookie.toRawForm(QtNetwork.QNetworkCookie.NameAndValueOnly)) for cookie in cookies]))).hexdigest()
+
+# While a session is being recorded or replayed (see ef.netrecord),
+# every request goes through this
+session_archive = None
+
+def qt_send(net_manager, operation, request, data=None, fields=None, file=None):
+    """net_manager.get/head/post the request, unless a session is
+    being recorded or replayed. fields and file are what's being
+    posted, for the recording."""
+    if session_archive is not None:
+        return session_archive.send(net_manager, operation, request, data, fields, file)
+    return qt_send_direct(net_manager, operation, request, data)
+
+def qt_send_direct(net_manager, operation, request, data=None):
+    if operation == 'GET':
+        return net_manager.get(request)
+    elif operation == 'HEAD':
+        return net_manager.head(request)
+    else:
+        return net_manager.post(request, data)
+
+def reply_manager(reply):
+    """The network manager a reply came from. Recorded and replayed
+    replies say which one they stand in for."""
+    net_manager = getattr(reply, 'net_manager', None)
+    if net_manager is not None:
+        return net_manager
+    return reply.manager()
+
+def qt_form_post(url, fields, file=None, net_manager=None):
     #print "Post", url
+    if net_manager is None:
+        net_manager = manager
     request = QtNetwork.QNetworkRequest(QtCore.QUrl(url))
     if file is None:
         request.setHeader(QtNetwork.QNetworkRequest.ContentTypeHeader, 'application/x-www-form-urlencoded; charset=utf-8')
-        reply = manager.post(request, encode_form_fields(fields))
+        reply = qt_send(net_manager, 'POST', request, encode_form_fields(fields), fields)
     else:
         multipart = QtNetwork.QHttpMultiPart(QtNetwork.QHttpMultiPart.FormDataType)
         for name, value in fields.iteritems():
@@ -151,15 +378,28 @@ def qt_form_post(url, fields, file=None):
         filepart.setHeader(QtNetwork.QNetworkRequest.ContentDispositionHeader, 'form-data; name="%s"; filename="%s"' % (file['name'], file['filename']))
         filepart.setBodyDevice(file['device'])
         multipart.append(filepart)
-        reply = manager.post(request, multipart)
+        reply = qt_send(net_manager, 'POST', request, multipart, fields, file)
         # Hook multipart to the reply so that it sticks around for the lifetime of the request
         multipart.setParent(reply)
     return reply
 
-def qt_page_get(url):
-    #print "Get", url
+def qt_request(url, headers={}):
     request = QtNetwork.QNetworkRequest(QtCore.QUrl(url))
-    reply = manager.get(request)
+    for name, value in headers.iteritems():
+        request.setRawHeader(name, value)
+    return request
+
+def qt_page_get(url, headers={}, net_manager=None):
+    #print "Get", url
+    if net_manager is None:
+        net_manager = manager
+    reply = qt_send(net_manager, 'GET', qt_request(url, headers))
+    return reply
+
+def qt_page_head(url, headers={}, net_manager=None):
+    if net_manager is None:
+        net_manager = manager
+    reply = qt_send(net_manager, 'HEAD', qt_request(url, headers))
     return reply
 
 def qt_reply_charset(reply):
@@ -0,0 +1,178 @@
+"""Running statistics about our requests to eventsforce: how long they
+take (waiting for the scheduler, to the first response headers, and in
+total), what status they end with, how many redirects they go through,
+the bytes sent and received, and how long the pages take to parse.
+
+Requests are grouped by endpoint (see endpoints), and only the most
+recent window of them is kept for the timings, so that the numbers
+reflect how the server is doing now. Counts and byte totals cover the
+whole run.
+
+Qt doesn't tell us how long DNS lookups or connecting took, so time to
+first byte includes them."""
+
+import re
+import json
+import time
+import threading
+from collections import deque
+
+# The first pattern to match a request's URL decides its endpoint.
+# Uploads (posts with a file) are told apart by whoever makes them.
+endpoints = [
+    ('login', re.compile(r'/login\.csp', re.I)),
+    ('codEditMain', re.compile(r'/codEditMain\.csp', re.I)),
+    ('dynaRepRun', re.compile(r'/dynaRep\w*\.csp', re.I)),
+    ('photos', re.compile(r'/media/', re.I)),
+    ]
+upload_endpoint = 'uploads'
+other_endpoint = 'other'
+
+# Timings are kept for this many of each endpoint's latest requests
+window = 500
+
+# Upper bounds (in seconds) of the histogram buckets
+buckets = [0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120]
+
+timings = ['queued', 'ttfb', 'total']
+
+def classify(url):
+    """Endpoint name for a URL (a QUrl or a string)"""
+    if not isinstance(url, basestring):
+        url = unicode(url.toString())
+    for name, pattern in endpoints:
+        if pattern.search(url):
+            return name
+    return other_endpoint
+
+def percentile(values, p):
+    # values must be sorted
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def histogram(values):
+    counts = [0] * (len(buckets) + 1)
+    for value in values:
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i = i + 1
+        counts[i] = counts[i] + 1
+    return counts
+
+class EndpointStats(object):
+    def __init__(self):
+        self.samples = deque(maxlen=window)
+        self.parses = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.statuses = {}
+        self.redirects = 0
+
+    def add(self, sample):
+        self.samples.append(sample)
+        self.requests = self.requests + 1
+        if not sample['ok']:
+            self.errors = self.errors + 1
+        self.bytes_in = self.bytes_in + sample['bytes_in']
+        self.bytes_out = self.bytes_out + sample['bytes_out']
+        status = sample['status']
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.redirects = self.redirects + sample['redirects']
+
+    def summary(self):
+        summary = {'requests': self.requests,
+                   'errors': self.errors,
+                   'bytes_in': self.bytes_in,
+                   'bytes_out': self.bytes_out,
+                   'redirects': self.redirects,
+                   'statuses': dict((str(status), count) for status, count in self.statuses.iteritems()),
+                   'recent': len(self.samples),
+                   }
+        series = dict((name, sorted(s[name] for s in self.samples if s[name] is not None)) for name in timings)
+        series['parse'] = sorted(self.parses)
+        for name, values in series.iteritems():
+            summary[name] = {'p50': percentile(values, 50),
+                             'p95': percentile(values, 95),
+                             'max': values[-1] if values else None,
+                             'histogram': histogram(values),
+                             }
+        return summary
+
+class Metrics(object):
+    """Requests are recorded from the network thread (and parse times
+    from the parse pool), and read from anywhere"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.endpoints = {}
+
+    def stats(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = EndpointStats()
+        return self.endpoints[endpoint]
+
+    def record(self, endpoint, ok, status=None, redirects=0, bytes_in=0, bytes_out=0,
+               queued=None, ttfb=None, total=None):
+        sample = {'ok': ok, 'status': status, 'redirects': redirects,
+                  'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                  'queued': queued, 'ttfb': ttfb, 'total': total,
+                  }
+        with self.lock:
+            self.stats(endpoint).add(sample)
+
+    def record_parse(self, endpoint, seconds):
+        with self.lock:
+            self.stats(endpoint).parses.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {'since': self.started,
+                    'seconds': time.time() - self.started,
+                    'buckets': buckets,
+                    'endpoints': dict((name, stats.summary()) for name, stats in self.endpoints.iteritems()),
+                    }
+
+    def describe(self):
+        snapshot = self.snapshot()
+        lines = ['Last %.0f minutes; timings over the latest %d requests to each endpoint' % (snapshot['seconds'] / 60, window)]
+        for name in sorted(snapshot['endpoints']):
+            summary = snapshot['endpoints'][name]
+            lines.append('')
+            lines.append('%s: %d requests, %d errors, %d redirects, %s in, %s out' %
+                         (name, summary['requests'], summary['errors'], summary['redirects'],
+                          format_bytes(summary['bytes_in']), format_bytes(summary['bytes_out'])))
+            lines.append('  status  %s' % ', '.join('%s: %d' % (status, count) for status, count in sorted(summary['statuses'].iteritems())))
+            for timing in timings + ['parse']:
+                values = summary[timing]
+                if values['p50'] is None:
+                    continue
+                lines.append('  %-7s p50 %6.2fs  p95 %6.2fs  max %6.2fs  %s' %
+                             (timing, values['p50'], values['p95'], values['max'], format_histogram(values['histogram'])))
+        return '\n'.join(lines)
+
+    def dump(self, filename, **extra):
+        """Write snapshot() as JSON, along with anything in extra"""
+        snapshot = self.snapshot()
+        snapshot.update(extra)
+        with open(filename, 'w') as f:
+            json.dump(snapshot, f, indent=2, sort_keys=True)
+
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB']:
+        if n < 1024:
+            return '%d%s' % (n, unit)
+        n = n / 1024.0
+    return '%.1fGB' % n
+
+def format_histogram(counts):
+    labels = ['<%gs' % bound for bound in buckets] + ['more']
+    return ' '.join('%s:%d' % (label, count) for label, count in zip(labels, counts) if count)
+
+metrics = Metrics()
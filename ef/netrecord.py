@@ -0,0 +1,366 @@
+"""Records every request made to eventsforce, with the responses, and
+plays them back later, so that fetches and uploads can be profiled
+against real traffic offline and repeatably.
+
+With EF_RECORD set to a directory, requests are made as usual, and each
+one is appended to requests.jsonl there as it finishes. The entry holds
+the method and URL, the fields posted, the response status and headers,
+and when the headers and the end of the body arrived. Bodies go in
+files of their own, written as they're read. Login fields (scrub_fields) and cookies are
+scrubbed. Uploaded files are recorded only as their name and size.
+
+With EF_REPLAY set to such a directory, nothing goes out. Each request
+is answered from the recording: the first unused response to the same
+request (method, URL and posted fields), failing that to the same
+method and URL; once they're all used, the last of them again. The headers
+and body arrive after the recorded delays, multiplied by
+EF_REPLAY_SCALE (default 1; 0 answers straight away). Anything the
+recording has no answer for fails with ContentNotFoundError.
+
+Replayed sessions don't set cookies, so a replay can't tell that it's
+logged in until it has replayed a login."""
+
+from PyQt4 import QtCore, QtNetwork
+import os
+import sys
+import json
+import time
+import threading
+from ef import netlib
+
+scrub_fields = ['txtUsername', 'txtPassword']
+scrub_headers = ['cookie', 'set-cookie', 'authorization']
+scrubbed = '(scrubbed)'
+
+# Replayed bodies arrive in pieces of this size, spread out over the
+# time the recorded one took
+replay_chunk_size = 65536
+
+# Reply attributes worth keeping
+recorded_attributes = [QtNetwork.QNetworkRequest.HttpStatusCodeAttribute,
+                       QtNetwork.QNetworkRequest.HttpReasonPhraseAttribute,
+                       QtNetwork.QNetworkRequest.RedirectionTargetAttribute,
+                       ]
+
+operations = {'GET': QtNetwork.QNetworkAccessManager.GetOperation,
+              'HEAD': QtNetwork.QNetworkAccessManager.HeadOperation,
+              'POST': QtNetwork.QNetworkAccessManager.PostOperation,
+              }
+
+def scrub(fields):
+    if fields is None:
+        return None
+    return dict((name, scrubbed if name in scrub_fields else unicode(value)) for name, value in fields.iteritems())
+
+def request_headers(request):
+    return dict((str(name), str(request.rawHeader(name))) for name in request.rawHeaderList()
+                if str(name).lower() not in scrub_headers)
+
+def request_key(method, url, fields):
+    return (method, url, json.dumps(fields, sort_keys=True))
+
+class ArchiveReply(QtNetwork.QNetworkReply):
+    """Reply that hands out data from self.buffer, and whatever
+    read_more() comes up with"""
+    def __init__(self, net_manager, operation, request):
+        QtNetwork.QNetworkReply.__init__(self)
+        # See netlib.reply_manager
+        self.net_manager = net_manager
+        self.buffer = ''
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(operations[operation])
+        self.open(QtCore.QIODevice.ReadOnly | QtCore.QIODevice.Unbuffered)
+
+    def isSequential(self):
+        return True
+
+    def read_more(self, maxlen):
+        return ''
+
+    def more_available(self):
+        return 0
+
+    def bytesAvailable(self):
+        return len(self.buffer) + self.more_available() + QtNetwork.QNetworkReply.bytesAvailable(self)
+
+    def readData(self, maxlen):
+        data = self.buffer[:maxlen]
+        self.buffer = self.buffer[maxlen:]
+        if len(data) < maxlen:
+            data = data + self.read_more(maxlen - len(data))
+        return data
+
+    def fail(self, code, message):
+        code = QtNetwork.QNetworkReply.NetworkError(code)
+        self.setError(code, message)
+        self.emit(QtCore.SIGNAL('error(QNetworkReply::NetworkError)'), code)
+
+class RecordingReply(ArchiveReply):
+    """Stands in for a real reply, recording what's read from it"""
+    def __init__(self, recorder, net_manager, reply, entry):
+        ArchiveReply.__init__(self, net_manager, entry['method'], reply.request())
+        self.recorder = recorder
+        self.reply = reply
+        self.entry = entry
+        self.started = time.time()
+        self.body_name, self.body = recorder.open_body()
+        self.length = 0
+        self.real_finished = False
+
+        reply.metaDataChanged.connect(self.handle_metadata)
+        reply.readyRead.connect(self.readyRead)
+        reply.downloadProgress.connect(self.downloadProgress)
+        reply.uploadProgress.connect(self.uploadProgress)
+        reply.finished.connect(self.handle_finished)
+
+    def copy_metadata(self):
+        for name in self.reply.rawHeaderList():
+            self.setRawHeader(name, self.reply.rawHeader(name))
+        for attribute in recorded_attributes:
+            value = self.reply.attribute(attribute)
+            if value.isValid():
+                self.setAttribute(attribute, value)
+
+    def handle_metadata(self):
+        if self.entry['headers_at'] is None:
+            self.entry['headers_at'] = time.time() - self.started
+        self.copy_metadata()
+        self.metaDataChanged.emit()
+
+    def setReadBufferSize(self, size):
+        # It's the real reply's buffer that holds back the socket
+        QtNetwork.QNetworkReply.setReadBufferSize(self, size)
+        self.reply.setReadBufferSize(size)
+
+    def more_available(self):
+        if self.real_finished:
+            return 0
+        return self.reply.bytesAvailable()
+
+    def record(self, data):
+        self.body.write(data)
+        self.length = self.length + len(data)
+
+    def read_more(self, maxlen):
+        if self.real_finished:
+            return ''
+        data = str(self.reply.read(maxlen))
+        self.record(data)
+        return data
+
+    def handle_finished(self):
+        # Whatever the reader hasn't got round to yet
+        data = str(self.reply.readAll())
+        self.record(data)
+        self.buffer = self.buffer + data
+        self.real_finished = True
+        self.body.close()
+
+        self.copy_metadata()
+        entry = self.entry
+        entry['finished_at'] = time.time() - self.started
+        entry['headers'] = [(str(name), str(self.reply.rawHeader(name))) for name in self.reply.rawHeaderList()
+                            if str(name).lower() not in scrub_headers]
+        status, ok = self.reply.attribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute).toInt()
+        entry['status'] = status if ok else None
+        entry['reason'] = unicode(self.reply.attribute(QtNetwork.QNetworkRequest.HttpReasonPhraseAttribute).toString())
+        redirect = self.reply.attribute(QtNetwork.QNetworkRequest.RedirectionTargetAttribute)
+        entry['redirect'] = str(redirect.toUrl().toEncoded()) if redirect.isValid() else None
+        entry['error'] = int(self.reply.error())
+        entry['error_string'] = unicode(self.reply.errorString())
+        # Requests we gave up on (timed out, or no longer wanted) can
+        # only get in the way of a replay
+        if self.reply.error() != QtNetwork.QNetworkReply.OperationCanceledError:
+            self.recorder.save(entry, self.body_name, self.length)
+        else:
+            self.recorder.discard_body(self.body_name)
+
+        self.setFinished(True)
+        if self.reply.error() != QtNetwork.QNetworkReply.NoError:
+            self.fail(self.reply.error(), self.reply.errorString())
+        self.finished.emit()
+
+    def abort(self):
+        if not self.real_finished:
+            self.reply.abort()
+
+class ReplayReply(ArchiveReply):
+    """Plays back a recorded reply"""
+    def __init__(self, net_manager, operation, request, entry, body, scale):
+        ArchiveReply.__init__(self, net_manager, operation, request)
+        self.entry = entry
+        self.body = body
+        self.scale = scale
+        self.aborted = False
+        self.received = 0
+
+        # The rest of the body comes in pieces, spread out until the
+        # recorded end
+        headers_at = (entry.get('headers_at') or 0) * scale
+        finished_at = max(headers_at, (entry.get('finished_at') or 0) * scale)
+        pieces = max(1, (len(body) + replay_chunk_size - 1) // replay_chunk_size)
+        self.interval = (finished_at - headers_at) / pieces
+        QtCore.QTimer.singleShot(int(headers_at * 1000), self.send_metadata)
+
+    def send_metadata(self):
+        if self.aborted:
+            return
+        for name, value in self.entry.get('headers', []):
+            self.setRawHeader(str(name), str(value))
+        if self.entry.get('status') is not None:
+            self.setAttribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute, QtCore.QVariant(self.entry['status']))
+        if self.entry.get('reason'):
+            self.setAttribute(QtNetwork.QNetworkRequest.HttpReasonPhraseAttribute, QtCore.QVariant(self.entry['reason']))
+        if self.entry.get('redirect'):
+            self.setAttribute(QtNetwork.QNetworkRequest.RedirectionTargetAttribute,
+                              QtCore.QVariant(QtCore.QUrl.fromEncoded(self.entry['redirect'])))
+        self.metaDataChanged.emit()
+        self.send_piece()
+
+    def send_piece(self):
+        if self.aborted:
+            return
+        piece = self.body[self.received:self.received + replay_chunk_size]
+        if piece:
+            self.received = self.received + len(piece)
+            self.buffer = self.buffer + piece
+            self.downloadProgress.emit(self.received, len(self.body))
+            self.readyRead.emit()
+        if self.received < len(self.body):
+            QtCore.QTimer.singleShot(int(self.interval * 1000), self.send_piece)
+            return
+        self.setFinished(True)
+        if self.entry.get('error'):
+            self.fail(self.entry['error'], self.entry.get('error_string', ''))
+        self.finished.emit()
+
+    def abort(self):
+        if self.aborted or self.isFinished():
+            return
+        self.aborted = True
+        self.setFinished(True)
+        self.fail(QtNetwork.QNetworkReply.OperationCanceledError, 'Operation canceled')
+        self.finished.emit()
+
+class MissingReply(ArchiveReply):
+    """Answer to a request that isn't in the recording"""
+    def __init__(self, net_manager, operation, request):
+        ArchiveReply.__init__(self, net_manager, operation, request)
+        QtCore.QTimer.singleShot(0, self.send_failure)
+
+    def send_failure(self):
+        self.setFinished(True)
+        self.fail(QtNetwork.QNetworkReply.ContentNotFoundError,
+                  'Not in the recording: %s %s' % (self.operation_name(), self.url().toEncoded()))
+        self.finished.emit()
+
+    def operation_name(self):
+        for name, operation in operations.iteritems():
+            if operation == self.operation():
+                return name
+        return '?'
+
+class Recorder(object):
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.lock = threading.Lock()
+        self.index = open(os.path.join(path, 'requests.jsonl'), 'a')
+        self.count = 0
+
+    def send(self, net_manager, operation, request, data, fields, file):
+        entry = {'method': operation,
+                 'url': str(request.url().toEncoded()),
+                 'request_headers': request_headers(request),
+                 'fields': scrub(fields),
+                 'file': None,
+                 'headers_at': None,
+                 }
+        if file is not None:
+            entry['file'] = {'name': file['name'], 'filename': file['filename'], 'type': file['type'],
+                             'size': file['device'].size()}
+        reply = netlib.qt_send_direct(net_manager, operation, request, data)
+        return RecordingReply(self, net_manager, reply, entry)
+
+    def open_body(self):
+        """(name, file) for the next response body"""
+        with self.lock:
+            self.count = self.count + 1
+            name = '%06d-%d.body' % (self.count, os.getpid())
+        return name, open(os.path.join(self.path, name), 'wb')
+
+    def discard_body(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def save(self, entry, name, length):
+        entry['body'] = name
+        entry['length'] = length
+        with self.lock:
+            self.index.write(json.dumps(entry) + '\n')
+            self.index.flush()
+
+    def close(self):
+        self.index.close()
+
+class Replayer(object):
+    def __init__(self, path, scale=1.0):
+        self.path = path
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.entries = []
+        # request key, or (method, url) -> indexes into entries
+        self.by_request = {}
+        self.by_url = {}
+        self.used = set()
+        with open(os.path.join(path, 'requests.jsonl')) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                i = len(self.entries)
+                self.entries.append(entry)
+                self.by_request.setdefault(request_key(entry['method'], entry['url'], entry['fields']), []).append(i)
+                self.by_url.setdefault((entry['method'], entry['url']), []).append(i)
+
+    def find(self, method, url, fields):
+        with self.lock:
+            for candidates in [self.by_request.get(request_key(method, url, fields)), self.by_url.get((method, url))]:
+                if not candidates:
+                    continue
+                for i in candidates:
+                    if i not in self.used:
+                        self.used.add(i)
+                        return self.entries[i]
+                return self.entries[candidates[-1]]
+        return None
+
+    def send(self, net_manager, operation, request, data, fields, file):
+        entry = self.find(operation, str(request.url().toEncoded()), scrub(fields))
+        if entry is None:
+            return MissingReply(net_manager, operation, request)
+        with open(os.path.join(self.path, entry['body']), 'rb') as f:
+            body = f.read()
+        return ReplayReply(net_manager, operation, request, entry, body, self.scale)
+
+    def close(self):
+        pass
+
+def start_session_archive():
+    """Start recording or replaying, if EF_RECORD or EF_REPLAY says to"""
+    if os.environ.get('EF_REPLAY'):
+        netlib.session_archive = Replayer(os.environ['EF_REPLAY'], float(os.environ.get('EF_REPLAY_SCALE', 1)))
+        print >>sys.stderr, 'Replaying network session from %s' % os.environ['EF_REPLAY']
+    elif os.environ.get('EF_RECORD'):
+        netlib.session_archive = Recorder(os.environ['EF_RECORD'])
+        print >>sys.stderr, 'Recording network session to %s' % os.environ['EF_RECORD']
+    return netlib.session_archive
+
+def stop_session_archive():
+    if netlib.session_archive is not None:
+        netlib.session_archive.close()
+    netlib.session_archive = None
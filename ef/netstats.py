@@ -0,0 +1,53 @@
+from PyQt4 import QtCore, QtGui
+from ef.ui.netstats import Ui_NetStatsDialog
+from ef.netmetrics import metrics
+from ef.scheduler import scheduler
+
+class NetStatsDialog(QtGui.QDialog, Ui_NetStatsDialog):
+    """Shows what the scheduler is doing right now (tasks, and requests
+    running and queued in each priority class), and ef.netmetrics,
+    refreshing every few seconds while open"""
+    refresh_interval = 5000
+
+    def __init__(self, parent=None):
+        super(QtGui.QDialog, self).__init__(parent)
+        self.setupUi(self)
+
+        self.savestats = QtGui.QFileDialog(self, 'Save network statistics')
+        self.savestats.setFileMode(QtGui.QFileDialog.AnyFile)
+        self.savestats.setAcceptMode(QtGui.QFileDialog.AcceptSave)
+        self.savestats.setNameFilter('*.json')
+        self.savestats.setDefaultSuffix('json')
+        self.savestats.restoreState(QtCore.QSettings().value('savestats-state', '').toByteArray())
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(self.refresh_interval)
+        self.timer.timeout.connect(self.refresh)
+
+        self.stats_refresh.clicked.connect(self.refresh)
+        self.stats_reset.clicked.connect(self.handle_reset)
+        self.stats_save.clicked.connect(self.handle_save)
+        self.finished.connect(lambda result: self.timer.stop())
+
+    def show(self):
+        self.refresh()
+        self.timer.start()
+        QtGui.QDialog.show(self)
+        self.raise_()
+
+    def refresh(self):
+        self.stats_text.setPlainText(scheduler.describe() + '\n\n' + metrics.describe())
+
+    def handle_reset(self):
+        metrics.reset()
+        self.refresh()
+
+    def handle_save(self):
+        if not self.savestats.exec_():
+            return
+        QtCore.QSettings().setValue('savestats-state', self.savestats.saveState())
+        filenames = self.savestats.selectedFiles()
+        try:
+            metrics.dump(unicode(filenames[0]), scheduler=scheduler.snapshot())
+        except (IOError, OSError), e:
+            QtGui.QMessageBox.information(self, 'Failed to save network statistics', str(e))
@@ -1,47 +1,236 @@
 from ef.task import TaskOp, Task
 from PyQt4 import QtCore, QtNetwork
-from ef.netlib import split_header_words, qt_page_get, qt_form_post
+from ef.netlib import split_header_words, qt_page_get, qt_page_head, qt_form_post, reply_manager
+from ef.scheduler import scheduler, NetRequest
+from ef.netmetrics import metrics, classify, upload_endpoint
 from bs4 import BeautifulSoup
+from lxml.html import HtmlElement
+from ef import scrape
 import re
+import time
+import random
+import hashlib
+from ef.lib import LRUCache
 
 class NetworkError(Exception):
-    def __init__(self, value):
+    # transient errors (timeouts, failures to connect, server errors)
+    # are worth retrying; others (404 and the like) aren't
+    def __init__(self, value, transient=False):
         self.value = value
+        self.transient = transient
     def __str__(self):
         return self.value
 
 class NetworkTimeout(NetworkError):
     def __init__(self, url):
-        NetworkError.__init__(self, 'Network operation timed out for %s' % url.toEncoded())
+        NetworkError.__init__(self, 'Network operation timed out for %s' % url.toEncoded(), transient=True)
+
+# Requests with timeout=auto_timeout get one based on how long requests
+# to the same host have been taking, the way TCP times retransmits,
+# within these bounds
+auto_timeout = 'auto'
+default_timeout = 30
+min_timeout = 15
+max_timeout = 120
+
+class LatencyTracker(object):
+    """Smoothed time taken by requests to each host, and its variation"""
+    def __init__(self):
+        self.hosts = {}
+
+    def add(self, host, seconds):
+        if host not in self.hosts:
+            self.hosts[host] = (seconds, seconds / 2)
+            return
+        srtt, rttvar = self.hosts[host]
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - seconds)
+        srtt = 0.875 * srtt + 0.125 * seconds
+        self.hosts[host] = (srtt, rttvar)
+
+    def timed_out(self, host, timeout):
+        # Back off, so that a server which has got slower doesn't time
+        # out every request from now on
+        self.add(host, 2 * timeout)
+
+    def timeout(self, host):
+        if host not in self.hosts:
+            return default_timeout
+        srtt, rttvar = self.hosts[host]
+        return max(min_timeout, min(max_timeout, srtt + 4 * rttvar))
+
+latency = LatencyTracker()
+
+# Transient failures of requests that are safe to repeat are retried
+# this many times, after an exponentially growing delay
+retry_limit = 3
+retry_delay = 2
+retry_max_delay = 60
+
+def backoff_delay(attempt, delay=retry_delay, max_delay=retry_max_delay):
+    """Seconds to wait before retry number attempt (counting from 1),
+    with jitter so that retries from lots of tasks don't bunch up"""
+    delay = min(max_delay, delay * 2 ** (attempt - 1))
+    return random.uniform(delay / 2.0, delay)
 
 class QNetworkReplyOp(TaskOp):
-    def __init__(self, reply, timeout=None, redirecter=None):
+    """Waits for a QNetworkReply. Given a NetRequest rather than a
+    reply, the request is queued with the scheduler and only made (and
+    timed) once it's allowed to go.
+
+    endpoint is what to file the request under in ef.netmetrics, if
+    not the one its URL suggests."""
+    def __init__(self, reply, timeout=None, redirecter=None, endpoint=None):
         super(QNetworkReplyOp, self).__init__()
 
-        self.reply = reply
-        if timeout is not None:
-            self.timer = QtCore.QTimer(self)
-            self.timer.setInterval(timeout * 1000)
-            self.timer.setSingleShot(True)
-            self.timer.timeout.connect(self.handle_timeout)
-            self.timer.start()
+        self.reply = None
+        self.request = None
+        self.timeout = timeout
+        self.timer = None
         self.redirected_to = None
-        self.reply.finished.connect(self.handle_finished)
         self.finish_processed = False
+        self.started_callbacks = []
+        self.scheduled = False
+        self.queued_at = None
+        self.started_at = None
+        self.bytes_read = 0
+        self.parse_time = None
+        self.endpoint = endpoint
+        self.headers_at = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.recorded = False
+        self.is_redirect = redirecter is not None
 
         if redirecter is not None:
             self._finished.connect(redirecter.finish)
             self._exception.connect(redirecter.rethrow)
 
+        if isinstance(reply, NetRequest):
+            self.request = reply
+            self.queued_at = time.time()
+            self.scheduled = True
+            scheduler.enqueue(self)
+        else:
+            self.start_reply(reply)
+
     def __str__(self):
+        if self.reply is None:
+            return 'QNetworkReply(%s, queued)' % self.request.url.toEncoded()
         return 'QNetworkReply(%s)' % self.reply.url().toEncoded()
 
+    def start_request(self):
+        if self.finish_processed:
+            self.release()
+            return
+        self.start_reply(self.request.make())
+
+    def start_reply(self, reply):
+        self.reply = reply
+        self.started_at = time.time()
+        timeout = self.timeout
+        if timeout is auto_timeout:
+            timeout = latency.timeout(self.host())
+        if timeout is not None:
+            self.timer = QtCore.QTimer(self)
+            self.timer.setInterval(int(timeout * 1000))
+            self.timer.setSingleShot(True)
+            self.timer.timeout.connect(self.handle_timeout)
+            self.timer.start()
+        self.reply.finished.connect(self.handle_finished)
+        self.reply.metaDataChanged.connect(self.handle_metadata)
+        self.reply.downloadProgress.connect(self.handle_download_progress)
+        self.reply.uploadProgress.connect(self.handle_upload_progress)
+        callbacks = self.started_callbacks
+        self.started_callbacks = []
+        for callback in callbacks:
+            callback(self.reply)
+
+    def when_started(self, callback):
+        """Call callback(reply) once the request has been made, which
+        may be straight away"""
+        if self.reply is not None:
+            callback(self.reply)
+        else:
+            self.started_callbacks.append(callback)
+
+    def host(self):
+        if self.request is not None:
+            return self.request.host
+        return unicode(self.reply.url().host()).lower()
+
+    def handle_metadata(self):
+        if self.headers_at is None:
+            self.headers_at = time.time()
+
+    def handle_download_progress(self, received, total):
+        self.bytes_in = received
+
+    def handle_upload_progress(self, sent, total):
+        self.bytes_out = sent
+
+    def endpoint_name(self):
+        if self.endpoint is None:
+            self.endpoint = classify(self.request.url if self.reply is None else self.reply.url())
+        return self.endpoint
+
+    def record(self, ok):
+        # Once for the whole chain of redirects
+        if self.recorded or self.is_redirect or self.started_at is None:
+            return
+        self.recorded = True
+        now = time.time()
+        ops = [self]
+        while ops[-1].redirected_to is not None:
+            ops.append(ops[-1].redirected_to)
+        status = None
+        if ops[-1].reply.isFinished():
+            status = ops[-1].status()
+        metrics.record(self.endpoint_name(), ok, status=status, redirects=len(ops) - 1,
+                       bytes_in=sum(op.bytes_in for op in ops),
+                       bytes_out=sum(op.bytes_out for op in ops),
+                       queued=self.started_at - self.queued_at if self.queued_at is not None else None,
+                       ttfb=self.headers_at - self.started_at if self.headers_at is not None else None,
+                       total=now - self.started_at)
+
+    def record_parse(self, start):
+        self.parse_time = time.time() - start
+        metrics.record_parse(self.endpoint_name(), self.parse_time)
+
+    def release(self, ok=None):
+        # Let the scheduler start something else, and tell it (and the
+        # latency tracker) how the request went: ok is None if it
+        # didn't get to finish
+        if ok is not None:
+            self.record(ok)
+        if self.scheduled:
+            self.scheduled = False
+            if ok and self.timeout is auto_timeout and self.started_at is not None:
+                latency.add(self.host(), time.time() - self.started_at)
+            scheduler.done(self, ok)
+
     def resolve_url(self, relative_url):
         if self.redirected_to is not None:
             return self.redirected_to.resolve_url(relative_url)
+        elif self.reply is None:
+            return self.request.url.resolved(QtCore.QUrl(relative_url))
         else:
             return self.reply.url().resolved(QtCore.QUrl(relative_url))
 
+    def status(self):
+        if self.redirected_to is not None:
+            return self.redirected_to.status()
+        status, ok = self.reply.attribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute).toInt()
+        if not ok:
+            return None
+        return status
+
+    def raw_header(self, name):
+        if self.redirected_to is not None:
+            return self.redirected_to.raw_header(name)
+        if not self.reply.hasRawHeader(name):
+            return None
+        return str(self.reply.rawHeader(name))
+
     def charset(self):
         content_type = self.reply.header(QtNetwork.QNetworkRequest.ContentTypeHeader)
         if not content_type.isValid():
@@ -54,6 +243,7 @@ class QNetworkReplyOp(TaskOp):
 
     def readall_charset(self):
         data = str(self.reply.readAll())
+        self.bytes_read = self.bytes_read + len(data)
         charset = self.charset()
         if charset is not None:
             data = data.decode(charset)
@@ -71,13 +261,21 @@ class QNetworkReplyOp(TaskOp):
         self.finish_processed = True
 
         if self.reply.error() != QtNetwork.QNetworkReply.NoError:
-            self.throw(NetworkError(self.reply.errorString()))
+            status = self.status()
+            self.throw(NetworkError(self.reply.errorString(), transient=status is None or status >= 500))
             return
 
         redirect = self.reply.attribute(QtNetwork.QNetworkRequest.RedirectionTargetAttribute)
         if redirect.isValid():
             url = self.resolve_url(redirect.toString())
-            reply = self.reply.manager().get(QtNetwork.QNetworkRequest(url))
+            # Carry the original headers over, so conditional requests
+            # stay conditional when they get redirected
+            original = self.reply.request()
+            headers = dict((str(name), str(original.rawHeader(name))) for name in original.rawHeaderList())
+            if self.reply.operation() == QtNetwork.QNetworkAccessManager.HeadOperation:
+                reply = qt_page_head(url, headers, net_manager=reply_manager(self.reply))
+            else:
+                reply = qt_page_get(url, headers, net_manager=reply_manager(self.reply))
             # Note that redirects will be timed out by the calling
             # class, which will abort the whole chain. This handles
             # loops neatly.
@@ -86,91 +284,283 @@ class QNetworkReplyOp(TaskOp):
 
         self.finish()
 
+    def finish(self):
+        self.release(True)
+        TaskOp.finish(self)
+
+    def throw(self, e, msg=None, blob={}):
+        self.release(not getattr(e, 'transient', False))
+        TaskOp.throw(self, e, msg, blob)
+
+    def trace_args(self):
+        args = {'url': str(self.request.url.toEncoded()) if self.reply is None else str(self.reply.url().toEncoded()),
+                'bytes': self.bytes_read,
+                }
+        if self.queued_at is not None and self.started_at is not None:
+            args['queued'] = self.started_at - self.queued_at
+        if self.reply is not None and self.reply.isFinished():
+            args['status'] = self.status()
+        if self.redirected_to is not None:
+            args['redirected'] = self.redirected_to.trace_args()
+        if self.parse_time is not None:
+            args['parse'] = self.parse_time
+        return args
+
     def handle_timeout(self):
         if self.finish_processed:
             return
+        if self.timeout is auto_timeout:
+            latency.timed_out(self.host(), self.timer.interval() / 1000.0)
+        self.finish_processed = True
         self.throw(NetworkTimeout(self.reply.url()))
+        # Don't leave it holding a connection
+        if not self.reply.isFinished():
+            self.reply.abort()
+
+    # For readers which deliberately stop reading for a while, so that
+    # the time spent waiting on them doesn't count
+    def pause_timeout(self):
+        if self.timer is not None:
+            self.timer.stop()
+
+    def resume_timeout(self):
+        if self.timer is not None and not self.finish_processed:
+            self.timer.start()
 
     def abort(self):
         self.finish_processed = True
-        if not self.reply.isFinished():
+        self.release()
+        if self.reply is not None and not self.reply.isFinished():
             self.reply.abort()
         if self.redirected_to is not None:
             self.redirected_to.abort()
 
+# Parsed pages, keyed by a hash of the page and the strainer used, so
+# that identical pages (eventsforce serves plenty of them while
+# walking through forms) only get parsed once
+parse_cache = LRUCache(size_limit=16)
+
+# If this is set, HTMLOp hands parsing to it rather than doing it in
+# the thread that the reply arrives in
+parse_pool = None
+
+def start_parse_pool(threads=2):
+    global parse_pool
+    parse_pool = QtCore.QThreadPool()
+    parse_pool.setMaxThreadCount(threads)
+
+def parse_key(data, parse_only):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    strainer = None
+    if parse_only is not None:
+        strainer = repr((parse_only.name, sorted(parse_only.attrs.items()), getattr(parse_only, 'text', None)))
+    return (hashlib.sha1(data).hexdigest(), strainer)
+
+class ParseJob(QtCore.QRunnable):
+    def __init__(self, op, data):
+        QtCore.QRunnable.__init__(self)
+        # Holding the op keeps it alive until we've signalled it
+        self.op = op
+        self.data = data
+
+    def run(self):
+        start = time.time()
+        try:
+            result = BeautifulSoup(self.data, 'lxml', parse_only=self.op.parse_only)
+        except Exception, e:
+            result = e
+        self.op.record_parse(start)
+        self.op.parsed.emit(result)
+        self.op = None
+
 class HTMLOp(QNetworkReplyOp):
+    parsed = QtCore.pyqtSignal(object)
+
     def __init__(self, *args, **kwargs):
         self.parse_only = kwargs.pop('parse_only', None)
         QNetworkReplyOp.__init__(self, *args, **kwargs)
-    
+        self.soup = None
+        self.parsing = False
+        self.aborted = False
+        self.parsed.connect(self.handle_parsed)
+
+    def finish(self):
+        # Parse before letting the task know we're done, so that the
+        # coroutine gets resumed with the finished soup
+        self.release(True)
+        if self.task_done or self.parsing or self.aborted:
+            return
+        data = QNetworkReplyOp.result(self)
+        self.key = parse_key(data, self.parse_only)
+        soup = parse_cache[self.key]
+        if soup is not None:
+            self.soup = soup
+            TaskOp.finish(self)
+        elif parse_pool is None:
+            start = time.time()
+            self.soup = parse_cache[self.key] = BeautifulSoup(data, 'lxml', parse_only=self.parse_only)
+            self.record_parse(start)
+            TaskOp.finish(self)
+        else:
+            self.parsing = True
+            parse_pool.start(ParseJob(self, data))
+
+    def handle_parsed(self, result):
+        self.parsing = False
+        if self.aborted:
+            return
+        if isinstance(result, Exception):
+            self.throw(result)
+            return
+        self.soup = parse_cache[self.key] = result
+        TaskOp.finish(self)
+
+    def abort(self):
+        self.aborted = True
+        QNetworkReplyOp.abort(self)
+
+    def result(self):
+        return self.soup
+
+class TreeOp(QNetworkReplyOp):
+    """Like HTMLOp, but results in an lxml tree for use with ef.scrape,
+    which is much cheaper to build than a soup"""
+    def result(self):
+        data = QNetworkReplyOp.result(self)
+        start = time.time()
+        tree = scrape.parse(data)
+        self.record_parse(start)
+        return tree
+
+class RetryOp(TaskOp):
+    """Runs the op that make_op() makes, and if it fails transiently
+    (see NetworkError), makes another, up to retries times, waiting a
+    little longer each time (see backoff_delay). Stands in for whichever
+    op it ran last, so tasks can use it as they would the op itself.
+
+    Only for requests that are safe to repeat, and which nobody reads
+    from before they finish."""
+
+    def __init__(self, make_op, retries=retry_limit):
+        TaskOp.__init__(self)
+
+        self.make_op = make_op
+        self.retries = retries
+        self.attempt = 0
+        self.op = None
+        self.aborted = False
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.start_op)
+        self.start_op()
+
+    def start_op(self):
+        if self.aborted:
+            return
+        self.attempt = self.attempt + 1
+        self.op = self.make_op()
+        # Tell attempts apart, so that a stray signal from an earlier
+        # one is ignored
+        self.op.set_op_id(self.attempt)
+        self.op._finished.connect(self.handle_op_finished)
+        self.op._exception.connect(self.handle_op_exception)
+
+    def handle_op_finished(self, op_id):
+        if op_id != self.attempt or self.aborted:
+            return
+        self.finish()
+
+    def handle_op_exception(self, e, op_id, blob):
+        if op_id != self.attempt or self.aborted:
+            return
+        if getattr(e, 'transient', False) and self.attempt <= self.retries:
+            self.timer.setInterval(int(backoff_delay(self.attempt) * 1000))
+            self.timer.start()
+            return
+        self.throw(e, blob=blob)
+
+    def abort(self):
+        self.aborted = True
+        self.timer.stop()
+        if self.op is not None:
+            self.op.abort()
+
     def result(self):
-        data = super(HTMLOp, self).result()
-        soup = BeautifulSoup(data, 'lxml', parse_only=self.parse_only)
-        return soup
+        return self.op.result()
+
+    def resolve_url(self, relative_url):
+        return self.op.resolve_url(relative_url)
+
+    def status(self):
+        return self.op.status()
+
+    def raw_header(self, name):
+        return self.op.raw_header(name)
+
+    def trace_args(self):
+        args = self.op.trace_args()
+        args['attempts'] = self.attempt
+        return args
 
 class NetFuncs(object):
-    def __init__(self):
+    # net_manager selects which session (network manager and cookie
+    # jar) requests go through; None means the global one
+    def __init__(self, net_manager=None):
         self.latest_net_op = None
+        self.net_manager = net_manager
 
-    def _net_op(self, f, url, *args, **kwargs):
+    def net_request(self, url, make_reply):
+        """A request to be made once the scheduler has room for it, in
+        this task's priority class"""
+        return NetRequest(url, make_reply, getattr(self, 'priority', None))
+
+    def _net_op(self, url, op_class, make_reply, retries, **kwargs):
+        # op_class(request, **kwargs) for the request make_reply(url)
+        # makes, with retries (see RetryOp)
         if self.latest_net_op is not None:
             url = self.latest_net_op.resolve_url(url)
-        self.latest_net_op = f(url, *args, **kwargs)
+        make_op = lambda: op_class(self.net_request(url, lambda: make_reply(url)), **kwargs)
+        if retries:
+            self.latest_net_op = RetryOp(make_op, retries)
+        else:
+            self.latest_net_op = make_op()
         return self.latest_net_op
 
-    def get(self, url, **kwargs):
-        return self._net_op(lambda url: HTMLOp(qt_page_get(url), **kwargs), url)
-
-    def get_raw(self, url, timeout=30):
-        return self._net_op(lambda url: QNetworkReplyOp(qt_page_get(url), timeout=timeout), url)
-
-    def post(self, url, *args, **kwargs):
-        timeout = kwargs.pop('timeout', 30)
-        parse_only = kwargs.pop('parse_only', None)
-        return self._net_op(lambda url, *args, **kwargs: HTMLOp(qt_form_post(url, *args, **kwargs), timeout=timeout, parse_only=parse_only), url, *args, **kwargs)
-
-    def submit_form(self, form, user_fields={}, file=None, timeout=30, parse_only=None, default_fields={}):
-        fields = {}
-        fields_seen = set()
-        action = form['action']
-
-        for input in form.find_all('input'):
-            if not input.has_key('name'):
-                continue
-            name = input['name']
-            if input.has_key('disabled'):
-                print "Skipping disabled select", name
-                continue
-            fields_seen.add(name)
-            type = input['type'].lower()
-            if type == 'image':
-                fields['%s.x' % name] = '1'
-                fields['%s.y' % name] = '1'
-            elif type == 'button':
-                continue
-            elif type == 'checkbox' or type == 'radio':
-                if input.has_key('checked'):
-                    fields[name] = input['value']
-            elif input.has_key('value'):
-                fields[name] = input['value']
-                #if input['value'] == 'Northern Ireland':
-                #    f = open('tmp.html', 'w')
-                #    soup = list(form.parents)[-2]
-                #    print soup
-                #    f.write(str(soup))
-                #    f.close()
-
-        for select in form.find_all('select'):
-            if not select.has_key('name'):
-                continue
-            name = select['name']
-            if select.has_key('disabled'):
-                print "Skipping disabled select", name
-                continue
-            fields_seen.add(name)
-            selected = filter(lambda o: o.has_key('selected'), select.find_all('option'))
-            if len(selected):
-                fields[name] = selected[0]['value']
+    def get(self, url, retries=retry_limit, **kwargs):
+        return self._net_op(url, HTMLOp, lambda url: qt_page_get(url, net_manager=self.net_manager), retries, **kwargs)
+
+    def get_tree(self, url, timeout=auto_timeout, retries=retry_limit):
+        return self._net_op(url, TreeOp, lambda url: qt_page_get(url, net_manager=self.net_manager), retries, timeout=timeout)
+
+    # Anything that reads the reply as it arrives needs retries=0
+    def get_raw(self, url, timeout=auto_timeout, headers={}, retries=retry_limit):
+        return self._net_op(url, QNetworkReplyOp, lambda url: qt_page_get(url, headers, net_manager=self.net_manager), retries, timeout=timeout)
+
+    def head(self, url, timeout=auto_timeout, headers={}, retries=retry_limit):
+        return self._net_op(url, QNetworkReplyOp, lambda url: qt_page_head(url, headers, net_manager=self.net_manager), retries, timeout=timeout)
+
+    # Posting a form twice isn't safe in general, so posts aren't
+    # retried unless asked
+    def post(self, url, fields, file=None, timeout=auto_timeout, parse_only=None, tree=False, retries=0):
+        make_reply = lambda url: qt_form_post(url, fields, file, net_manager=self.net_manager)
+        # Uploads go to the same pages as everything else
+        endpoint = upload_endpoint if file is not None else None
+        if tree:
+            return self._net_op(url, TreeOp, make_reply, retries, timeout=timeout, endpoint=endpoint)
+        else:
+            return self._net_op(url, HTMLOp, make_reply, retries, timeout=timeout, parse_only=parse_only, endpoint=endpoint)
+
+    def submit_form(self, form, user_fields={}, file=None, timeout=auto_timeout, parse_only=None, default_fields={}, tree=False):
+        action, fields = self.form_submission(form, user_fields, default_fields)
+        return self.post(action, fields, file, timeout=timeout, parse_only=parse_only, tree=tree)
+
+    def form_submission(self, form, user_fields={}, default_fields={}):
+        """The (action, fields) that submit_form would post"""
+        if isinstance(form, HtmlElement):
+            action, fields, fields_seen, scripts = scrape.form_fields(form)
+        else:
+            action, fields, fields_seen, scripts = soup_form_fields(form)
 
         fields_missed = fields_seen - set(fields.keys())
 
@@ -180,8 +570,8 @@ class NetFuncs(object):
                     fields[name] = default_fields[rexp]
 
         # Hideous eventsforce hack: they do this field-disabling mess in javascript
-        for script in form.find_all('script'):
-            m = re.search(r"depends = depends \+ '(.*)'", script.text)
+        for script in scripts:
+            m = re.search(r"depends = depends \+ '(.*)'", script)
             if m:
                 depend_str = m.group(1)
                 m = re.match(r'^(.*)->(.*)->(.*)\|$', depend_str)
@@ -195,4 +585,47 @@ class NetFuncs(object):
         fields.update(user_fields)
         #print [action, fields]
 
-        return self.post(action, fields, file, timeout=timeout, parse_only=parse_only)
+        return action, fields
+
+def soup_form_fields(form):
+    """Collect the fields a browser would submit for this (bs4) form.
+    Returns (action, fields, fields_seen, script_texts)."""
+    fields = {}
+    fields_seen = set()
+    action = form['action']
+
+    for input in form.find_all('input'):
+        if not input.has_key('name'):
+            continue
+        name = input['name']
+        if input.has_key('disabled'):
+            print "Skipping disabled select", name
+            continue
+        fields_seen.add(name)
+        type = input['type'].lower()
+        if type == 'image':
+            fields['%s.x' % name] = '1'
+            fields['%s.y' % name] = '1'
+        elif type == 'button':
+            continue
+        elif type == 'checkbox' or type == 'radio':
+            if input.has_key('checked'):
+                fields[name] = input['value']
+        elif input.has_key('value'):
+            fields[name] = input['value']
+
+    for select in form.find_all('select'):
+        if not select.has_key('name'):
+            continue
+        name = select['name']
+        if select.has_key('disabled'):
+            print "Skipping disabled select", name
+            continue
+        fields_seen.add(name)
+        selected = filter(lambda o: o.has_key('selected'), select.find_all('option'))
+        if len(selected):
+            fields[name] = selected[0]['value']
+
+    scripts = [script.text for script in form.find_all('script')]
+
+    return action, fields, fields_seen, scripts
@@ -1,4 +1,5 @@
-from HTMLParser import HTMLParser
+from lxml import etree
+from itertools import izip
 import sys
 import re
 
@@ -7,117 +8,209 @@ person_fields = set(['Person ID', 'Firstname', 'Lastname', 'Full Name', 'Salutat
                      'EF_Application Status', 'common first name'])
 event_fields = set(['Bookers Firstname', 'Bookers lastname', 'Booking Ref', 'Type of Attendee'])
 
-class EFParser(HTMLParser):
-    current_target = None
-    current_inserter = None
-    keys = None
-    #data = []
-    pos = None
-    records = 0
-    current_string = None
-    
-    def handle_starttag(self, tag, attrs):
-        if tag == 'tr':
-            if self.keys is None:
-                self.keys = []
+def person_record(person):
+    """Person table values for a person collected by EFDelegateParser"""
+    firstname = person['Firstname'] or person['common first name']
+    fullname = filter(lambda x: len(x) > 0, [person['Salutation'].strip(), firstname.strip(), person['Lastname'].strip()])
+    return {'id': person['Person ID'],
+            'firstname': firstname.strip(),
+            'lastname': person['Lastname'].strip(),
+            'title': person['Salutation'].strip(),
+            'fullname': ' '.join(fullname),
+            'police_status': person['EF_Application Status'],
+            }
+
+def registration_record(person, event_id):
+    """Registration table values for one of a person's events"""
+    data = person['events'][event_id]
+    return {'person_id': person['Person ID'],
+            'event_id': event_id,
+            'attendee_type': data['Type of Attendee'],
+            'booking_ref': data['Booking Ref'],
+            'booker_firstname': data['Bookers Firstname'],
+            'booker_lastname': data['Bookers lastname'],
+            }
+
+class EFParser(object):
+    """Streaming reader for eventsforce "Export to Excel" reports, which
+    are one big HTML table. Feed it the report as it arrives; the first
+    row is taken as the column names (passed to handle_header) and every
+    row after that is passed to handle_row as a tuple of cell texts.
+
+    handle_header can set self.wanted to a list of flags, one for each
+    column, and then only the text of the flagged columns is read; the
+    rest come out empty."""
+
+    def __init__(self):
+        self.parser = etree.HTMLPullParser(events=('end',), tag='tr')
+        self.keys = None
+        self.wanted = None
+        self.records = 0
+
+    def feed(self, data):
+        self.parser.feed(data)
+        self.read_rows()
+
+    def close(self):
+        self.parser.close()
+        self.read_rows()
+        self.handle_end()
+
+    def read_rows(self):
+        for event, tr in self.parser.read_events():
+            tds = tr.findall('td')
+            if self.keys is not None and len(tds) > len(self.keys):
+                values = tuple([cell_text(td) for td in tds])
+                raise ValueError('Eventsforce sent corrupted data in report, in record %d. Record: %s' % (self.records + 1, values))
+            if self.wanted is None:
+                values = tuple([cell_text(td) for td in tds])
             else:
-                self.current_target = {}
-                self.pos = 0
-                self.records = self.records + 1
-                #self.data.append(self.current_target)
+                values = tuple([cell_text(td) if wanted else u'' for td, wanted in izip(tds, self.wanted)])
+            # Throw away what we've finished with, or the whole report
+            # ends up in memory as a tree
+            tr.clear()
+            parent = tr.getparent()
+            if parent is not None:
+                while tr.getprevious() is not None:
+                    del parent[0]
+
+            if self.keys is None:
+                self.keys = values
+                self.handle_header(values)
+                continue
 
-            #if len(self.data) % 1000 == 0:
-            #    print >>sys.stderr, "Parsed %d rows" % len(self.data)
+            self.records = self.records + 1
+            self.handle_row(values)
 
-        elif tag == 'td':
-            if self.current_target is None:
-                self.current_inserter = lambda data: self.keys.append(data)
-            else:
-                i = self.pos
-                self.pos = self.pos + 1
-                def inserter(data):
-                    if i >= len(self.keys):
-                        raise ValueError('Eventsforce sent corrupted data in report, in record %d. Record so far: %s' % (self.records, self.current_target))
-                    j = self.keys[i]
-                    self.current_target[j] = data
-                self.current_inserter = inserter
-            self.current_string = ''
-
-    def handle_endtag(self, tag):
-        if tag == 'tr':
-            if self.current_target is not None:
-                self.handle_record(self.current_target)
-            #else:
-            #    print self.keys
-            self.current_target = None
-        elif tag == 'td':
-            if self.current_inserter is not None:
-                self.current_inserter(self.current_string.strip())
-                self.current_inserter = None
-                
-    def handle_data(self, data):
-        if self.current_string is not None:
-            self.current_string = self.current_string + ' ' + data.strip()
+    def handle_header(self, keys):
+        pass
+
+    def handle_row(self, values):
+        self.handle_record(dict(zip(self.keys, values)))
 
     def handle_record(self, record):
         pass
 
+    def handle_end(self):
+        pass
+
+def cell_text(td):
+    if len(td) == 0:
+        # Nearly every cell is plain text, and itertext is comparatively slow
+        text = td.text
+        return text.strip() if text else u''
+    return u' '.join([text.strip() for text in td.itertext() if text.strip()])
+
 class EFDelegateParser(EFParser):
-    people = {}
-    events_map = {}
-    registrations = {}
-    
-    def get_event(self, record):
+    """Collects report rows into people and their registrations, and
+    passes each person to handle_person (followed by handle_registration
+    for each of their events) once all of their rows have been read.
+
+    Reports come out grouped by Person ID, so in streaming mode a person
+    is passed on as soon as a row for somebody else turns up, and then
+    forgotten. Otherwise everybody is kept until close(), and is
+    available from get_people() afterwards."""
+
+    def __init__(self, streaming=False):
+        EFParser.__init__(self)
+        self.streaming = streaming
+        self.people = {}
+        self.events_map = {}
+        self.registrations = {}
+        self.person_count = 0
+        self.current = None
+
+    def handle_end(self):
+        if self.streaming:
+            if self.current is not None:
+                self.finish_person(self.current)
+        else:
+            for person in self.people.itervalues():
+                self.finish_person(person)
+        self.current = None
+
+    def finish_person(self, person):
+        person_id = person['Person ID']
+        self.handle_person(person)
+        for event_id in self.registrations.get(person_id, []):
+            self.handle_registration(person, event_id)
+        if self.streaming:
+            del self.people[person_id]
+            del self.registrations[person_id]
+
+    def handle_header(self, keys):
+        # Work out once which column everything comes from, rather than
+        # building and picking apart a dict for every row. Where a
+        # column name is repeated, the last one wins, as it did when rows
+        # were dicts.
+        columns = dict((key, i) for i, key in enumerate(keys))
+        self.person_id_col = columns.get('Person ID')
+        self.person_cols = [(key, columns[key]) for key in person_fields if key in columns and key != 'Person ID']
+        self.local_party_cols = [i for i, key in enumerate(keys) if re.match(r'^Local Party', key)]
+        self.event_id_col = columns.get('Event ID')
+        self.event_name_col = columns.get('Event Name')
+        self.event_cols = [(key, columns[key]) for key in event_fields if key in columns]
+
+        planned = set([i for key, i in self.person_cols + self.event_cols] + self.local_party_cols)
+        planned.update([i for i in [self.person_id_col, self.event_id_col, self.event_name_col] if i is not None])
+        self.wanted = [i in planned for i in xrange(len(keys))]
+
+    def get_event(self, values):
+        if self.event_id_col is None or self.event_id_col >= len(values):
+            return None
         try:
-            id = int(record.pop('Event ID'))
+            id = int(values[self.event_id_col])
         except ValueError:
             return None
 
-        name = record.pop('Event Name')
         if self.events_map.has_key(id):
             return id
 
+        name = values[self.event_name_col] if self.event_name_col is not None and self.event_name_col < len(values) else None
         self.events_map[id] = name
         self.handle_event(id, name)
         return id
 
-    def handle_record(self, record):
+    def handle_row(self, values):
+        n = len(values)
         try:
-            if record['Person ID'] == '':
+            if values[self.person_id_col] == '':
                 return
-            person_id = record['Person ID'] = int(record['Person ID'])
-        except (KeyError, ValueError):
-            print "Confusing nonsense in person record", record
+            person_id = int(values[self.person_id_col])
+        except (TypeError, IndexError, ValueError):
+            print "Confusing nonsense in person record", values
             return
 
-        person = self.people.setdefault(person_id, {'events': {}})
-
-        for key in person_fields:
-            if key in record:
-                value = record.pop(key)
-                # Suppress duplicates (take the first thing in the report), but prefer non-zero-length values
-                if 0 == len(unicode(person.get(key, ''))):
-                    person[key] = value
-        # Record changes size here, so must not be an iterator...
-        for key in list(record.keys()):
-            if re.match(r'^Local Party', key):
-                if record[key].strip() != '':
-                    person['Local Party'] = record[key]
-                del record[key]
-        self.handle_person(person)
-
-        event_id = self.get_event(record)
+        current = self.current
+        if current is not None and current['Person ID'] != person_id and self.streaming:
+            self.finish_person(current)
+
+        person = self.people.get(person_id)
+        if person is None:
+            person = self.people[person_id] = {'events': {}, 'Person ID': person_id}
+            self.registrations[person_id] = []
+            self.person_count = self.person_count + 1
+        self.current = person
+
+        for key, i in self.person_cols:
+            # Suppress duplicates (take the first thing in the report), but prefer non-zero-length values
+            if i < n and not person.get(key):
+                person[key] = values[i]
+        for i in self.local_party_cols:
+            if i < n and values[i] != '':
+                person['Local Party'] = values[i]
+
+        event_id = self.get_event(values)
         if event_id is None:
             return
-        events = person['events']
-        event = events.setdefault(event_id, {})
-        for key in event_fields:
+        event = person['events'].get(event_id)
+        if event is None:
+            event = person['events'][event_id] = {}
+            self.registrations[person_id].append(event_id)
+        for key, i in self.event_cols:
             # Take the first thing in the report, but prefer non-zero-length values
-            if record.has_key(key) and 0 == len(unicode(event.get(key, ''))):
-                event[key] = record[key]
-
-        self.handle_registration(person, event_id)
-        self.registrations.setdefault(person_id, []).append(event_id)
+            if i < n and not event.get(key):
+                event[key] = values[i]
 
     def handle_person(self, person):
         pass
@@ -136,5 +229,5 @@ class EFDelegateParser(EFParser):
 
 class EFDelegateProgressParser(EFDelegateParser):
     def handle_person(self, person):
-        if len(self.people) % 1000 == 0:
-            print >>sys.stderr, "Parsed %d people" % len(self.people)
+        if self.person_count % 1000 == 0:
+            print >>sys.stderr, "Parsed %d people" % self.person_count
@@ -1,40 +1,146 @@
 from PyQt4 import QtCore, QtGui
+from ef.threads import thread_registry
 from ef.nettask import NetFuncs
-from ef.task import Task
-from ef.db import Photo
+from ef.task import Task, BoundedMapOp, TaskCancelled
+from ef.scheduler import scheduler
+from ef.db import Photo, Person
 from collections import OrderedDict
 import os
 import sys
+import time
 from PIL import Image
 from StringIO import StringIO
 
 class PhotoDownload(Task, NetFuncs):
-    def __init__(self, id, url, filename):
+    def __init__(self, id, url, filename, validators=None):
         Task.__init__(self)
         NetFuncs.__init__(self)
 
         self.id = id
         self.url = url
         self.filename = filename
+        self.validators = validators
+        self.data = None
+
+    def revalidation(self):
+        """Work out how to check whether our copy on disk is still
+        current. Returns 'conditional' (for a conditional GET), 'head'
+        (compare sizes with a HEAD request) or None (just download
+        it)."""
+        # Only revalidate if we have a copy on disk that looks like
+        # the one the validators describe - otherwise a 304 would
+        # leave us with a broken file forever
+        if not self.validators or not os.path.exists(self.filename):
+            return None
+        content_length = self.validators.get('content_length')
+        if content_length and os.path.getsize(self.filename) != content_length:
+            return None
+
+        if self.validators.get('etag') or self.validators.get('last_modified'):
+            return 'conditional'
+        if content_length:
+            return 'head'
+        return None
+
+    def conditional_headers(self):
+        headers = {}
+        if self.validators.get('etag'):
+            headers['If-None-Match'] = self.validators['etag']
+        if self.validators.get('last_modified'):
+            headers['If-Modified-Since'] = self.validators['last_modified']
+        return headers
+
+    def not_modified(self):
+        Photo.upsert({'id': self.id, 'date_fetched': time.time()})
 
     def task(self):
         url = QtCore.QUrl.fromEncoded(self.url)
-        self.data = yield self.get_raw(url)
+        mode = self.revalidation()
+
+        if mode == 'head':
+            yield self.head(url)
+            length = self.current.raw_header('Content-Length')
+            if length is not None and int(length) == self.validators['content_length']:
+                self.not_modified()
+                return
+
+        headers = {}
+        if mode == 'conditional':
+            headers = self.conditional_headers()
+        data = yield self.get_raw(url, headers=headers)
+
+        if self.current.status() == 304:
+            self.not_modified()
+            return
 
         # Collecting the size here has the neat side-effect that we'll
         # throw an exception if the data isn't a valid image, so we
         # won't write complete junk (like an HTML error message) to
         # the cache
-        buf = StringIO(str(self.data))
+        buf = StringIO(str(data))
         image = Image.open(buf).convert('RGBA')
         width, height = image.size
-        Photo.upsert({'id': self.id, 'width': width, 'height': height})
+        self.data = data
+        Photo.upsert({'id': self.id,
+                      'width': width,
+                      'height': height,
+                      'etag': self.current.raw_header('ETag'),
+                      'last_modified': self.current.raw_header('Last-Modified'),
+                      'content_length': len(data),
+                      'date_fetched': time.time(),
+                      })
 
     def write_file(self):
+        if self.data is None:
+            return
         f = open(self.filename, 'wb')
         f.write(self.data)
         f.close()
 
+# How many photos PrefetchPhotosTask downloads at once
+prefetch_concurrency = 4
+
+class PrefetchPhotosTask(Task):
+    """Downloads the current photo of everybody whose photo isn't in
+    the cache yet, so that it's there before anybody looks"""
+    progress = QtCore.pyqtSignal(str, int, int)
+
+    def __init__(self):
+        Task.__init__(self)
+
+        self.photos = []
+        self.downloaded = 0
+        self.failed = 0
+
+    def task(self):
+        for person in Person.all():
+            if person.current_photo_id is None:
+                continue
+            photo = Photo.get(id=person.current_photo_id)
+            if photo.url is None or photo.load_failed or photo.full_path() is None:
+                continue
+            if os.path.exists(photo.full_path()):
+                continue
+            self.photos.append(photo)
+
+        def make_task(photo):
+            return self.subtask(PhotoDownload(photo.id, photo.url, photo.full_path()))
+
+        self.progress.emit('Downloading photos', 0, len(self.photos))
+        try:
+            yield BoundedMapOp(make_task, self.photos, prefetch_concurrency, self.handle_download, fail_fast=False)
+        except TaskCancelled:
+            raise
+        except Exception:
+            # Photos which failed just get tried again next time
+            pass
+        self.failed = len(self.photos) - self.downloaded
+
+    def handle_download(self, i, download):
+        download.write_file()
+        self.downloaded = self.downloaded + 1
+        self.progress.emit('Downloading photos', i + 1, len(self.photos))
+
 class PhotoDownloadWorker(QtCore.QObject):
     ready = QtCore.pyqtSignal(int)
     error = QtCore.pyqtSignal(int, str)
@@ -67,7 +173,7 @@ class PhotoDownloadWorker(QtCore.QObject):
             return
 
         queue = self.queue['background' if background else 'normal']
-        queue[id] = {'id': id, 'url': location['url'], 'filename': location['filename']}
+        queue[id] = {'id': id, 'url': location['url'], 'filename': location['filename'], 'validators': location.get('validators')}
         if urgent:
             self.queue['urgent'] = id
 
@@ -84,22 +190,28 @@ class PhotoDownloadWorker(QtCore.QObject):
             return
 
         item = None
+        # Photos somebody is waiting to see go ahead of bulk work;
+        # revalidation and prefetching only use what's left over
+        priority = 'interactive'
         if self.queue['urgent'] is not None:
             id = self.queue['urgent']
             item = self.queue['normal'].pop(id, None)
             self.queue['urgent'] = None
         if item is None:
-            for queue in [self.queue['normal'], self.queue['background']]:
+            for name in ['normal', 'background']:
+                queue = self.queue[name]
                 if queue:
                     id, item = queue.popitem(last=False)
+                    if name == 'background':
+                        priority = 'background'
                     break
         if item is None:
             return
 
-        self.current_task = PhotoDownload(item['id'], item['url'], item['filename'])
+        self.current_task = PhotoDownload(item['id'], item['url'], item['filename'], item['validators'])
         self.current_task.task_finished.connect(self.handle_task_finished)
         self.current_task.task_exception.connect(self.handle_task_exception)
-        self.current_task.start_task()
+        scheduler.submit(self.current_task, priority)
 
     def cleanup_task(self):
         # Hold GC for one pass
@@ -134,7 +246,7 @@ class PhotoDownloader(QtCore.QObject):
         super(QtCore.QObject, self).__init__()
         
         self.downloader = PhotoDownloadWorker()
-        #self.downloader.moveToThread(thread_registry.get('network'))
+        self.downloader.moveToThread(thread_registry.get('network'))
 
         self.sig_download_photo.connect(self.downloader.download_photo)
 
@@ -146,7 +258,24 @@ class PhotoDownloader(QtCore.QObject):
         self.latest_queue_size = None
         
     def download_photo(self, id, url, filename, refresh=False, urgent=False, background=False, refresh_size=False):
-        self.sig_download_photo.emit(id, {'url': url, 'filename': filename}, refresh, urgent, background, refresh_size)
+        location = {'url': url, 'filename': filename}
+        if refresh:
+            location['validators'] = Photo.get(id=id).validators()
+        self.sig_download_photo.emit(id, location, refresh, urgent, background, refresh_size)
+
+    def verify_photos(self, photos):
+        """Revalidate the cached copies of these photos in the
+        background. Unchanged photos only cost a round trip for the
+        headers."""
+        count = 0
+        for photo in photos:
+            if photo.url is None or photo.full_path() is None:
+                continue
+            if not os.path.exists(photo.full_path()):
+                continue
+            self.download_photo(photo.id, photo.url, photo.full_path(), refresh=True, background=True)
+            count = count + 1
+        return count
 
     def update_queue_size(self, size):
         self.latest_queue_size = size
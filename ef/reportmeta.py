@@ -0,0 +1,107 @@
+"""Remembers what we learn from a report's parameters page on
+eventsforce (the form to submit, which criteria are which, and the list
+of events), so that running a report or opening the fetch wizard
+doesn't have to fetch and scrape the page every time.
+
+Kept in QSettings, for up to report_meta_ttl seconds. Anything that
+finds the cached form no longer works should invalidate it.
+
+The form's hidden fields may belong to the session it was fetched in,
+so a cached form is only posted from that same session; the other
+session just fetches it afresh."""
+
+from PyQt4 import QtCore
+import json
+import time
+from ef.nettask import NetFuncs
+from ef.netlib import ef_url, session_id
+from ef.task import Task
+from ef import scrape
+
+report_meta_ttl = 6 * 60 * 60
+
+class ReportFormError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return self.msg
+
+def report_url(profile):
+    return ef_url('/libdems/backend/home/dynaRepRun.csp?profileID=%d' % profile)
+
+def settings_key(profile):
+    return 'report-meta-%d' % profile
+
+def load_report_meta(profile):
+    value = QtCore.QSettings().value(settings_key(profile))
+    if not value.isValid():
+        return None
+    try:
+        meta = json.loads(unicode(value.toString()))
+    except ValueError:
+        return None
+    if meta.get('fetched_at', 0) + report_meta_ttl < time.time():
+        return None
+    return meta
+
+def save_report_meta(profile, meta):
+    meta = dict(meta, fetched_at=time.time())
+    QtCore.QSettings().setValue(settings_key(profile), json.dumps(meta))
+
+def invalidate_report_meta(profile):
+    QtCore.QSettings().remove(settings_key(profile))
+
+class ReportFormTask(Task, NetFuncs):
+    """Gets the metadata for a report, from the cache if possible. Once
+    finished, self.meta has:
+
+    action, fields: what to post to run the report, before filling in
+      any criteria
+    criteria: map of criterion description to id
+    choices: (text, value) options of the first criterion, which for
+      the reports we use is the list of events
+
+    Unless for_post is False, a form cached in another session isn't
+    used."""
+
+    def __init__(self, profile, force=False, for_post=True):
+        Task.__init__(self)
+        NetFuncs.__init__(self)
+
+        self.profile = profile
+        self.force = force
+        self.for_post = for_post
+        self.meta = None
+        self.cached = False
+
+    def task(self):
+        if not self.force:
+            meta = load_report_meta(self.profile)
+            if meta is not None and (not self.for_post or meta.get('session') == self.session()):
+                self.meta = meta
+                self.cached = True
+                return
+
+        tree = yield self.get_tree(report_url(self.profile), timeout=None)
+
+        form = scrape.first_form(tree)
+        if form is None:
+            invalidate_report_meta(self.profile)
+            raise ReportFormError("Failed to parse form from eventsforce (no form for report %d)" % self.profile)
+        action, fields = self.form_submission(form)
+
+        criteria = scrape.report_criteria(tree)
+        if not criteria:
+            invalidate_report_meta(self.profile)
+            raise ReportFormError("Failed to parse form from eventsforce (no criteria for report %d)" % self.profile)
+
+        self.meta = {'action': str(self.latest_net_op.resolve_url(action).toEncoded()),
+                     'fields': fields,
+                     'criteria': criteria,
+                     'choices': scrape.report_choices(tree) or [],
+                     'session': self.session(),
+                     }
+        save_report_meta(self.profile, self.meta)
+
+    def session(self):
+        return session_id(report_url(self.profile), self.net_manager)
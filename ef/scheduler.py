@@ -0,0 +1,257 @@
+"""Decides when network requests actually go out, so that everything
+sharing the network (fetching, uploading, photo downloads, logging in)
+gets a fair turn.
+
+Tasks are submitted with a priority class, which their subtasks and
+network requests inherit. Requests are made in priority order, with a
+limit on how many are in flight at once, overall and to any one host;
+background work is further limited so that it always leaves room for
+the rest.
+
+If too many recent requests to a host have failed, its circuit breaker
+trips: for a cooldown period only interactive requests go to it, then a
+single request is let through to see whether it has recovered. Failing
+again doubles the cooldown. That way a struggling server isn't buried
+under retries from every bulk task at once.
+
+The scheduler is used from the network thread, apart from snapshot()
+which can be called from anywhere."""
+
+from PyQt4 import QtCore
+from collections import deque
+import threading
+import weakref
+import time
+import sys
+
+priorities = ['interactive', 'bulk', 'background']
+default_priority = 'bulk'
+
+# Requests in flight at once, overall and to any one host
+max_requests = 8
+max_host_requests = 6
+
+# Most requests one priority class may have in flight
+class_limits = {'background': 2}
+
+# The breaker trips once at least breaker_error_rate of the last
+# breaker_window requests to a host (and breaker_min_samples of them)
+# have failed, and stays open for breaker_cooldown seconds, up to
+# breaker_max_cooldown
+breaker_window = 20
+breaker_min_samples = 8
+breaker_error_rate = 0.5
+breaker_cooldown = 30
+breaker_max_cooldown = 300
+
+class Breaker(object):
+    """Circuit breaker for one host. state is 'closed' (all requests
+    go), 'open' (only interactive ones do) or 'half-open' (one other
+    request at a time goes, to try the host out)."""
+    def __init__(self):
+        self.outcomes = deque(maxlen=breaker_window)
+        self.state = 'closed'
+        self.cooldown = breaker_cooldown
+        self.opened_at = None
+        self.trial = None
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1.0 - sum(self.outcomes) / float(len(self.outcomes))
+
+    def record(self, ok, trial):
+        """Returns the seconds to wait if this has tripped the breaker"""
+        self.outcomes.append(1 if ok else 0)
+        if trial:
+            self.trial = None
+            if ok:
+                self.state = 'closed'
+                self.cooldown = breaker_cooldown
+                self.outcomes.clear()
+                return None
+            self.cooldown = min(breaker_max_cooldown, self.cooldown * 2)
+            return self.trip()
+        if self.state == 'closed' and len(self.outcomes) >= breaker_min_samples and self.error_rate() >= breaker_error_rate:
+            return self.trip()
+        return None
+
+    def trip(self):
+        self.state = 'open'
+        self.opened_at = time.time()
+        return self.cooldown
+
+    def allows(self, op):
+        if self.state == 'closed' or op.request.priority == 'interactive':
+            return True
+        if self.state == 'open' and time.time() - self.opened_at >= self.cooldown:
+            self.state = 'half-open'
+        return self.state == 'half-open' and self.trial is None
+
+class NetRequest(object):
+    """A request that hasn't been made yet: make() creates the
+    QNetworkReply once the scheduler has room for it"""
+    def __init__(self, url, make, priority=None):
+        self.url = QtCore.QUrl(url)
+        self.make = make
+        self.priority = priority or default_priority
+        self.host = unicode(self.url.host()).lower()
+
+def task_name(task):
+    return task.__class__.__name__
+
+class Scheduler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.max_requests = max_requests
+        self.max_host_requests = max_host_requests
+        self.class_limits = dict(class_limits)
+
+        self.queues = dict((priority, deque()) for priority in priorities)
+        # op -> (request, started)
+        self.running = {}
+        self.host_counts = {}
+        self.class_counts = dict((priority, 0) for priority in priorities)
+        # id(task) -> (weakref to task, name, priority, started)
+        self.tasks = {}
+        self.breakers = {}
+        self.starting = False
+
+    def check_priority(self, priority):
+        if priority is None:
+            return default_priority
+        if priority not in self.queues:
+            raise ValueError('Unknown priority class %s' % priority)
+        return priority
+
+    def submit(self, task, priority, *args, **kwargs):
+        """Start a task, with its network requests in this priority class"""
+        self.track(task, priority)
+        task.start_task(*args, **kwargs)
+
+    def track(self, task, priority):
+        """Put a task which gets started some other way in this
+        priority class, and list it until it's done"""
+        task.priority = self.check_priority(priority)
+        key = id(task)
+        with self.lock:
+            self.tasks[key] = (weakref.ref(task), task_name(task), task.priority, time.time())
+        def untrack(*args):
+            with self.lock:
+                self.tasks.pop(key, None)
+        task.task_finished.connect(untrack)
+        task.task_exception.connect(untrack)
+        task.task_aborted.connect(untrack)
+
+    def enqueue(self, op):
+        """Queue a network op; op.start_request() is called once it can go"""
+        with self.lock:
+            self.queues[self.check_priority(op.request.priority)].append(op)
+        self.start_ready()
+
+    def done(self, op, ok=None):
+        """The op has finished with its request, or doesn't want it any
+        more. ok says whether the request worked, or is None if it was
+        abandoned before we found out."""
+        cooldown = None
+        with self.lock:
+            entry = self.running.pop(op, None)
+            if entry is not None:
+                request, started = entry
+                self.host_counts[request.host] = self.host_counts[request.host] - 1
+                if self.host_counts[request.host] == 0:
+                    del self.host_counts[request.host]
+                self.class_counts[request.priority] = self.class_counts[request.priority] - 1
+                breaker = self.breakers.setdefault(request.host, Breaker())
+                trial = breaker.trial is op
+                if ok is not None:
+                    cooldown = breaker.record(ok, trial)
+                elif trial:
+                    breaker.trial = None
+            else:
+                queue = self.queues[op.request.priority]
+                if op in queue:
+                    queue.remove(op)
+        if cooldown is not None:
+            print >>sys.stderr, "Too many failed requests to %s, holding off for %ds" % (request.host, cooldown)
+            # Nothing else may come along to get things going again
+            QtCore.QTimer.singleShot(int(cooldown * 1000) + 100, self.start_ready)
+        self.start_ready()
+
+    def next_ready(self):
+        with self.lock:
+            if len(self.running) >= self.max_requests:
+                return None
+            for priority in priorities:
+                if self.class_counts[priority] >= self.class_limits.get(priority, self.max_requests):
+                    continue
+                queue = self.queues[priority]
+                for op in queue:
+                    if self.host_counts.get(op.request.host, 0) >= self.max_host_requests:
+                        continue
+                    breaker = self.breakers.get(op.request.host)
+                    if breaker is None or breaker.allows(op):
+                        if breaker is not None and breaker.state == 'half-open' and priority != 'interactive':
+                            breaker.trial = op
+                        queue.remove(op)
+                        self.running[op] = (op.request, time.time())
+                        self.host_counts[op.request.host] = self.host_counts.get(op.request.host, 0) + 1
+                        self.class_counts[priority] = self.class_counts[priority] + 1
+                        return op
+        return None
+
+    def start_ready(self):
+        # Starting a request can end up back in here, if it finishes
+        # or is aborted straight away
+        if self.starting:
+            return
+        self.starting = True
+        try:
+            while True:
+                op = self.next_ready()
+                if op is None:
+                    break
+                op.start_request()
+        finally:
+            self.starting = False
+
+    def snapshot(self):
+        """What's going on right now, as a dict of lists:
+
+        tasks: (name, priority, seconds running) of submitted tasks
+        running: (priority, url, seconds running) of requests in flight
+        queued: (priority, url, seconds waiting) of requests waiting
+          for room, in the order they'll go
+        breakers: (host, state, recent error rate) of hosts whose
+          circuit breaker isn't closed"""
+        now = time.time()
+        with self.lock:
+            tasks = [(name, priority, now - started)
+                     for ref, name, priority, started in self.tasks.itervalues()
+                     if ref() is not None]
+            running = [(request.priority, str(request.url.toEncoded()), now - started)
+                       for request, started in self.running.itervalues()]
+            queued = [(priority, str(op.request.url.toEncoded()), now - op.queued_at)
+                      for priority in priorities
+                      for op in self.queues[priority]]
+            breakers = [(host, breaker.state, breaker.error_rate())
+                        for host, breaker in self.breakers.iteritems()
+                        if breaker.state != 'closed']
+        tasks.sort(key=lambda t: t[2], reverse=True)
+        running.sort(key=lambda r: r[2], reverse=True)
+        return {'tasks': tasks, 'running': running, 'queued': queued, 'breakers': breakers}
+
+    def describe(self):
+        snapshot = self.snapshot()
+        lines = ['%d tasks, %d requests running, %d queued' % (len(snapshot['tasks']), len(snapshot['running']), len(snapshot['queued']))]
+        for name, priority, age in snapshot['tasks']:
+            lines.append('  task    %-11s %6.1fs %s' % (priority, age, name))
+        for priority, url, age in snapshot['running']:
+            lines.append('  running %-11s %6.1fs %s' % (priority, age, url))
+        for priority, url, age in snapshot['queued']:
+            lines.append('  queued  %-11s %6.1fs %s' % (priority, age, url))
+        for host, state, error_rate in snapshot['breakers']:
+            lines.append('  breaker %-11s %5.0f%% %s' % (state, error_rate * 100, host))
+        return '\n'.join(lines)
+
+scheduler = Scheduler()
@@ -0,0 +1,182 @@
+"""Fast extraction of the handful of things we scrape from eventsforce
+pages, using lxml directly rather than building a BeautifulSoup tree.
+Each function returns the same thing the equivalent bs4 code did, so
+they can be swapped in wherever pages are scraped in bulk."""
+
+from lxml import etree, html
+import re
+
+profile_img_xpath = etree.XPath('//img[@title="Picture Profile"]/@src')
+tick_img_xpath = etree.XPath('//img[contains(@src, "tick.gif")]')
+tick_src_re = re.compile(r'.*/backend/tick.gif$')
+export_link_xpath = etree.XPath('//img[@title="Export to Excel"]/..')
+script_text_xpath = etree.XPath('//script/text()')
+form_xpath = etree.XPath('//form')
+title_xpath = etree.XPath('//title')
+logout_xpath = etree.XPath('//a[@id="ef_menu_button_logout"]')
+invalid_logon_xpath = etree.XPath('//text()[contains(., "Invalid logon")]')
+criteria_xpath = etree.XPath('//input[@type="hidden"][starts-with(@name, "criteriaDescription_")]')
+criteria_name_re = re.compile(r'^criteriaDescription_(\d+)$')
+first_value_select_xpath = etree.XPath('//select[starts-with(@name, "value1_")][1]')
+window_location_re = re.compile(r'^\s*window\.location=\'(.*)\';')
+redirect_url_re = re.compile(r'var redirectURL="(.*)"')
+
+def parse(data):
+    if not data.strip():
+        # lxml refuses to parse an empty document
+        data = '<html></html>'
+    return html.document_fromstring(data)
+
+def element_string(element):
+    """Equivalent of bs4's Tag.string: the text of an element with
+    exactly one child node, looking through single-child elements,
+    or None."""
+    nodes = []
+    if element.text:
+        nodes.append(element.text)
+    for child in element:
+        nodes.append(child)
+        if child.tail:
+            nodes.append(child.tail)
+    if len(nodes) != 1:
+        return None
+    if isinstance(nodes[0], basestring):
+        return unicode(nodes[0])
+    return element_string(nodes[0])
+
+def profile_picture(tree):
+    """src of the profile picture on a person page, or None"""
+    srcs = profile_img_xpath(tree)
+    if not srcs:
+        return None
+    return srcs[0]
+
+def ticked_category(tree):
+    """Attendee category next to the tick on a person's event page, or None"""
+    for img in tick_img_xpath(tree):
+        if not tick_src_re.match(img.get('src')):
+            continue
+        img_td = None
+        for parent in img.iterancestors('td'):
+            img_td = parent
+            break
+        if img_td is None:
+            return None
+        category_td = None
+        for sibling in img_td.itersiblings('td', preceding=True):
+            category_td = sibling
+            break
+        if category_td is None:
+            return None
+        return element_string(category_td)
+    return None
+
+def export_link(tree):
+    """href of the 'Export to Excel' link on a report page, or None"""
+    links = export_link_xpath(tree)
+    if not links:
+        return None
+    return links[0].get('href')
+
+def script_match(tree, regexp, search=False):
+    for text in script_text_xpath(tree):
+        m = regexp.search(text) if search else regexp.match(text)
+        if m:
+            return m.group(1)
+    return None
+
+def window_location(tree):
+    """Target of a window.location='...' script, or None"""
+    return script_match(tree, window_location_re)
+
+def redirect_url(tree):
+    """Target of the javascript redirect in the login sequence, or None"""
+    return script_match(tree, redirect_url_re, search=True)
+
+def first_form(tree):
+    forms = form_xpath(tree)
+    if not forms:
+        return None
+    return forms[0]
+
+def title(tree):
+    titles = title_xpath(tree)
+    if not titles:
+        return None
+    return titles[0].text_content()
+
+def report_criteria(tree):
+    """Map of criterion description to id on a report's parameters page,
+    e.g. {'Amendment Date': '12', 'In Event': '13'}"""
+    criteria = {}
+    for input in criteria_xpath(tree):
+        m = criteria_name_re.match(input.get('name'))
+        if m:
+            criteria[input.get('value')] = m.group(1)
+    return criteria
+
+def report_choices(tree):
+    """(text, value) for each option of the first criterion on a
+    report's parameters page"""
+    selects = first_value_select_xpath(tree)
+    if not selects:
+        return None
+    choices = []
+    for option in selects[0].iter('option'):
+        if option.get('value') is None:
+            continue
+        try:
+            choices.append((option.text_content(), int(option.get('value'))))
+        except ValueError:
+            pass
+    return choices
+
+def has_logout_button(tree):
+    return len(logout_xpath(tree)) > 0
+
+def has_invalid_logon(tree):
+    return len(invalid_logon_xpath(tree)) > 0
+
+def form_fields(form):
+    """Collect the fields a browser would submit for this form, in the
+    same way as nettask.soup_form_fields. Returns (action, fields,
+    fields_seen, script_texts)."""
+    fields = {}
+    fields_seen = set()
+
+    for input in form.iter('input'):
+        name = input.get('name')
+        if name is None:
+            continue
+        if input.get('disabled') is not None:
+            print "Skipping disabled select", name
+            continue
+        fields_seen.add(name)
+        type = input.get('type', 'text').lower()
+        if type == 'image':
+            fields['%s.x' % name] = '1'
+            fields['%s.y' % name] = '1'
+        elif type == 'button':
+            continue
+        elif type == 'checkbox' or type == 'radio':
+            if input.get('checked') is not None:
+                fields[name] = input.get('value')
+        elif input.get('value') is not None:
+            fields[name] = input.get('value')
+
+    for select in form.iter('select'):
+        name = select.get('name')
+        if name is None:
+            continue
+        if select.get('disabled') is not None:
+            print "Skipping disabled select", name
+            continue
+        fields_seen.add(name)
+        for option in select.iter('option'):
+            if option.get('selected') is not None:
+                fields[name] = option.get('value')
+                break
+
+    scripts = [script.text_content() for script in form.iter('script')]
+
+    return form.get('action'), fields, fields_seen, scripts
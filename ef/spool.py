@@ -0,0 +1,225 @@
+"""Keeps a compressed copy of every report downloaded from eventsforce,
+so that it can be ingested again without re-running the report (after
+a crash or a parser fix), and so that the next run of the same report
+can tell which people have changed since.
+
+Each report is datadir/reports/<name>.html.gz, with a <name>.json
+alongside holding the report's parameters and what happened to it,
+and once ingested, a <name>.digests listing a digest for each person's
+rows. Old reports are removed as new ones come in (see expire_spool)."""
+
+import os
+import gzip
+import json
+import time
+import errno
+import hashlib
+
+spooldir = None
+
+# Reports kept for each report (see report_key)
+keep_reports = 3
+
+# And however many reports there are, no more than this many, taking
+# up no more than this much space, from no longer ago than this
+max_reports = 20
+max_bytes = 500 * 1024 * 1024
+max_age = 30 * 24 * 60 * 60
+
+# Parameters which make one report a different report, rather than
+# another run of the same one; the rest (such as 'since') are only
+# noted down
+report_key_params = ['profile', 'event']
+
+def setup_spool(datadir):
+    global spooldir
+    spooldir = os.path.join(datadir, 'reports')
+    if not os.path.exists(spooldir):
+        os.mkdir(spooldir)
+
+# Spooled reports are referred to by the path without the extension,
+# which is also how the db worker gets to them
+def spool_base(name):
+    return os.path.join(spooldir, name)
+
+def spool_path(base, ext):
+    return '%s.%s' % (base, ext)
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+def report_key(params):
+    return params_key(dict((name, value) for name, value in params.iteritems() if name in report_key_params))
+
+class ReportSpool(object):
+    """Writes a report to the spool as it downloads. Nothing is listed
+    in the spool until close() is called."""
+
+    def __init__(self, params):
+        self.params = params
+        self.name = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), hashlib.sha1(params_key(params)).hexdigest()[:8])
+        self.base = spool_base(self.name)
+        self.filename = spool_path(self.base, 'html.gz')
+        self.encoding = None
+        self.file = gzip.open(self.filename + '.part', 'wb')
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            self.encoding = 'utf-8'
+            data = data.encode('utf-8')
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        os.rename(self.filename + '.part', self.filename)
+        meta = {'name': self.name,
+                'params': self.params,
+                'date': time.time(),
+                'encoding': self.encoding,
+                'ingested': False,
+                }
+        write_meta(meta)
+        expire_spool(self.params)
+        return meta
+
+    def discard(self):
+        self.file.close()
+        remove(self.filename + '.part')
+
+def write_meta(meta):
+    filename = spool_path(spool_base(meta['name']), 'json')
+    with open(filename + '.part', 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(filename):
+        # Windows won't rename over an existing file
+        os.remove(filename)
+    os.rename(filename + '.part', filename)
+
+def remove(filename):
+    try:
+        os.remove(filename)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def find_spools(params=None, ingested=None):
+    """Spooled reports, newest first, optionally only runs of the same
+    report as params, or those which have (or haven't) been ingested"""
+    if spooldir is None or not os.path.isdir(spooldir):
+        return []
+    found = []
+    for filename in os.listdir(spooldir):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(spooldir, filename)) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            continue
+        if params is not None and report_key(meta['params']) != report_key(params):
+            continue
+        if ingested is not None and meta['ingested'] != ingested:
+            continue
+        found.append(meta)
+    found.sort(key=lambda meta: meta['date'], reverse=True)
+    return found
+
+def latest_spool(params=None, ingested=None):
+    found = find_spools(params, ingested)
+    if not found:
+        return None
+    return found[0]
+
+def spool_size(meta):
+    size = 0
+    for ext in ['html.gz', 'digests']:
+        try:
+            size = size + os.path.getsize(spool_path(spool_base(meta['name']), ext))
+        except OSError:
+            pass
+    return size
+
+def remove_spool(meta):
+    for ext in ['html.gz', 'digests', 'json']:
+        remove(spool_path(spool_base(meta['name']), ext))
+
+def expire_spool(params):
+    """Remove all but the latest keep_reports runs of params' report,
+    and then the oldest reports of all until within max_reports,
+    max_bytes and max_age. The newest report always stays."""
+    for meta in find_spools(params)[keep_reports:]:
+        remove_spool(meta)
+
+    now = time.time()
+    total = 0
+    for i, meta in enumerate(find_spools()):
+        total = total + spool_size(meta)
+        if i > 0 and (i >= max_reports or total > max_bytes or meta['date'] < now - max_age):
+            remove_spool(meta)
+
+def read_chunks(filename, encoding=None, chunk_size=65536):
+    f = gzip.open(filename, 'rb')
+    try:
+        for data in decode_chunks(f, encoding, chunk_size):
+            yield data
+    finally:
+        f.close()
+
+def decode_chunks(f, encoding=None, chunk_size=65536):
+    """Read f in chunks, decoded if there's an encoding"""
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        if encoding is not None:
+            # Don't split a character across chunks
+            while True:
+                try:
+                    data = data.decode(encoding)
+                    break
+                except UnicodeDecodeError, e:
+                    if e.start < len(data) - 4:
+                        raise
+                    more = f.read(1)
+                    if not more:
+                        raise
+                    data = data + more
+        yield data
+
+def group_digest(rows):
+    """Digest of all the rows for one person"""
+    h = hashlib.sha1()
+    for row in rows:
+        h.update(u'\x1f'.join(row).encode('utf-8'))
+        h.update('\x1e')
+    return h.digest()
+
+def save_digests(base, keys, digests):
+    filename = spool_path(base, 'digests')
+    with open(filename, 'wb') as f:
+        f.write(json.dumps(keys) + '\n')
+        f.write(''.join(digests))
+
+def load_digests(base):
+    """(keys, digests) saved for this spooled report, or (None, None)"""
+    try:
+        with open(spool_path(base, 'digests'), 'rb') as f:
+            keys = json.loads(f.readline())
+            data = f.read()
+    except (IOError, ValueError):
+        return None, None
+    size = hashlib.sha1().digest_size
+    return keys, set([data[i:i+size] for i in xrange(0, len(data), size)])
+
+def mark_ingested(base):
+    filename = spool_path(base, 'json')
+    try:
+        with open(filename) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return
+    meta['ingested'] = True
+    with open(filename + '.part', 'w') as f:
+        json.dump(meta, f)
+    os.remove(filename)
+    os.rename(filename + '.part', filename)
@@ -1,6 +1,7 @@
 from PyQt4 import QtCore
 import traceback
 import sys
+from ef import trace
 
 class TaskOp(QtCore.QObject):
     _finished = QtCore.pyqtSignal(int)
@@ -41,6 +42,72 @@ class TaskOp(QtCore.QObject):
     def emit_delayed(self):
         pass
 
+    def trace_args(self):
+        """What to record about this op when tracing (see ef.trace)"""
+        return {}
+
+class TaskCancelled(Exception):
+    """Thrown into a task when it's cancelled, so that it can clean up"""
+    def __init__(self, msg='Aborted'):
+        Exception.__init__(self, msg)
+        self.msg = msg
+    def __str__(self):
+        return self.msg
+
+class DeadlineExceeded(TaskCancelled):
+    def __init__(self, seconds):
+        TaskCancelled.__init__(self, 'Gave up after taking more than %d minutes' % (seconds // 60))
+
+class CancelToken(QtCore.QObject):
+    """Cancels a whole tree of tasks at once. Each task started with
+    Task.subtask gets a child of its parent's token, so cancelling a
+    token cancels everything under it, but not its parent. With a
+    deadline (in seconds), the token cancels itself once that much
+    time has passed."""
+    cancelled = QtCore.pyqtSignal(Exception)
+
+    def __init__(self, parent=None, deadline=None):
+        QtCore.QObject.__init__(self)
+        self.error = None
+        self.timer = None
+        self.deadline = None
+        if parent is not None:
+            if parent.error is not None:
+                self.error = parent.error
+            else:
+                parent.cancelled.connect(self.cancel)
+        if deadline is not None:
+            self.set_deadline(deadline)
+
+    def child(self, deadline=None):
+        return CancelToken(self, deadline)
+
+    def is_cancelled(self):
+        return self.error is not None
+
+    def set_deadline(self, seconds):
+        if self.timer is None:
+            self.timer = QtCore.QTimer(self)
+            self.timer.setSingleShot(True)
+            self.timer.timeout.connect(self.handle_deadline)
+        self.deadline = seconds
+        self.timer.setInterval(int(seconds * 1000))
+        self.timer.start()
+
+    def handle_deadline(self):
+        self.cancel(DeadlineExceeded(self.deadline))
+
+    @QtCore.pyqtSlot(Exception)
+    def cancel(self, error=None):
+        if self.error is not None:
+            return
+        if error is None:
+            error = TaskCancelled()
+        self.error = error
+        if self.timer is not None:
+            self.timer.stop()
+        self.cancelled.emit(error)
+
 class Finishable(object):
     def __init__(self, signal, error_signal=None):
         self.finish_signal = signal
@@ -69,10 +136,12 @@ class FinishableWaitOp(TaskOp):
     def __init__(self, finishable):
         TaskOp.__init__(self)
         self.finishable = finishable
+        self.connected = False
         if not self.finishable.is_finished:
             self.finishable.finish_signal.connect(self.finish)
             if self.finishable.error_signal is not None:
                 self.finishable.error_signal.connect(self.throw)
+            self.connected = True
 
     def emit_delayed(self):
         if self.finishable.finished_error is not None:
@@ -80,6 +149,24 @@ class FinishableWaitOp(TaskOp):
         elif self.finishable.is_finished:
             self.finish()
 
+    def trace_args(self):
+        return {'waiting_for': self.finishable.__class__.__name__}
+
+    def abort(self):
+        # Nobody is waiting for it any more, so if it can be stopped
+        # (a subtask, or a report being ingested), stop it
+        if self.connected:
+            self.connected = False
+            self.finishable.finish_signal.disconnect(self.finish)
+            if self.finishable.error_signal is not None:
+                self.finishable.error_signal.disconnect(self.throw)
+        if self.finishable.is_finished:
+            return
+        if isinstance(self.finishable, Task):
+            self.finishable.cancel()
+        elif hasattr(self.finishable, 'abort'):
+            self.finishable.abort()
+
 class Task(QtCore.QObject, Finishable):
     task_finished = QtCore.pyqtSignal()
     task_aborted = QtCore.pyqtSignal()
@@ -97,14 +184,29 @@ class Task(QtCore.QObject, Finishable):
         self.previous_op = None
         self.is_connected = False
 
+        # Priority class for the scheduler (see ef.scheduler); None
+        # means the default
+        self.priority = None
+
+        # See CancelToken
+        self.token = None
+        self.cancel_error = None
+        self.running = False
+
         self.op_id = 1
 
     @QtCore.pyqtSlot()
     def start_task(self, *args, **kwargs):
+        if self.token is not None and self.token.is_cancelled():
+            self.task_exception.emit(self.token.error, str(self.token.error), {})
+            return
+        trace.task_started(self)
         self.task_coro = self.task(*args, **kwargs)
         if self.task_coro is None:
+            trace.task_ended(self, 'finished')
             self.task_finished.emit()
         else:
+            self.running = True
             self.continue_task(lambda: self.task_coro.next())
 
     def connect_coro(self):
@@ -132,6 +234,11 @@ class Task(QtCore.QObject, Finishable):
 
             self.current = continuation()
 
+            if self.cancel_error is not None and isinstance(self.current, TaskOp):
+                # A cancelled task doesn't get to start anything new
+                self.current.abort()
+                raise self.cancel_error
+
             # Give the task one chance to respond (the only sensible response is to wrap the exception with more information and reraise)
             if not isinstance(self.current, TaskOp):
                 self.current = self.task_coro.throw(TypeError("yield from task must be an instance of TaskOp"))
@@ -141,16 +248,21 @@ class Task(QtCore.QObject, Finishable):
                 raise TypeError("yield from task must be an instance of TaskOp - double fault")
 
             self.connect_coro()
+            trace.op_started(self, self.current)
             # We have this mainly for FinishedWaitOp, which might have
             # finished immediately but needs to send its signals after
             # we connect to them
             self.current.emit_delayed()
         except StopIteration:
+            self.running = False
+            trace.task_ended(self, 'finished')
             self.task_finished.emit()
         except Exception, e:
+            self.running = False
+            trace.task_ended(self, '%s: %s' % (e.__class__.__name__, e))
             tb = sys.exc_info()[2]
-            trace = traceback.format_exc()
-            self.task_exception.emit(e, trace, {'traceback': tb})
+            tb_text = traceback.format_exc()
+            self.task_exception.emit(e, tb_text, {'traceback': tb})
 
     def handle_finished(self, op_id):
         if op_id != self.current.get_op_id():
@@ -158,6 +270,7 @@ class Task(QtCore.QObject, Finishable):
             return
         self.disconnect_coro()
         result = self.current.result()
+        trace.op_ended(self, self.current, 'finished')
         self.continue_task(lambda: self.task_coro.send(result))
 
     def handle_exception(self, e, op_id, blob):
@@ -166,12 +279,52 @@ class Task(QtCore.QObject, Finishable):
             return
 
         self.disconnect_coro()
+        trace.op_ended(self, self.current, '%s: %s' % (e.__class__.__name__, e))
 
         # We've got an exception. We want to throw it through the
         # coroutine in order to get a useful traceback, and possibly
         # allow the coroutine to handle the exception
         self.continue_task(lambda: self.task_coro.throw(e, None, blob.get('traceback', None)))
 
+    def subtask(self, task):
+        """Hand our priority class and cancellation on to a task
+        started from this one"""
+        if task.priority is None:
+            task.priority = self.priority
+        if task.token is None and self.token is not None:
+            task.set_token(self.token.child())
+        return task
+
+    def set_token(self, token):
+        if self.token is not None and not self.token.is_cancelled():
+            self.token.cancelled.disconnect(self.cancel)
+        self.token = token
+        if not token.is_cancelled():
+            token.cancelled.connect(self.cancel)
+        elif self.running:
+            self.cancel(token.error)
+
+    def set_deadline(self, seconds):
+        """Cancel this task (and its subtasks) with DeadlineExceeded if
+        it's still running after this many seconds"""
+        self.set_token(CancelToken(self.token, seconds))
+
+    @QtCore.pyqtSlot(Exception)
+    def cancel(self, error=None):
+        """Abort whatever the task is waiting for, and throw error
+        (TaskCancelled by default) into it so that it can clean up. The
+        task then fails with that error, unless it catches it."""
+        if not self.running or self.cancel_error is not None:
+            return
+        if error is None:
+            error = TaskCancelled()
+        self.cancel_error = error
+        self.disconnect_coro()
+        if self.current is not None:
+            trace.op_ended(self, self.current, 'cancelled')
+            self.current.abort()
+        self.continue_task(lambda: self.task_coro.throw(error))
+
     def wait(self, until):
         if isinstance(until, Finishable):
             return FinishableWaitOp(until)
@@ -181,7 +334,11 @@ class Task(QtCore.QObject, Finishable):
     @QtCore.pyqtSlot()
     def abort(self):
         self.disconnect_coro()
+        if self.running:
+            trace.task_ended(self, 'aborted')
+        self.running = False
         if self.current is not None:
+            trace.op_ended(self, self.current, 'aborted')
             self.current.abort()
         self.task_aborted.emit()
 
@@ -200,5 +357,312 @@ class TaskList(Task):
 
     def task(self):
         for task in self.task_list:
-            task.start_task()
+            self.subtask(task).start_task()
             yield self.wait(task)
+
+class TaskGroup(Task):
+    """Runs tasks all at once (see GatherOp), as a Task in its own
+    right, e.g. for putting in a TaskList"""
+    def __init__(self, tasks, fail_fast=True):
+        Task.__init__(self)
+
+        self.tasks = list(tasks)
+        self.fail_fast = fail_fast
+
+    def task(self):
+        yield GatherOp([self.subtask(task) for task in self.tasks], self.fail_fast)
+
+class TaskGroupError(Exception):
+    """More than one of a group of tasks failed. errors is a list of
+    (index, exception, blob) for each of them."""
+    def __init__(self, errors):
+        Exception.__init__(self)
+        self.errors = errors
+
+    def __str__(self):
+        return '%d tasks failed: %s' % (len(self.errors), '; '.join([str(e) for index, e, blob in self.errors]))
+
+class TaskGroupOp(TaskOp):
+    """Base for ops which run a group of children at once. A child is
+    either a Task, which gets started, or a TaskOp (such as a network
+    op), which is already under way. Children are identified by
+    index; the result of a Task is the task itself, and of a TaskOp
+    whatever its result() is when it finishes.
+
+    Subclasses start children with start_child, get told about them
+    through child_finished and child_failed, and end with done or
+    fail. Once ended (or aborted), the children still running are
+    aborted and anything else they emit is ignored."""
+
+    def __init__(self):
+        TaskOp.__init__(self)
+
+        self.running = {}
+        self.errors = []
+        self.closed = False
+
+    def start_child(self, index, child):
+        self.running[index] = child
+        if isinstance(child, Task):
+            child.task_finished.connect(lambda: self.handle_child_finished(index, child))
+            child.task_exception.connect(lambda e, msg, blob: self.handle_child_exception(index, child, e, blob))
+            child.start_task()
+        else:
+            # Ops tell us who they are by op_id, which within a group
+            # is the index
+            child.set_op_id(index)
+            child._finished.connect(self.handle_op_finished)
+            child._exception.connect(self.handle_op_exception)
+            child.emit_delayed()
+
+    def handle_op_finished(self, op_id):
+        child = self.running.get(op_id)
+        if child is not None:
+            self.handle_child_finished(op_id, child)
+
+    def handle_op_exception(self, e, op_id, blob):
+        child = self.running.get(op_id)
+        if child is not None:
+            self.handle_child_exception(op_id, child, e, blob)
+
+    def handle_child_finished(self, index, child):
+        if self.closed or self.running.get(index) is not child:
+            # Stray signal from a child we've already dealt with
+            return
+        del self.running[index]
+        if isinstance(child, Task):
+            result = child
+        else:
+            result = child.result()
+        try:
+            self.child_finished(index, result)
+        except Exception, e:
+            self.errors.append((index, e, {'traceback': sys.exc_info()[2]}))
+            self.fail()
+
+    def handle_child_exception(self, index, child, e, blob):
+        if self.closed or self.running.get(index) is not child:
+            return
+        del self.running[index]
+        self.errors.append((index, e, blob))
+        try:
+            self.child_failed(index, e, blob)
+        except Exception, e:
+            self.errors.append((index, e, {'traceback': sys.exc_info()[2]}))
+            self.fail()
+
+    def child_finished(self, index, result):
+        pass
+
+    def child_failed(self, index, e, blob):
+        self.fail()
+
+    def done(self):
+        self.closed = True
+        self.cancel_running()
+        self.finish()
+
+    def fail(self):
+        # A single failure is passed on as it is, so that callers can
+        # still catch particular exceptions
+        self.closed = True
+        self.cancel_running()
+        if len(self.errors) == 1:
+            index, e, blob = self.errors[0]
+            self.throw(e, blob=blob)
+        else:
+            self.throw(TaskGroupError(self.errors))
+
+    def trace_args(self):
+        return {'failed': len(self.errors)}
+
+    def cancel_running(self):
+        running = self.running
+        self.running = {}
+        for child in running.values():
+            if isinstance(child, Task):
+                # Let it clean up
+                child.cancel()
+            else:
+                child.abort()
+
+    def abort(self):
+        self.closed = True
+        self.cancel_running()
+
+class GatherOp(TaskGroupOp):
+    """Runs all the children at once, finishing when they all have.
+    The result is a list of their results, in order. With fail_fast,
+    the first failure aborts the rest and is thrown; otherwise all the
+    children get to finish, and then any failures are thrown."""
+
+    def __init__(self, children, fail_fast=True):
+        TaskGroupOp.__init__(self)
+
+        self.children = list(children)
+        self.fail_fast = fail_fast
+        self.results = [None] * len(self.children)
+        self.remaining = len(self.children)
+        self.started = False
+
+    def emit_delayed(self):
+        # As with BoundedMapOp, wait for the owning Task to be listening
+        if self.started:
+            return
+        self.started = True
+        for index, child in enumerate(self.children):
+            if self.closed:
+                return
+            self.start_child(index, child)
+        self.check_done()
+
+    def child_finished(self, index, result):
+        self.results[index] = result
+        self.remaining = self.remaining - 1
+        self.check_done()
+
+    def child_failed(self, index, e, blob):
+        self.remaining = self.remaining - 1
+        if self.fail_fast:
+            self.fail()
+        else:
+            self.check_done()
+
+    def check_done(self):
+        if self.closed or self.remaining > 0:
+            return
+        if self.errors:
+            self.fail()
+        else:
+            self.done()
+
+    def result(self):
+        return self.results
+
+class RaceOp(TaskGroupOp):
+    """Runs all the children at once, finishing as soon as one of them
+    does and aborting the others. The result is (index, result) of the
+    winner. Failures are only thrown if every child fails."""
+
+    def __init__(self, children):
+        TaskGroupOp.__init__(self)
+
+        self.children = list(children)
+        self.winner = None
+        self.started = False
+
+    def emit_delayed(self):
+        if self.started:
+            return
+        self.started = True
+        for index, child in enumerate(self.children):
+            if self.closed:
+                return
+            self.start_child(index, child)
+        self.check_failed()
+
+    def child_finished(self, index, result):
+        self.winner = (index, result)
+        self.done()
+
+    def child_failed(self, index, e, blob):
+        self.check_failed()
+
+    def check_failed(self):
+        if self.closed or self.running:
+            return
+        if self.errors:
+            self.fail()
+        else:
+            # Nothing to race
+            self.done()
+
+    def result(self):
+        return self.winner
+
+class BoundedMapOp(TaskGroupOp):
+    '''Runs make_task(item) for each item, keeping at most limit of
+    the resulting tasks (or ops) in flight at once. handle_result(index,
+    result) is called for each finished one in the order of items,
+    regardless of the order they actually finish in; nothing is started
+    more than window items ahead of the oldest unhandled one, so a slow
+    task can't make finished ones pile up. The op finishes once all the
+    tasks have finished. With fail_fast, it throws (aborting the rest)
+    as soon as any of them throws; otherwise failed items are skipped
+    and the failures thrown at the end.'''
+
+    def __init__(self, make_task, items, limit, handle_result=None, window=None, fail_fast=True):
+        TaskGroupOp.__init__(self)
+
+        self.make_task = make_task
+        self.items = list(items)
+        self.limit = max(1, limit)
+        self.window = window if window is not None else 4 * self.limit
+        self.handle_result = handle_result
+        self.fail_fast = fail_fast
+
+        self.next_index = 0
+        self.next_result = 0
+        self.done_results = {}
+        self.filling = False
+        self.refill = False
+
+    def emit_delayed(self):
+        # Tasks only get started once the owning Task has connected
+        # to our signals, so that one which finishes immediately
+        # doesn't get lost
+        self.fill()
+
+    def can_start(self):
+        return (not self.closed and len(self.running) < self.limit
+                and self.next_index < len(self.items)
+                and self.next_index < self.next_result + self.window)
+
+    def fill(self):
+        # Tasks which finish immediately would otherwise recurse back
+        # in here, once per item
+        if self.filling:
+            self.refill = True
+            return
+        self.filling = True
+        try:
+            self.refill = True
+            while self.refill:
+                self.refill = False
+                while self.can_start():
+                    index = self.next_index
+                    self.next_index = self.next_index + 1
+                    self.start_child(index, self.make_task(self.items[index]))
+        finally:
+            self.filling = False
+
+        if not self.closed and not self.running and self.next_result >= len(self.items):
+            if self.errors:
+                self.fail()
+            else:
+                self.done()
+
+    def child_finished(self, index, result):
+        self.done_results[index] = (True, result)
+        self.hand_back()
+
+    def child_failed(self, index, e, blob):
+        if self.fail_fast:
+            self.fail()
+            return
+        self.done_results[index] = (False, None)
+        self.hand_back()
+
+    def hand_back(self):
+        # Hand results back in order
+        while self.next_result in self.done_results:
+            ok, result = self.done_results.pop(self.next_result)
+            if ok and self.handle_result is not None:
+                self.handle_result(self.next_result, result)
+            self.next_result = self.next_result + 1
+
+        self.fill()
+
+    def abort(self):
+        TaskGroupOp.abort(self)
+        self.done_results = {}
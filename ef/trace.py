@@ -0,0 +1,116 @@
+"""Optional record of where the time goes while tasks run: a span for
+each task, and within it one for each op it waits on (network
+requests, with their URL, size and parse time, and waits on the db
+worker). Written in the Chrome trace event format, for loading into
+chrome://tracing or ui.perfetto.dev.
+
+Off unless EF_TRACE is set in the environment, in which case traces
+go to datadir/traces. Each task gets its own track, named after it,
+since tasks interleave on the same thread."""
+
+import os
+import json
+import time
+import threading
+
+tracer = None
+
+# Trace file gets rewritten at most this often while tasks are ending
+flush_interval = 10
+
+# Beyond this many spans, later ones are only counted
+max_events = 500000
+
+class Tracer(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self.dropped = 0
+        self.next_track = 1
+        self.last_flush = self.start
+
+    def ts(self, t):
+        return int((t - self.start) * 1000000)
+
+    def new_track(self, name):
+        with self.lock:
+            track = self.next_track
+            self.next_track = self.next_track + 1
+            self.events.append({'ph': 'M', 'name': 'thread_name', 'pid': self.pid, 'tid': track,
+                                'args': {'name': '%s #%d' % (name, track)}})
+        return track
+
+    def span(self, track, name, cat, start, end, args):
+        with self.lock:
+            if len(self.events) >= max_events:
+                self.dropped = self.dropped + 1
+                return
+            self.events.append({'ph': 'X', 'name': name, 'cat': cat, 'pid': self.pid, 'tid': track,
+                                'ts': self.ts(start), 'dur': self.ts(end) - self.ts(start),
+                                'args': args})
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.last_flush = time.time()
+            data = {'traceEvents': list(self.events),
+                    'displayTimeUnit': 'ms',
+                    'otherData': {'dropped': self.dropped},
+                    }
+        with open(self.filename + '.part', 'w') as f:
+            json.dump(data, f)
+        if os.path.exists(self.filename):
+            # Windows won't rename over an existing file
+            os.remove(self.filename)
+        os.rename(self.filename + '.part', self.filename)
+
+def start_tracing(datadir):
+    global tracer
+    if not os.environ.get('EF_TRACE'):
+        return None
+    tracedir = os.path.join(datadir, 'traces')
+    if not os.path.exists(tracedir):
+        os.mkdir(tracedir)
+    tracer = Tracer(os.path.join(tracedir, 'trace-%s.json' % time.strftime('%Y%m%d-%H%M%S')))
+    return tracer.filename
+
+def stop_tracing():
+    global tracer
+    if tracer is not None:
+        tracer.flush()
+    tracer = None
+
+# Hooks called by ef.task; they do nothing unless tracing is on
+
+def task_started(task):
+    if tracer is None:
+        return
+    task.trace_track = tracer.new_track(task.__class__.__name__)
+    task.trace_start = time.time()
+
+def task_ended(task, outcome):
+    if tracer is None or getattr(task, 'trace_start', None) is None:
+        return
+    tracer.span(task.trace_track, task.__class__.__name__, 'task', task.trace_start, time.time(),
+                {'outcome': outcome, 'priority': task.priority})
+    task.trace_start = None
+    tracer.maybe_flush()
+
+def op_started(task, op):
+    if tracer is None:
+        return
+    op.trace_start = time.time()
+
+def op_ended(task, op, outcome):
+    if tracer is None or getattr(op, 'trace_start', None) is None or getattr(task, 'trace_track', None) is None:
+        return
+    args = op.trace_args()
+    args['outcome'] = outcome
+    tracer.span(task.trace_track, op.__class__.__name__, 'op', op.trace_start, time.time(), args)
+    op.trace_start = None
@@ -1,7 +1,9 @@
 from PyQt4 import QtCore
+from ef.threads import thread_registry
 from ef.login import LoginTask, LoginError
+from ef.scheduler import scheduler
 
-class TryLogin(QtCore.QObject):
+class TryLoginWorker(QtCore.QObject):
     completed = QtCore.pyqtSignal()
     error = QtCore.pyqtSignal(str)
     
@@ -14,10 +16,27 @@ class TryLogin(QtCore.QObject):
         self.task.task_finished.connect(self.completed)
         self.task.task_exception.connect(self.handle_exception)
 
-        self.task.start_task()
+        scheduler.submit(self.task, 'interactive')
 
     def handle_exception(self, e, msg):
         if isinstance(e, LoginError):
             self.error.emit(str(e))
         else:
             self.error.emit(msg)
+
+class TryLogin(QtCore.QObject):
+    sig_start_login = QtCore.pyqtSignal(str, str)
+
+    def __init__(self):
+        QtCore.QObject.__init__(self)
+
+        self.worker = TryLoginWorker()
+        self.worker.moveToThread(thread_registry.get('network'))
+
+        self.sig_start_login.connect(self.worker.start_login)
+
+        self.completed = self.worker.completed
+        self.error = self.worker.error
+
+    def start_login(self, username, password):
+        self.sig_start_login.emit(username, password)
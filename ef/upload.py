@@ -1,12 +1,17 @@
 from __future__ import division
 import re
 import sys
+import errno
+from collections import deque
 from PyQt4 import QtCore
+from ef.threads import thread_registry
 from ef.lib import SignalGroup
 from ef.db import Person, Photo, Registration, Batch, FetchedPhoto
 import traceback
-from ef.nettask import NetFuncs
-from ef.task import Task
+from ef.nettask import NetFuncs, backoff_delay
+from ef.netlib import create_network_manager, ef_url
+from ef.task import Task, CancelToken
+from ef.scheduler import scheduler
 from ef.login import LoginTask, LoginError
 from ef.image import PhotoImage
 from PIL import Image
@@ -25,9 +30,9 @@ class UploadTask(Task, NetFuncs):
     error = QtCore.pyqtSignal(str)
     progress = QtCore.pyqtSignal(int)
 
-    def __init__(self, person, minimum_change, batch):
+    def __init__(self, person, minimum_change, batch, net_manager=None):
         Task.__init__(self)
-        NetFuncs.__init__(self)
+        NetFuncs.__init__(self, net_manager)
 
         self.batch = batch
         self.person = person
@@ -94,7 +99,7 @@ class UploadTask(Task, NetFuncs):
     def extract_link_from_silly_button(self, button):
         m = re.match(r'document.location=\'(.*)\';', button['onclick'])
         if not m:
-            self.error.emit("Could not parse javascript handler link %s", button['onclick'])
+            self.error.emit("Could not parse javascript handler link %s" % button['onclick'])
             return None
         return m.group(1)
 
@@ -119,7 +124,7 @@ class UploadTask(Task, NetFuncs):
                 }
 
     def task(self, image):
-        soup = yield self.get('https://www.eventsforce.net/libdems/backend/home/codEditMain.csp?codReadOnly=1&personID=%d&curPage=1' % self.person.id)
+        soup = yield self.get(ef_url('/libdems/backend/home/codEditMain.csp?codReadOnly=1&personID=%d&curPage=1' % self.person.id))
 
         self.progress.emit(1)
 
@@ -314,6 +319,105 @@ def person_should_upload(person):
 
     return False
 
+class UploadSession(QtCore.QObject):
+    """One logged-in eventsforce session, working through people from
+    the worker's shared queue until it runs dry"""
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, worker, number):
+        QtCore.QObject.__init__(self)
+
+        self.worker = worker
+        self.number = number
+        self.net_manager = create_network_manager()
+        self.person = None
+        self.task = None
+        self.login_task = None
+        self.progress = 0
+        self.is_finished = False
+
+    def start(self):
+        self.login_task = LoginTask(self.worker.username, self.worker.password, self.net_manager)
+        self.login_task.task_finished.connect(self.next_person)
+        self.login_task.task_exception.connect(self.handle_login_exception)
+        scheduler.submit(self.login_task, 'bulk')
+
+    def handle_login_exception(self, e, msg):
+        if isinstance(e, LoginError):
+            msg = str(e)
+        self.worker.session_failed(self, 'Login failed for upload session %d: %s' % (self.number, msg))
+        self.finish()
+
+    def finish(self):
+        if self.is_finished:
+            return
+        self.is_finished = True
+        self.task = None
+        self.finished.emit()
+
+    def next_person(self):
+        if self.is_finished:
+            return
+        self.person = self.worker.next_person()
+        if self.person is None:
+            self.finish()
+            return
+        self.retries = self.worker.retry_limit
+        self.start_upload()
+
+    def start_upload(self):
+        self.progress = 0
+        task = self.task = UploadTask(self.person, self.worker.percent_filter, self.worker.batch, self.net_manager)
+        # UploadTask can signal both error and completion for the same
+        # attempt, so only listen to the attempt that's current
+        task.completed.connect(lambda uploaded, aborted: self.handle_task_complete(task, uploaded, aborted))
+        task.error.connect(lambda err: self.handle_task_error(task, err))
+        task.progress.connect(self.handle_task_progress)
+        scheduler.track(task, 'bulk')
+        self.worker.update_progress('Uploading %s' % self.person)
+        try:
+            task.start()
+        except Exception:
+            self.handle_task_error(task, traceback.format_exc())
+
+    def handle_task_complete(self, task, uploaded, aborted):
+        if task is not self.task or aborted:
+            return
+        self.worker.person_done(self.person, uploaded)
+        # Skipped photos complete immediately, so go round the event
+        # loop rather than recursing through a long run of them
+        QtCore.QTimer.singleShot(0, self.next_person)
+
+    def handle_task_error(self, task, err):
+        if task is not self.task:
+            return
+        task.abort()
+        self.retries = self.retries - 1
+        if self.retries > 0 and not self.worker.aborted:
+            delay = backoff_delay(self.worker.retry_limit - self.retries)
+            print >>sys.stderr, "Upload of %s failed (retrying %d more times, in %.0fs): %s" % (self.person, self.retries, delay, err)
+            QtCore.QTimer.singleShot(int(delay * 1000), lambda: self.retry_upload(task))
+        else:
+            self.worker.person_failed(self.person, err)
+            QtCore.QTimer.singleShot(0, self.next_person)
+
+    def retry_upload(self, task):
+        # Unless we've been aborted, or moved on, while waiting
+        if task is not self.task or self.is_finished or self.worker.aborted:
+            return
+        self.start_upload()
+
+    def handle_task_progress(self, i):
+        self.progress = i
+        self.worker.update_progress('Uploading %s' % self.person)
+
+    def abort(self):
+        if self.login_task is not None:
+            self.login_task.abort()
+        if self.task is not None:
+            self.task.abort()
+        self.finish()
+
 class UploadWorker(QtCore.QObject):
     # XXX: this should be a task
     completed = QtCore.pyqtSignal()
@@ -321,26 +425,36 @@ class UploadWorker(QtCore.QObject):
     progress = QtCore.pyqtSignal(str, int, int)
 
     task_progress_size = 14
+    # Number of eventsforce sessions to upload through at once
+    upload_sessions = 3
+    retry_limit = 3
+    # Longest an upload may take before it's given up on, in seconds
+    time_limit = 8 * 60 * 60
     
     def __init__(self):
         super(QtCore.QObject, self).__init__()
 
-        self.tasks = None
+        self.sessions = []
+        self.aborted = False
+        self.token = None
 
     @QtCore.pyqtSlot(dict, str, str)
     @catcherror
     def start_upload(self, people_filter, username, password):
         self.aborted = False
+        self.abort_reason = None
+        self.token = CancelToken(deadline=self.time_limit)
+        self.token.cancelled.connect(self.handle_cancelled)
         self.people_filter = people_filter
-        self.i = 0
         self.upload_count = 0
-        self.tasks = {}
+        self.done_count = 0
+        self.errors = []
+        self.login_errors = []
         self.batch = Batch()
-        self.batch.finished.connect(self.completed)
+        self.batch.finished.connect(self.handle_batch_finished)
         self.username = username
         self.password = password
         self.percent_filter = 0
-        self.retry_limit = 3
 
         if self.people_filter['mode'] == 'good' or self.people_filter['mode'] == 'percent':
             self.people = None
@@ -352,86 +466,101 @@ class UploadWorker(QtCore.QObject):
             self.people = self.people_filter['people']
 
         self.people = filter(person_should_upload, self.people)
+        self.queue = deque(self.people)
 
         #print self.people
 
-        self.login_task = LoginTask(self.username, self.password)
-        self.login_task.task_exception.connect(self.handle_login_exception)
-        self.login_task.start_task()
-        self.login_task.task_finished.connect(self.next_task)
+        count = max(1, min(self.upload_sessions, len(self.people)))
+        self.sessions = [UploadSession(self, i + 1) for i in xrange(count)]
+        self.running_sessions = set(self.sessions)
+        for session in self.sessions:
+            session.finished.connect(lambda session=session: self.handle_session_finished(session))
+            session.start()
 
         self.progress.emit('Logging in', 0, 0)
 
-    def next_task(self):
-        self.progress.emit('Uploading photos', self.i * self.task_progress_size, len(self.people) * self.task_progress_size)
-
-        if self.i >= len(self.people):
-            self.batch.progress.connect(self.handle_commit_progress)
-            self.batch.finish()
+    def next_person(self):
+        if self.aborted or not self.queue:
+            return None
+        return self.queue.popleft()
+
+    def person_done(self, person, uploaded):
+        self.done_count = self.done_count + 1
+        if uploaded:
+            self.upload_count = self.upload_count + 1
+        self.update_progress('Uploading photos')
+
+    def person_failed(self, person, err):
+        self.done_count = self.done_count + 1
+        self.errors.append('%s: %s' % (person, err))
+        self.update_progress('Uploading photos')
+
+    def session_failed(self, session, err):
+        # Other sessions will pick up the work, so this only gets
+        # reported at the end
+        self.login_errors.append(err)
+
+    def update_progress(self, text):
+        cur = self.done_count * self.task_progress_size
+        for session in self.running_sessions:
+            if session.task is not None:
+                cur = cur + session.progress
+        self.progress.emit(text, cur, len(self.people) * self.task_progress_size)
+
+    def handle_session_finished(self, session):
+        self.running_sessions.discard(session)
+        if self.running_sessions:
             return
 
-        try:
-            person = self.people[self.i]
-            self.progress.emit('Uploading %s' % person, self.i * self.task_progress_size, len(self.people) * self.task_progress_size)
-            self.tasks[person.id] = UploadTask(person, self.percent_filter, self.batch)
-            self.current_task = self.tasks[person.id]
-            self.tasks[person.id].completed.connect(self.handle_task_complete)
-            self.tasks[person.id].error.connect(self.handle_upload_error)
-            self.tasks[person.id].progress.connect(self.handle_task_progress)
-            self.tasks[person.id].start()
-        except Exception:
-            self.error.emit(traceback.format_exc())
+        if self.queue and not self.aborted:
+            # Every session died before the work was done
+            for person in self.queue:
+                self.errors.append('%s: not uploaded' % person)
+            self.queue.clear()
 
-    def handle_task_complete(self, uploaded, aborted):
-        if not aborted:
-            if uploaded:
-                self.upload_count = self.upload_count + 1
-            self.i = self.i + 1
-            self.retry_limit = 3
-        self.next_task()
+        self.batch.progress.connect(self.handle_commit_progress)
+        self.batch.finish()
 
-    def handle_task_progress(self, i):
-        person = self.people[self.i]
-        self.progress.emit('Uploading %s' % person, self.i * self.task_progress_size + i, len(self.people) * self.task_progress_size)
+    def handle_batch_finished(self):
+        for err in self.login_errors:
+            print >>sys.stderr, err
+        if self.aborted:
+            msg = '%s: %d of %d photos uploaded' % (self.abort_reason, self.upload_count, len(self.people))
+            self.error.emit('\n\n'.join([msg, '\n'.join(self.errors)]).strip())
+        elif self.errors:
+            msg = '%d of %d uploads failed' % (len(self.errors), len(self.people))
+            self.error.emit('\n\n'.join([msg, '\n'.join(self.errors), '\n'.join(self.login_errors)]).strip())
+        else:
+            self.completed.emit()
 
     def handle_commit_progress(self, cur, max):
         self.progress.emit('Saving new photo URLs', cur, max)
 
-    def handle_login_exception(self, e, msg):
-        if isinstance(e, LoginError):
-            self.handle_error(str(e))
-        else:
-            self.handle_error(m)
-
-    def handle_upload_error(self, err):
-        self.retry_limit = self.retry_limit - 1
-        if self.retry_limit <= 0:
-            self.handle_error(err)
-        else:
-            print "Upload of %s failed (retrying %d more times): %s" % (self.people[self.i], self.retry_limit, err)
-            self.current_task.abort()
-            self.next_task()
+    @QtCore.pyqtSlot()
+    def abort(self):
+        if self.token is not None:
+            self.token.cancel()
 
-    def handle_error(self, err):
-        if self.aborted:
-            return
+    def handle_cancelled(self, e):
+        # In-flight uploads are dropped; what's already been uploaded
+        # still gets saved
         self.aborted = True
-
-        self.error.emit(err)
-        if self.tasks is not None:
-            for task in self.tasks.itervalues():
-                task.abort()
+        self.abort_reason = str(e)
+        for session in self.sessions:
+            session.abort()
 
 class Uploader(QtCore.QObject):
     sig_start_upload = QtCore.pyqtSignal(dict, str, str)
+    sig_abort = QtCore.pyqtSignal()
     
     def __init__(self):
         super(QtCore.QObject, self).__init__()
         
         self.uploader = UploadWorker()
-        #self.uploader.moveToThread(thread_registry.get('network'))
+        self.uploader.moveToThread(thread_registry.get('network'))
 
         self.sig_start_upload.connect(self.uploader.start_upload)
+        self.sig_abort.connect(self.uploader.abort)
 
         self.completed = self.uploader.completed
         self.error = self.uploader.error
@@ -439,3 +568,6 @@ class Uploader(QtCore.QObject):
         
     def start_upload(self, people_filter, username, password):
         self.sig_start_upload.emit(people_filter, username, password)
+
+    def abort(self):
+        self.sig_abort.emit()
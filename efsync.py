@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+"""Keeps the local database and photo cache warm without the editor
+open. Every so often it logs in, fetches whatever has changed in an
+event since the last fetch, and downloads any photos that aren't in
+the cache yet:
+
+    python efsync.py --event 123 --interval 30
+
+or from cron, once per run:
+
+    python efsync.py --event 123 --once
+
+The password comes from EF_PASSWORD, or is asked for at startup. The
+last fetch is remembered in the same last-fetched-<event> setting the
+fetch wizard uses, so either can pick up where the other left off.
+Changes show up in the editor the next time it's started.
+"""
+
+import sys
+import os
+import time
+import getpass
+import argparse
+import traceback
+import multiprocessing
+from PyQt4 import QtCore, QtGui
+
+from ef.headless import Headless, HeadlessError, core_application
+from ef.photodownload import PrefetchPhotosTask
+from ef.netmetrics import metrics
+from ef.scheduler import scheduler
+
+def log(msg):
+    print '%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), msg)
+    sys.stdout.flush()
+
+class ProgressLog(object):
+    """Logs progress messages, but not every step of them"""
+    def __init__(self):
+        self.last = None
+
+    def __call__(self, text, cur, max):
+        text = unicode(text)
+        if text != self.last:
+            self.last = text
+            log(text)
+
+def watermark(event):
+    value = QtCore.QSettings().value('last-fetched-%d' % event, '').toString()
+    if not len(value):
+        return None
+    return QtCore.QDate.fromString(value, QtCore.Qt.ISODate)
+
+def sync(headless, options, username, password):
+    # Anything changed while we're fetching gets picked up next time
+    started = QtCore.QDate.currentDate()
+    since = watermark(options.event)
+    if since is None:
+        since = started.addDays(-options.days)
+
+    log('Fetching event %d, changes since %s' % (options.event, since.toString(QtCore.Qt.ISODate)))
+    headless.fetch(options.event, since, options.photos, username, password, progress=ProgressLog())
+    QtCore.QSettings().setValue('last-fetched-%d' % options.event, started.toString(QtCore.Qt.ISODate))
+
+    if options.prefetch:
+        task = PrefetchPhotosTask()
+        task.progress.connect(ProgressLog())
+        try:
+            headless.run(task, 'background')
+        finally:
+            log('Downloaded %d photos, %d failed' % (task.downloaded, task.failed))
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep the ef-image-editor database and photo cache up to date')
+    parser.add_argument('--event', type=int, required=True, help='eventsforce event id to fetch')
+    parser.add_argument('--interval', type=float, default=30, help='minutes between fetches (default 30)')
+    parser.add_argument('--once', action='store_true', help='fetch once and exit')
+    parser.add_argument('--days', type=int, default=365, help='how far back the first fetch goes (default 365)')
+    parser.add_argument('--photos', choices=['none', 'missing', 'all'], default='missing',
+                        help='which people to look for photos for (default missing)')
+    parser.add_argument('--no-prefetch', dest='prefetch', action='store_false',
+                        help="don't download photos into the cache")
+    parser.add_argument('--username', help='eventsforce username (default: the one last used in the editor)')
+    parser.add_argument('--datadir', help="data directory (default: the editor's)")
+    parser.add_argument('--metrics', help='write network statistics and scheduler state (as JSON) to this file after each fetch')
+    options = parser.parse_args()
+
+    core_application()
+
+    username = options.username or unicode(QtCore.QSettings().value('ef-username', '').toString())
+    if not username:
+        parser.error('no username given, and none saved by the editor')
+    password = os.environ.get('EF_PASSWORD')
+    if password is None:
+        password = getpass.getpass('eventsforce password for %s: ' % username)
+
+    datadir = options.datadir
+    if datadir is None:
+        datadir = unicode(QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.DataLocation))
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+
+    headless = Headless(datadir)
+    rc = 0
+    try:
+        while True:
+            try:
+                sync(headless, options, username, password)
+                rc = 0
+            except HeadlessError, e:
+                log('Failed: %s' % e)
+                log(scheduler.describe())
+                rc = 1
+            except Exception:
+                log('Failed: %s' % traceback.format_exc())
+                log(scheduler.describe())
+                rc = 1
+            if options.metrics:
+                metrics.dump(options.metrics, scheduler=scheduler.snapshot())
+            if options.once:
+                break
+            time.sleep(options.interval * 60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        headless.close()
+    return rc
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -9,6 +9,7 @@ from datetime import datetime
 
 from ef.ui.membercheck import Ui_MemberCheck
 from ef.netlib import start_network_manager, stop_network_manager
+from ef.scheduler import scheduler
 from ef.memberfile import MemberFile
 from ef.memberscan import MemberScanner
 
@@ -187,7 +188,7 @@ class MemberCheck(QtGui.QMainWindow, Ui_MemberCheck):
         self.scanner.task_exception.connect(self.handle_exception)
         self.scanner.progress.connect(self.handle_progress)
 
-        self.scanner.start_task()
+        scheduler.submit(self.scanner, 'bulk')
 
     def task_ended(self):
         self.start.setEnabled(True)
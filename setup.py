@@ -25,4 +25,5 @@ setup(
 
     # targets to build
     windows = ["ef-image-editor.py", 'membercheck.py', 'duplicatedetect.py'],
+    console = ['efsync.py'],
     )
@@ -0,0 +1,61 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from ef import spool
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.saved = (spool.spooldir, spool.keep_reports, spool.max_reports, spool.max_bytes, spool.max_age)
+        spool.setup_spool(self.datadir)
+
+    def tearDown(self):
+        spool.spooldir, spool.keep_reports, spool.max_reports, spool.max_bytes, spool.max_age = self.saved
+        shutil.rmtree(self.datadir)
+
+    def add(self, params, data=u'<table></table>'):
+        report = spool.ReportSpool(params)
+        report.write(data)
+        meta = report.close()
+        # Keep the dates apart, so that newest first is well defined
+        time.sleep(0.01)
+        return meta
+
+    def names(self, params=None):
+        return [meta['name'] for meta in spool.find_spools(params)]
+
+    def test_runs_with_different_since_expire_oldest(self):
+        spool.keep_reports = 1
+        first = self.add({'profile': 69, 'event': 101, 'since': '2014-01-01'})
+        second = self.add({'profile': 69, 'event': 101, 'since': '2014-02-01'})
+        self.assertEqual(self.names(), [second['name']])
+        self.assertFalse(os.path.exists(spool.spool_path(spool.spool_base(first['name']), 'html.gz')))
+
+    def test_previous_run_found_whatever_since(self):
+        first = self.add({'profile': 69, 'event': 101, 'since': '2014-01-01'})
+        spool.mark_ingested(spool.spool_base(first['name']))
+        self.add({'profile': 69, 'event': 102, 'since': '2014-01-01'})
+        previous = spool.latest_spool({'profile': 69, 'event': 101, 'since': '2014-03-01'}, ingested=True)
+        self.assertEqual(previous['name'], first['name'])
+
+    def test_global_limits(self):
+        spool.max_reports = 2
+        metas = [self.add({'profile': 69, 'event': event}) for event in [101, 102, 103]]
+        self.assertEqual(self.names(), [metas[2]['name'], metas[1]['name']])
+
+        spool.max_bytes = 1
+        newest = self.add({'profile': 69, 'event': 104})
+        self.assertEqual(self.names(), [newest['name']])
+
+    def test_old_reports_expire(self):
+        old = self.add({'profile': 69, 'event': 101})
+        old['date'] = time.time() - spool.max_age - 60
+        spool.write_meta(old)
+        newest = self.add({'profile': 69, 'event': 102})
+        self.assertEqual(self.names(), [newest['name']])
+
+if __name__ == '__main__':
+    unittest.main()
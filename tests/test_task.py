@@ -0,0 +1,74 @@
+import unittest
+
+try:
+    from PyQt4 import QtCore
+except ImportError:
+    QtCore = None
+
+if QtCore is not None:
+    from ef.task import Task, TaskOp
+
+    class ImmediateOp(TaskOp):
+        """Finishes as soon as the task has connected to it"""
+        def __init__(self, value):
+            TaskOp.__init__(self)
+            self.value = value
+
+        def emit_delayed(self):
+            self.finish()
+
+        def result(self):
+            return self.value
+
+    class FailingOp(TaskOp):
+        def emit_delayed(self):
+            self.throw(ValueError('op failed'))
+
+    class AddTask(Task):
+        def task(self):
+            a = yield ImmediateOp(1)
+            b = yield ImmediateOp(2)
+            self.total = a + b
+
+    class CatchTask(Task):
+        def task(self):
+            try:
+                yield FailingOp()
+            except ValueError, e:
+                self.caught = str(e)
+
+    class RaiseTask(Task):
+        def task(self):
+            yield ImmediateOp(None)
+            raise RuntimeError('task failed')
+
+@unittest.skipIf(QtCore is None, 'needs PyQt4')
+class TaskTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+
+    def test_ops_run_through_continue_task(self):
+        task = AddTask()
+        task.start_task()
+        self.assertTrue(task.is_finished)
+        self.assertEqual(task.finished_error, None)
+        self.assertEqual(task.total, 3)
+
+    def test_op_exception_is_thrown_into_task(self):
+        task = CatchTask()
+        task.start_task()
+        self.assertTrue(task.is_finished)
+        self.assertEqual(task.finished_error, None)
+        self.assertEqual(task.caught, 'op failed')
+
+    def test_task_exception_is_reported(self):
+        task = RaiseTask()
+        task.start_task()
+        self.assertTrue(task.is_finished)
+        e, tb_text, blob = task.finished_error
+        self.assertTrue(isinstance(e, RuntimeError))
+        self.assertTrue('task failed' in tb_text)
+
+if __name__ == '__main__':
+    unittest.main()